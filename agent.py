@@ -13,6 +13,7 @@ import tenacity
 
 from booking import book_hotel, book_restaurant, book_taxi, book_train
 from client import MyOpenAI
+from model_registry import is_completion_model
 from prompts import AGENT_TEMPLATE, DB_TEMPLATE_DICT
 from utils import (AGENT_COLOR, DB_PATH, HEADER_COLOR, HEADER_WIDTH,
                    OPENAI_API_KEY, RESET_COLOR, USER_COLOR, tenacity_retry_log)
@@ -131,8 +132,7 @@ class Agent:
     @staticmethod
     def prepare_agent_executor(model):
         # LLM
-        assert model.startswith('text-davinci-') or model.startswith('gpt-3.5-')
-        if model.startswith('text-davinci-'):
+        if is_completion_model(model):
             llm = OpenAI(
                 model_name=model,
                 temperature=0,
@@ -3,6 +3,7 @@ import json
 import openai
 import tenacity
 
+from tracing import tracer
 from utils import OPENAI_API_KEY, tenacity_retry_log
 
 openai.api_key = OPENAI_API_KEY
@@ -27,6 +28,7 @@ class BaseAgent:
         self.messages = [{'role': 'system', 'content': self.system_prompt}]
 
         self.functions = self.make_function_schemas()
+        self.function_schema_map = {func['name']: func for func in self.functions}
         self.function_map = self.make_function_map()
 
     def make_system_prompt(self):
@@ -44,14 +46,17 @@ class BaseAgent:
                     before_sleep=tenacity_retry_log,
                     retry=tenacity.retry_if_exception_type(openai.OpenAIError))
     def chat(self, messages, extra_openai_args={}):
-        completion = openai.ChatCompletion.create(
-            model=self.model_name,
-            temperature=0,
-            messages=messages,
-            functions=self.functions,
-            request_timeout=10,
-            **extra_openai_args,
-        )
+        with tracer.span('chat', 'llm', model=self.model_name, n_messages=len(messages),
+                         prompt_chars=sum(len(m['content'] or '') for m in messages)) as span:
+            completion = openai.ChatCompletion.create(
+                model=self.model_name,
+                temperature=0,
+                messages=messages,
+                functions=self.functions,
+                request_timeout=10,
+                **extra_openai_args,
+            )
+            span.set_usage(completion['usage'])
 
         for callback in self.callbacks:
             callback.on_llm_end(completion)
@@ -88,15 +93,13 @@ class BaseAgent:
             function_call = self.fix_function_call(function_call)
             passed, check_msg = self.check_function_call(function_call)
             if not passed:
-                print()
-                print('Function parsing error:')
-                print(f'function_call: {msg.get("function_call")}')
                 result = check_msg
                 if msg.get('function_call') and msg['function_call'].get('name'):
                     name = msg['function_call']['name']
                 else:
                     name = None
-                print('Result: ' + CYAN_COLOR + f'{result}' + RESET_COLOR)
+                with tracer.span(str(name), 'function', parse_error=check_msg) as span:
+                    span.show(function_call=msg.get('function_call'), result=result)
                 self.messages.append({'role': 'function', 'name': name, 'content': result})
                 continue
 
@@ -104,15 +107,15 @@ class BaseAgent:
             function_call = msg['function_call']
             name, args = function_call['name'], function_call['arguments']
             func = self.function_map[name]
-            args = json.loads(args)
-            result = func(**args)
-            print()
-            print('Function: ' + MAG_COLOR + f'{name}' + RESET_COLOR)
-            print('Arguments: ' + GREEN_COLOR + f'{args}' + RESET_COLOR)
+            with tracer.span(name, 'function', args_chars=len(args)) as span:
+                args = json.loads(args)
+                span.show(args=args)
+                result = func(**args)
+                span.set(result_chars=len(str(result)))
+                span.show(result=result)
             for callback in self.callbacks:
                 callback.on_function_call_end(name, args, result)
 
-            print('Result: ' + CYAN_COLOR + f'{result}' + RESET_COLOR)
             self.messages.append({'role': 'function', 'name': name, 'content': result})
 
     def __call__deprecated(self, user_utter):
@@ -180,8 +183,7 @@ class BaseAgent:
         except json.JSONDecodeError as e:
             return False, f'Invalid json parameters with the exception {e.__class__.__name__}: {e}.'
 
-        func_schema_dict = {func['name']: func for func in self.functions}
-        func_schema = func_schema_dict[name]
+        func_schema = self.function_schema_map[name]
 
         if error_args := [arg for arg in args if arg not in func_schema['parameters']['properties']]:
             error_args_str = ', '.join(f'"{x}"' for x in error_args)
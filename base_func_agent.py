@@ -3,6 +3,7 @@ import json
 import openai
 import tenacity
 
+from tracing import tracer
 from utils import OPENAI_API_KEY, tenacity_retry_log
 
 openai.api_key = OPENAI_API_KEY
@@ -44,14 +45,17 @@ class BaseReactAgent:
                     before_sleep=tenacity_retry_log,
                     retry=tenacity.retry_if_exception_type(openai.OpenAIError))
     def chat(self, messages, extra_openai_args={}):
-        completion = openai.ChatCompletion.create(
-            model=self.model_name,
-            temperature=0,
-            messages=messages,
-            functions=self.functions,
-            request_timeout=10,
-            **extra_openai_args,
-        )
+        with tracer.span('chat', 'llm', model=self.model_name, n_messages=len(messages),
+                         prompt_chars=sum(len(m['content'] or '') for m in messages)) as span:
+            completion = openai.ChatCompletion.create(
+                model=self.model_name,
+                temperature=0,
+                messages=messages,
+                functions=self.functions,
+                request_timeout=10,
+                **extra_openai_args,
+            )
+            span.set_usage(completion['usage'])
 
         for callback in self.callbacks:
             callback.on_llm_end(completion)
@@ -87,15 +91,13 @@ class BaseReactAgent:
             function_call = self.fix_function_call(function_call)
             passed, check_msg = self.check_function_call(function_call)
             if not passed:
-                print()
-                print('Function parsing error:')
-                print(f'function_call: {msg.get("function_call")}')
                 result = check_msg
                 if msg.get('function_call') and msg['function_call'].get('name'):
                     name = msg['function_call']['name']
                 else:
                     name = None
-                print('Result: ' + CYAN_COLOR + f'{result}' + RESET_COLOR)
+                with tracer.span(str(name), 'function', parse_error=check_msg) as span:
+                    span.show(function_call=msg.get('function_call'), result=result)
                 self.messages.append({'role': 'function', 'name': name, 'content': result})
                 continue
 
@@ -103,15 +105,15 @@ class BaseReactAgent:
             function_call = msg['function_call']
             name, args = function_call['name'], function_call['arguments']
             func = self.function_map[name]
-            args = json.loads(args)
-            result = func(**args)
-            print()
-            print('Function: ' + MAG_COLOR + f'{name}' + RESET_COLOR)
-            print('Arguments: ' + GREEN_COLOR + f'{args}' + RESET_COLOR)
+            with tracer.span(name, 'function', args_chars=len(args)) as span:
+                args = json.loads(args)
+                span.show(args=args)
+                result = func(**args)
+                span.set(result_chars=len(str(result)))
+                span.show(result=result)
             for callback in self.callbacks:
                 callback.on_function_call_end(name, args, result)
 
-            print('Result: ' + CYAN_COLOR + f'{result}' + RESET_COLOR)
             self.messages.append({'role': 'function', 'name': name, 'content': result})
 
     def __call__deprecated(self, user_utter):
@@ -1,6 +1,7 @@
 import openai
 import tenacity
 
+from tracing import tracer
 from utils import tenacity_retry_log
 
 
@@ -51,12 +52,14 @@ class BaseUser:
     def run_model(self, agent_utter):
         self.prompt = self.make_prompt(self.dialog, self.history, agent_utter)
 
-        completion = openai.ChatCompletion.create(
-            model=self.model_name,
-            temperature=0,
-            messages=[{'role': 'user', 'content': self.prompt}],
-            request_timeout=10,
-        )
+        with tracer.span('chat', 'llm', model=self.model_name, n_messages=1, prompt_chars=len(self.prompt)) as span:
+            completion = openai.ChatCompletion.create(
+                model=self.model_name,
+                temperature=0,
+                messages=[{'role': 'user', 'content': self.prompt}],
+                request_timeout=10,
+            )
+            span.set_usage(completion['usage'])
 
         for callback in self.callbacks:
             callback.on_llm_end(completion)
@@ -1,6 +1,8 @@
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 import os
 import random
+import time
 
 import click
 import tenacity
@@ -8,22 +10,35 @@ from termcolor import colored, cprint
 from tqdm import tqdm
 
 import engine
-from evaluate import evaluate_by_domain
-from metric import MetricTracker
-from utils import DATA_PATH, DOMAINS, json_default_func, load_data
+from evaluate import evaluate_by_domains, evaluate_by_domains_parallel
+from bootstrap import N_RESAMPLES
+from judge_cache import JUDGE_CACHE_PATH, load_judge_cache
+from metric import MetricTracker, summarize_result, track_run_log
+from pipeline import run_pipeline
+from run_log import RunLog, copy_run_log, open_run_log, pack
+from tracing import configure_tracing, tracer
+from utils import (DATA_PATH, DOMAINS, add_usage, build_data_cache, json_default_func, load_data,
+                   make_usage)
 
 
-def run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model):
+def run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model, eval_mode='domain'):
+    succeed, result = run_dialog(dialog, dialog_id, agent_type, agent_model, user_model)
+    return evaluate_stage((succeed, result), eval_mode)
+
+
+def run_dialog(dialog, dialog_id, agent_type, agent_model, user_model):
+    '''Run the dialog and fill the run result, cost and usage of the result.'''
     result = {
         'dialog_id': dialog_id,
         'status': None,
         'eval_summary': None,
         'cost': 0.0,
+        'latency': None,
+        'usage': None,
         'eval_results': None,
         'run_result': None,
     }
 
-    # Step 1. Run dialog
     def before_sleep_func(retry_state):
         e = retry_state.outcome.exception()
         msg = f'Tenacity: Retrying {retry_state.fn} as it raise {e.__class__.__name__}: '
@@ -31,8 +46,10 @@ def run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model):
         print(msg)
 
     retrying = tenacity.Retrying(stop=tenacity.stop_after_attempt(2), before_sleep=before_sleep_func, reraise=True)
+    start = time.time()
     try:
-        run_result = retrying(engine.run, dialog=dialog, agent_type=agent_type, agent_model=agent_model, user_model=user_model)
+        with tracer.span('dialog', 'dialog', dialog_id=dialog_id):
+            run_result = retrying(engine.run, dialog=dialog, agent_type=agent_type, agent_model=agent_model, user_model=user_model)
     except Exception as e:
         msg = f'Run dialog failed as {e.__class__.__name__}: '
         print(colored(msg, 'red') + str(e))
@@ -40,37 +57,60 @@ def run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model):
         result['status'] = 'failed on run dialog'
         return False, result
     else:
+        result['usage'] = run_result.pop('usage')
         result['run_result'] = run_result
         result['cost'] += run_result['cost']
+        result['latency'] = time.time() - start
+        return True, result
+
+
+def evaluate_stage(run_output, eval_mode='domain'):
+    succeed, result = run_output
+    if not succeed:
+        return False, result
+    succeed = evaluate_run(result, result['run_result'], eval_mode)
+    return succeed, result
+
+
+def evaluate_run(result, run_result, eval_mode='domain'):
+    '''Evaluate the run result and fill the eval results, status, summary, cost and judge usage of the result.'''
+    # Step 1. Evaluate
+    domains = [domain for domain in DOMAINS if run_result['goals'].get(domain)]
+    with tracer.span('evaluate', 'eval', dialog_id=result['dialog_id'], eval_mode=eval_mode, n_domains=len(domains)):
+        if eval_mode == 'merged' and domains:
+            try:
+                domain_results = evaluate_by_domains(domains, run_result)
+            except Exception as e:
+                domain_results = {domain: e for domain in domains}
+        else:
+            domain_results = evaluate_by_domains_parallel(domains, run_result)
 
-    # Step 2. Evaluate
     eval_results = {}
     fail_domains = []
-    for domain in DOMAINS:
-        if not dialog['goal'].get(domain):
-            continue
-        try:
-            eval_result = evaluate_by_domain(domain, run_result)
-        except Exception as e:
-            # raise e
+    result['cost'] = run_result['cost']  # drop the judge cost of an earlier evaluation
+    result['usage'] = result.get('usage') or {}  # logs from before the usage was recorded
+    judge_usage = result['usage']['judge'] = make_usage()
+    for domain, eval_result in domain_results.items():
+        if isinstance(eval_result, Exception):
             fail_domains.append(domain)
-            msg = f'Run dialog failed as {e.__class__.__name__}: '
-            print(colored(msg, 'red') + str(e))
-            eval_results[domain] = {'exception': msg + str(e)}
+            msg = f'Run dialog failed as {eval_result.__class__.__name__}: '
+            print(colored(msg, 'red') + str(eval_result))
+            eval_results[domain] = {'exception': msg + str(eval_result)}
         else:
             eval_results[domain] = eval_result
             result['cost'] += eval_result['cost']
+            add_usage(judge_usage, eval_result['usage'])
     if eval_results == {}:
-        cprint(f'No domain found for evaluation of dialog {dialog_id}.', 'red')
+        cprint(f'No domain found for evaluation of dialog {result["dialog_id"]}.', 'red')
     result['eval_results'] = eval_results
 
-    # Step 3. Status
+    # Step 2. Status
     if fail_domains:
         result['status'] = 'failed on eval dialog of domain: ' + ', '.join(fail_domains)
     else:
         result['status'] = 'succeed'
     
-    # Step 4. Summary
+    # Step 3. Summary
     result['eval_summary'] = {}
     for domain, eval_result in result['eval_results'].items():
         if 'exception' in eval_result:
@@ -82,13 +122,77 @@ def run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model):
                     summary[metric] = s
         result['eval_summary'][domain] = summary
 
-    succeed = result['status'] == 'succeed'
-    return succeed, result
+    return result['status'] == 'succeed'
+
+
+def make_ref_fields_getter(data):
+    '''Fields of a result copied from its dialog in the data, which packed run logs store by reference.'''
+    def get_ref_fields(result):
+        goals, goal_messages, dialog_refer = engine.transform_dialog(data[result['dialog_id']])
+        ref_fields = {
+            ('run_result', 'goals'): goals,
+            ('run_result', 'goal_messages'): goal_messages,
+            ('run_result', 'dialog_refer'): dialog_refer,
+        }
+        for domain in result.get('eval_results') or {}:
+            ref_fields[('eval_results', domain, 'goal')] = goals.get(domain)
+        return ref_fields
+    return get_ref_fields
+
+
+def run_batch(data, run_log, metric_tracker, agent_type, agent_model, user_model, eval_mode='domain',
+              run_workers=1, eval_workers=1, n_done=0, n_succeed=0):
+    '''Run and evaluate the (dialog id, dialog) pairs in a pipeline and append the results to the log in order.
+
+    Simulation and evaluation are separate stages with their own workers, so a dialog is evaluated
+    while the next ones are simulated.
+    '''
+    pbar = tqdm(total=len(data))
+    counter = {'done': n_done, 'succeed': n_succeed}
+
+    def sink(item, output):
+        dialog_id, _ = item
+        if isinstance(output, Exception):
+            msg = f'run_and_evaluate failed as {output.__class__.__name__}: '
+            print(colored(msg, 'red') + str(output))
+            result = {'dialog_id': dialog_id, 'status': 'run_and_evaluate', 'exception': msg + str(output)}
+            succeed = False
+        else:
+            succeed, result = output
+            if succeed:
+                metric_tracker.add_dialog_eval_results(dialog_id, result['eval_results'])
+                metric_tracker.add_cost(dialog_id, result['cost'])
+                summary = summarize_result(result)
+                metric_tracker.add_usage(dialog_id, summary['usage'], summary['n_turns'], summary['latency'])
+
+        run_log.append(result, default=json_default_func)
+
+        counter['done'] += 1
+        counter['succeed'] += succeed
+        succeed_rate = counter['succeed'] / counter['done']
+        succeed_str = f'succeed: {succeed_rate:.0%} ({counter["succeed"]}/{counter["done"]})'
+
+        pbar.update()
+        pbar.set_description(f'Finished {dialog_id}')
+        postfix_str = metric_tracker.generate_postfix_str(prefixes=[succeed_str])
+        pbar.set_postfix_str(postfix_str, refresh=False)
+
+    stages = [
+        (lambda item: run_dialog(item[1], item[0], agent_type, agent_model, user_model), run_workers),
+        (lambda run_output: evaluate_stage(run_output, eval_mode), eval_workers),
+    ]
+    run_pipeline(data, stages, sink)
+    pbar.close()
 
 
 @click.group()
-def batch_run():
-    pass
+@click.option('--trace_file', default=None, help='Export the spans of the dialogs and evaluations to the JSONL file.')
+@click.option('--chrome_trace_file', default=None, help='Export the spans in the Chrome trace event format.')
+@click.option('--quiet', is_flag=True, help='Do not print the dialogs.')
+@click.pass_context
+def batch_run(ctx, trace_file, chrome_trace_file, quiet):
+    configure_tracing(trace_file, chrome_trace_file, print_spans=not quiet)
+    ctx.call_on_close(tracer.close)
 
 
 @batch_run.command()
@@ -99,7 +203,13 @@ def batch_run():
 @click.option('--agent_type', default='func')
 @click.option('--agent_model', default='gpt-3.5-turbo-0613')
 @click.option('--user_model', default='gpt-3.5-turbo-0613')
-def new(log_file, score_table_file, max_dialog, data_path, agent_type, agent_model, user_model):
+@click.option('--eval_mode', type=click.Choice(['domain', 'merged']), default='domain',
+              help='domain: concurrent judge calls, one per domain. merged: one judge call per dialog.')
+@click.option('--run_workers', type=int, default=1, help='Number of dialogs simulated at the same time.')
+@click.option('--eval_workers', type=int, default=1, help='Number of dialogs evaluated at the same time.')
+@click.option('--bootstrap', type=int, default=0, help=f'Bootstrap resamples of the score table, e.g. {N_RESAMPLES}. 0 to skip.')
+def new(log_file, score_table_file, max_dialog, data_path, agent_type, agent_model, user_model, eval_mode,
+        run_workers, eval_workers, bootstrap):
     # Step 0. Check
     if os.path.exists(log_file):
         raise RuntimeError(f'mode = new and {log_file = } exists.')
@@ -114,44 +224,18 @@ def new(log_file, score_table_file, max_dialog, data_path, agent_type, agent_mod
     data = [(idx, data[idx]) for idx in dialog_ids]
 
     first_line = {'max_dialog': max_dialog, 'dialog_ids': dialog_ids,
-                  'agent_type': agent_type, 'agent_model': agent_model, 'user_model': user_model}
-    with open(log_file, 'w') as f:
-        f.write(json.dumps(first_line) + '\n')
+                  'agent_type': agent_type, 'agent_model': agent_model, 'user_model': user_model,
+                  'eval_mode': eval_mode}
+    run_log = RunLog.create(log_file, first_line, summarize_result)
 
     print(f'Sampled {max_dialog} dialogs from "{data_path}".')
 
     # Step 2. Batch Run
     metric_tracker = MetricTracker()
-    n_succeed = 0
-    pbar = tqdm(data)
-    for idx, (dialog_id, dialog) in enumerate(pbar, start=1):
-        pbar.set_description(f'Processing {dialog_id}')
-
-        # TODO: print goal?
-        try:
-            succeed, result = run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model)
-        except Exception as e:
-            # raise e
-            msg = f'run_and_evaluate failed as {e.__class__.__name__}: '
-            print(colored(msg, 'red') + str(e))
-            result = {'dialog_id': dialog_id, 'status': 'run_and_evaluate', 'exception': msg + str(e)}
-            succeed = False
-        else:  # TODO: how about: if succeed:
-            metric_tracker.add_dialog_eval_results(dialog_id, result['eval_results'])
-            metric_tracker.add_cost(dialog_id, result['cost'])
-
-        with open(log_file, 'a') as f:
-            f.write(json.dumps(result, default=json_default_func) + '\n')
-
-        n_succeed += succeed
-        succeed_rate = n_succeed / idx
-        succeed_str = f'succeed: {succeed_rate:.0%} ({n_succeed}/{idx})'
-
-        postfix_str = metric_tracker.generate_postfix_str(prefixes=[succeed_str])
-        pbar.set_postfix_str(postfix_str, refresh=False)
+    run_batch(data, run_log, metric_tracker, agent_type, agent_model, user_model, eval_mode, run_workers, eval_workers)
 
     # Step 3. Summary
-    summary = metric_tracker.generate_summary_tables()
+    summary = metric_tracker.generate_summary_tables(bootstrap)
     with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
@@ -160,7 +244,10 @@ def new(log_file, score_table_file, max_dialog, data_path, agent_type, agent_mod
 @click.option('--log_file')
 @click.option('--score_table_file')
 @click.option('--data_path', default=DATA_PATH)
-def recover(log_file, score_table_file, data_path):
+@click.option('--run_workers', type=int, default=1, help='Number of dialogs simulated at the same time.')
+@click.option('--eval_workers', type=int, default=1, help='Number of dialogs evaluated at the same time.')
+@click.option('--bootstrap', type=int, default=0, help=f'Bootstrap resamples of the score table, e.g. {N_RESAMPLES}. 0 to skip.')
+def recover(log_file, score_table_file, data_path, run_workers, eval_workers, bootstrap):
     # Step 0. Check
     if not os.path.exists(log_file):
         raise RuntimeError(f'mode = recover and {log_file = } does not exist.')
@@ -169,61 +256,26 @@ def recover(log_file, score_table_file, data_path):
     
     # Step 1. Load
     all_data = load_data(data_path)
-    
-    with open(log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
-    n_target_dialogs = len(data[0]['dialog_ids'])
-    n_finish_dialogs = len(data) - 1
-    n_left_dialogs = n_target_dialogs - n_finish_dialogs
-    print(f'Recover: Target: {n_target_dialogs}, Finish: {n_finish_dialogs}, Left: {n_left_dialogs}')
-    agent_type, agent_model, user_model = data[0]['agent_type'], data[0]['agent_model'], data[0]['user_model']
-    print(f'Run parameters: {agent_type = }, {agent_model = }, {user_model = }')
-
-    # Step 2. Check dialog ids
-    dialog_ids = data[0]['dialog_ids']
-    for dialog_id, item in zip(dialog_ids, data[1:]):
-        assert dialog_id == item['dialog_id']
-
-    # Step 3. Batch Run
-    metric_tracker = MetricTracker()
-    n_succeed = 0
-
-    # finished dialogs
-    for result in data[1:]:
-        n_succeed += result['status'] == 'succeed'
-        metric_tracker.add_dialog_eval_results(result['dialog_id'], result['eval_results'])
-        metric_tracker.add_cost(result['dialog_id'], result['cost'])
-
-    # new dialogs
-    dialog_ids = data[0]['dialog_ids'][n_finish_dialogs:]
-    pbar = tqdm(dialog_ids)
-    for idx, dialog_id in enumerate(pbar, start=n_finish_dialogs + 1):
-        pbar.set_description(f'Processing {dialog_id}')
-        dialog = all_data[dialog_id]
-
-        try:
-            succeed, result = run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model)
-        except Exception as e:
-            msg = f'run_and_evaluate failed as {e.__class__.__name__}: '
-            print(colored(msg, 'red') + str(e))
-            result = {'dialog_id': dialog_id, 'status': 'run_and_evaluate', 'exception': msg + str(e)}
-            succeed = False
-        else:  # TODO: how about: if succeed:
-            metric_tracker.add_dialog_eval_results(dialog_id, result['eval_results'])
-            metric_tracker.add_cost(dialog_id, result['cost'])
-
-        with open(log_file, 'a') as f:
-            f.write(json.dumps(result, default=json_default_func) + '\n')
 
-        n_succeed += succeed
-        succeed_rate = n_succeed / idx
-        succeed_str = f'succeed: {succeed_rate:.0%} ({n_succeed}/{idx})'
+    # Only the index is read: the finished dialogs and their metrics
+    run_log = open_run_log(log_file, summarize_result)
+    header = run_log.header
+    left_dialog_ids = [dialog_id for dialog_id in header['dialog_ids'] if dialog_id not in run_log]
+    n_target_dialogs = len(header['dialog_ids'])
+    n_finish_dialogs = n_target_dialogs - len(left_dialog_ids)
+    print(f'Recover: Target: {n_target_dialogs}, Finish: {n_finish_dialogs}, Left: {len(left_dialog_ids)}')
+    agent_type, agent_model, user_model = header['agent_type'], header['agent_model'], header['user_model']
+    eval_mode = header.get('eval_mode', 'domain')
+    print(f'Run parameters: {agent_type = }, {agent_model = }, {user_model = }, {eval_mode = }')
 
-        postfix_str = metric_tracker.generate_postfix_str(prefixes=[succeed_str])
-        pbar.set_postfix_str(postfix_str, refresh=False)
+    # Step 2. Batch Run
+    metric_tracker, n_succeed = track_run_log(run_log)
+    new_data = [(dialog_id, all_data[dialog_id]) for dialog_id in left_dialog_ids]
+    run_batch(new_data, run_log, metric_tracker, agent_type, agent_model, user_model, eval_mode, run_workers, eval_workers,
+              n_done=n_finish_dialogs, n_succeed=n_succeed)
 
     # Step 3. Summary
-    summary = metric_tracker.generate_summary_tables()
+    summary = metric_tracker.generate_summary_tables(bootstrap)
     with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
@@ -234,6 +286,7 @@ def recover(log_file, score_table_file, data_path):
 @click.option('--updated_score_table_file', default='logs_updated_table.md')
 @click.option('--data_path', default=DATA_PATH)
 def update(log_file, updated_log_file, updated_score_table_file, data_path):
+    '''Re-run the failed dialogs and append their results as patches to a copy of the log, the updated log.'''
     # Step 0. Check
     if not os.path.exists(log_file):
         raise RuntimeError(f'mode = update and {log_file = } does not exist.')
@@ -244,27 +297,21 @@ def update(log_file, updated_log_file, updated_score_table_file, data_path):
     
     # Step 1. Load
     all_data = load_data(data_path)
-    
-    with open(log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
-    n_dialog = len(data) - 1
-    print(f'Loaded {n_dialog} dialogus from "{log_file}".')
-    agent_type, agent_model, user_model = data[0]['agent_type'], data[0]['agent_model'], data[0]['user_model']
-    print(f'Run parameters: {agent_type = }, {agent_model = }, {user_model = }')
+
+    run_log = open_run_log(log_file, summarize_result)
+    header = run_log.header
+    print(f'Loaded {len(run_log)} dialogs from "{log_file}".')
+    agent_type, agent_model, user_model = header['agent_type'], header['agent_model'], header['user_model']
+    eval_mode = header.get('eval_mode', 'domain')
+    print(f'Run parameters: {agent_type = }, {agent_model = }, {user_model = }, {eval_mode = }')
 
     # Step 2. Check dialog ids
-    dialog_ids = data[0]['dialog_ids']
-    assert len(dialog_ids) == len(data) - 1
-    for dialog_id, item in zip(dialog_ids, data[1:]):
-        assert dialog_id == item['dialog_id']
+    if left_dialog_ids := [dialog_id for dialog_id in header['dialog_ids'] if dialog_id not in run_log]:
+        raise RuntimeError(f'mode = update and {len(left_dialog_ids)} dialogs are not finished. Use recover first.')
 
     # Step 3. Scan failed dialogs
-    data_fails = []
-    for i, item in enumerate(data[1:], start=1):
-        if item['status'] != 'succeed':
-            dialog_id = data[0]['dialog_ids'][i - 1]
-            dialog = all_data[dialog_id]
-            data_fails.append((i, dialog_id, dialog))
+    data_fails = [(dialog_id, all_data[dialog_id]) for dialog_id in run_log.dialog_ids()
+                  if run_log.get_summary(dialog_id)['status'] != 'succeed']
     if len(data_fails) > 0:
         print(f'{len(data_fails)} failed dialogs found.')
     else:
@@ -272,25 +319,22 @@ def update(log_file, updated_log_file, updated_score_table_file, data_path):
         return
 
     # Step 4. Update
+    run_log = copy_run_log(log_file, updated_log_file, summarize_result)
     pbar = tqdm(data_fails)
     n_total, n_succeed = 0, 0
-    for i, dialog_id, dialog in pbar:
+    for dialog_id, dialog in pbar:
         pbar.set_description(f'Processing {dialog_id}')
 
         try:
-            succeed, result = run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model)
+            succeed, result = run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model, eval_mode)
         except Exception as e:
-            # raise e
             msg = f'run_and_evaluate failed as {e.__class__.__name__}: '
             print(colored(msg, 'red') + str(e))
-            print(f'Update dialog faided: Line {i + 1}, Dialog_id: {dialog_id}')
+            print(f'Update dialog faided: Dialog_id: {dialog_id}')
             succeed = False
         else:
-            data[i] = result
-            with open(updated_log_file, 'w') as f:
-                data_raw = [json.dumps(item, default=json_default_func) for item in data]
-                f.write('\n'.join(data_raw) + '\n')
-            print(f'Updated to "{updated_log_file}": Line {i + 1}, Dialog_id: {dialog_id}')
+            run_log.append(result, default=json_default_func)
+            print(f'Updated to "{updated_log_file}": Dialog_id: {dialog_id}')
 
         n_total += 1
         n_succeed += succeed
@@ -299,20 +343,162 @@ def update(log_file, updated_log_file, updated_score_table_file, data_path):
     print(f'Finish: succeed: {succeed_rate:.0%} ({n_succeed}/{n_total})')
 
     # Step 5. Summary
-    with open(updated_log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
+    metric_tracker, _ = track_run_log(run_log)
+    summary = metric_tracker.generate_summary_tables()
+    with open(updated_score_table_file, 'w') as f:
+        f.write(summary + '\n')
+
+
+@batch_run.command()
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--compacted_log_file', default=None, help='Default: compact the log in place.')
+def compact(log_file, compacted_log_file):
+    '''Drop the records superseded by patches from the log.'''
+    if not os.path.exists(log_file):
+        raise RuntimeError(f'mode = compact and {log_file = } does not exist.')
+    size = os.path.getsize(log_file)
+    run_log = open_run_log(log_file, summarize_result).compact(compacted_log_file)
+    print(f'Compacted {len(run_log)} dialogs to "{run_log.log_file}": '
+          f'{size / 2**20:.1f} MB -> {os.path.getsize(run_log.log_file) / 2**20:.1f} MB')
+
+
+@batch_run.command('pack')
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--packed_log_file', default=None, help='Default: <log_file>.z')
+@click.option('--data_path', default=DATA_PATH)
+@click.option('--block_size', type=int, default=64, help='Number of results per compressed block.')
+def pack_log(log_file, packed_log_file, data_path, block_size):
+    '''Pack the latest results of the log into compressed blocks, with the data fields by reference.'''
+    packed_log_file = packed_log_file or log_file + '.z'
+    if not os.path.exists(log_file):
+        raise RuntimeError(f'mode = pack and {log_file = } does not exist.')
+    if os.path.exists(packed_log_file):
+        raise RuntimeError(f'mode = pack and {packed_log_file = } exists.')
+    size = os.path.getsize(log_file)
+    get_ref_fields = make_ref_fields_getter(load_data(data_path))
+    run_log = pack(open_run_log(log_file, summarize_result, get_ref_fields), packed_log_file, get_ref_fields, block_size)
+    print(f'Packed {len(run_log)} dialogs to "{packed_log_file}": '
+          f'{size / 2**20:.1f} MB -> {os.path.getsize(packed_log_file) / 2**20:.1f} MB')
+
+
+def reevaluate_logs(data, indices, eval_mode='domain', workers=1, keep_cost=False):
+    '''Re-evaluate the run results of the log items `data[i]` in parallel, in place. Never re-run dialogs.
+
+    With `keep_cost`, the logged cost and judge usage are kept, for judge answers replayed from the cache.
+    '''
+    def reevaluate(i):
+        result = copy.deepcopy(data[i])
+        succeed = evaluate_run(result, result['run_result'], eval_mode)
+        if keep_cost:
+            result['cost'] = data[i]['cost']
+            if judge_usage := (data[i].get('usage') or {}).get('judge'):
+                result['usage']['judge'] = copy.deepcopy(judge_usage)
+        return i, succeed, result
+
+    n_total, n_succeed = 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reevaluate, i) for i in indices]
+        pbar = tqdm(as_completed(futures), total=len(futures))
+        for future in pbar:
+            i, succeed, result = future.result()
+            data[i] = result
+            n_total += 1
+            n_succeed += succeed
+            pbar.set_postfix_str(f'succeed: {n_succeed / n_total:.0%} ({n_succeed}/{n_total})', refresh=False)
+    print(f'Finish: {n_succeed} of {n_total} re-evaluated dialogs succeed.')
+
+
+def save_logs_and_summary(data, log_file, score_table_file):
+    run_log = RunLog.create(log_file, data[0], summarize_result)
+    for item in data[1:]:
+        run_log.append(item, default=json_default_func)
+    print(f'Saved to "{log_file}".')
 
     metric_tracker = MetricTracker()
     for item in data[1:]:
         if item['status'] == 'succeed':
             metric_tracker.add_dialog_eval_results(item['dialog_id'], item['eval_results'])
             metric_tracker.add_cost(item['dialog_id'], item['cost'])
+            summary = summarize_result(item)
+            metric_tracker.add_usage(item['dialog_id'], summary['usage'], summary['n_turns'], summary['latency'])
 
-    # Step 6. Summary
     summary = metric_tracker.generate_summary_tables()
-    with open(updated_score_table_file, 'w') as f:
+    with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
 
+def load_logs_for_evaluation(log_file, output_files, mode, data_path=DATA_PATH):
+    for path in output_files:
+        if os.path.exists(path):
+            raise RuntimeError(f'mode = {mode} and {path = } exists.')
+    if not os.path.exists(log_file):
+        raise RuntimeError(f'mode = {mode} and {log_file = } does not exist.')
+
+    run_log = open_run_log(log_file, summarize_result, make_ref_fields_getter(load_data(data_path)))
+    data = [run_log.header, *run_log.records()]
+    print(f'Loaded {len(data) - 1} dialogs from "{log_file}".')
+
+    # Dialogs failed on run have nothing to evaluate
+    evaluable = [i for i, item in enumerate(data[1:], start=1)
+                 if isinstance(item.get('run_result'), dict) and 'exception' not in item['run_result']]
+    return data, evaluable
+
+
+@batch_run.command('evaluate')
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--evaluated_log_file', default='logs_evaluated.jsonl')
+@click.option('--evaluated_score_table_file', default='logs_evaluated_table.md')
+@click.option('--dialog_ids', default=None, help='Comma separated dialog ids. Default: the dialogs failed on evaluation.')
+@click.option('--eval_mode', type=click.Choice(['domain', 'merged']), default=None,
+              help='Default: the eval mode of the log.')
+@click.option('--data_path', default=DATA_PATH)
+@click.option('--workers', type=int, default=4)
+def evaluate_logs(log_file, evaluated_log_file, evaluated_score_table_file, dialog_ids, eval_mode, data_path, workers):
+    '''Re-evaluate the failed or selected dialogs of the log from their run results.'''
+    # Step 1. Load
+    data, evaluable = load_logs_for_evaluation(log_file, [evaluated_log_file, evaluated_score_table_file], 'evaluate',
+                                               data_path)
+    eval_mode = eval_mode or data[0].get('eval_mode', 'domain')
+
+    # Step 2. Select
+    if dialog_ids:
+        dialog_ids = set(dialog_ids.split(','))
+        indices = [i for i in evaluable if data[i]['dialog_id'] in dialog_ids]
+        if missing := dialog_ids - {data[i]['dialog_id'] for i in indices}:
+            cprint(f'Skip dialogs not found or failed on run: {", ".join(sorted(missing))}', 'red')
+    else:
+        indices = [i for i in evaluable if data[i]['status'] != 'succeed']
+    print(f'Evaluate {len(indices)} dialogs. {eval_mode = }')
+
+    # Step 3. Evaluate
+    reevaluate_logs(data, indices, eval_mode, workers)
+    save_logs_and_summary(data, evaluated_log_file, evaluated_score_table_file)
+
+
+@batch_run.command()
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--rescored_log_file', default='logs_rescored.jsonl')
+@click.option('--rescored_score_table_file', default='logs_rescored_table.md')
+@click.option('--data_path', default=DATA_PATH)
+@click.option('--judge_cache_path', default=JUDGE_CACHE_PATH)
+@click.option('--workers', type=int, default=4)
+def re_score(log_file, rescored_log_file, rescored_score_table_file, data_path, judge_cache_path, workers):
+    '''Re-score the run results with the current evaluator and the cached judge answers only.'''
+    data, evaluable = load_logs_for_evaluation(log_file, [rescored_log_file, rescored_score_table_file], 're-score',
+                                               data_path)
+    eval_mode = data[0].get('eval_mode', 'domain')
+    load_judge_cache(judge_cache_path, replay_only=True)
+
+    # The replayed answers cost nothing now, so keep the judge cost paid in the run of the log
+    reevaluate_logs(data, evaluable, eval_mode, workers, keep_cost=True)
+    save_logs_and_summary(data, rescored_log_file, rescored_score_table_file)
+
+
+@batch_run.command()
+@click.option('--data_path', default=DATA_PATH)
+def build_cache(data_path):
+    build_data_cache(data_path)
+
+
 if __name__ == '__main__':
     batch_run()
@@ -0,0 +1,56 @@
+import numpy as np
+
+N_RESAMPLES = 1000
+ALPHA = 0.05
+
+
+def resample_counts(n, n_resamples=N_RESAMPLES, seed=0):
+    '''How many times each of the n dialogs is drawn in each resample: (n_resamples, n).'''
+    rng = np.random.default_rng(seed)
+    return rng.multinomial(n, np.full(n, 1.0 / n), size=n_resamples)
+
+
+def ratio_of_sums(counts, hits, totals):
+    '''sum(hits) / sum(totals) of each resample and score: (n_resamples, n_scores). NaN if there is no total.'''
+    hit_sums, total_sums = counts @ hits, counts @ totals
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(total_sums > 0, hit_sums / total_sums, np.nan)
+
+
+def point_scores(hits, totals):
+    '''sum(hits) / sum(totals) over the dialogs of each score: (n_scores,).'''
+    hits, totals = np.asarray(hits, dtype=float), np.asarray(totals, dtype=float)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return hits.sum(0) / totals.sum(0)
+
+
+def bootstrap_scores(hits, totals, n_resamples=N_RESAMPLES, alpha=ALPHA, seed=0):
+    '''Percentile bootstrap over dialogs of scores which are sum(hits) / sum(totals).
+
+    `hits` and `totals` are (n_dialogs, n_scores) arrays, e.g. a dialog with two domains has a total
+    of 2 for a domain level score. All the scores are resampled in one matrix product.
+    Returns the scores and the low and high ends of their confidence intervals, each (n_scores,).
+    '''
+    hits, totals = np.asarray(hits, dtype=float), np.asarray(totals, dtype=float)
+    scores = point_scores(hits, totals)
+    samples = ratio_of_sums(resample_counts(len(hits), n_resamples, seed), hits, totals)
+    low, high = np.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    return scores, low, high
+
+
+def paired_bootstrap(hits_a, totals_a, hits_b, totals_b, n_resamples=N_RESAMPLES, alpha=ALPHA, seed=0):
+    '''Paired bootstrap of the score differences of two runs over the same dialogs (in the same order).
+
+    Both runs are resampled with the same dialogs. Returns the differences (a - b), the low and high
+    ends of their confidence intervals and the two-sided p-values, each (n_scores,).
+    '''
+    hits_a, totals_a = np.asarray(hits_a, dtype=float), np.asarray(totals_a, dtype=float)
+    hits_b, totals_b = np.asarray(hits_b, dtype=float), np.asarray(totals_b, dtype=float)
+    deltas = point_scores(hits_a, totals_a) - point_scores(hits_b, totals_b)
+
+    counts = resample_counts(len(hits_a), n_resamples, seed)
+    samples = ratio_of_sums(counts, hits_a, totals_a) - ratio_of_sums(counts, hits_b, totals_b)
+    low, high = np.nanpercentile(samples, [100 * alpha / 2, 100 * (1 - alpha / 2)], axis=0)
+    n_valid = np.maximum((~np.isnan(samples)).sum(0), 1)
+    p_values = 2 * np.minimum((samples <= 0).sum(0), (samples >= 0).sum(0)) / n_valid
+    return deltas, low, high, np.minimum(p_values, 1.0)
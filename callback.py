@@ -1,4 +1,4 @@
-from utils import calc_openai_cost
+from utils import add_usage, completion_usage, make_usage
 
 
 class BaseCallback:
@@ -14,13 +14,19 @@ class BaseCallback:
 
 
 class CostCallback(BaseCallback):
+    '''Cost and usage (LLM calls, tokens and function calls) of the role the callback is given to.'''
 
     def __init__(self):
         self.cost = 0.0
+        self.usage = make_usage()
 
     def on_llm_end(self, completion):
-        cost = calc_openai_cost(completion['model'], completion['usage'])
-        self.cost += cost
+        usage = completion_usage(completion['model'], completion['usage'])
+        add_usage(self.usage, usage)
+        self.cost += usage['cost']
+
+    def on_function_call_end(self, function_name, args, result):
+        self.usage['function_calls'] += 1
 
 
 class AgentUtterTrimCallback(BaseCallback):
@@ -2,29 +2,44 @@ import json
 import random
 
 from langchain.callbacks.base import BaseCallbackHandler
-from termcolor import cprint
-
 from agent import Agent
+from callback import FunctionCallCollectCallback
+from event_bus import CallbackBus
 from func_agent import FuncAgent
+from model_registry import supports_function_call
+from tracing import tracer
 from user import User
-from utils import (AGENT_COLOR, DOMAINS, HEADER_COLOR, HEADER_WIDTH,
-                   RESET_COLOR, USER_COLOR, calc_openai_cost)
+from utils import DOMAINS, add_usage, completion_usage, make_usage
+
+
+def run_role(role, func, *args, **kwargs):
+    '''The utterance of the role (user or agent) in a span. Returns the utterance and its wall time.'''
+    with tracer.span(role, 'role') as span:
+        utter = func(*args, **kwargs)
+        span.set(utter_chars=len(utter))
+        span.show(utter=utter)
+    return utter, span.duration
 
 
-def run_with_user_agent(user, agent, max_iter=15):
+def run_with_user_agent(user, agent, max_iter=15, wall_time=None):
+    '''With `wall_time` (role -> seconds), the wall time of the user and the agent is added to it.
+
+    The wall time is kept apart from the usage of the roles, which their callbacks update on the dispatcher
+    thread. Add it to the usage after flushing the callbacks.
+    '''
+    wall_time = {'user': 0.0, 'agent': 0.0} if wall_time is None else wall_time
     logs = []
     agent_utter = None
     for turn_idx in range(1, max_iter + 1):
-        print('=' * 50 + f' Turn {turn_idx} ' + '=' * 50, end='\n\n')
-        
-        user_utter = user(agent_utter)
-        cprint(f'User: {user_utter}', color='blue', attrs=['bold'], force_color=True, end='\n\n')
+        with tracer.span('turn', 'turn', turn_idx=turn_idx):
+            user_utter, seconds = run_role('user', user, agent_utter)
+            wall_time['user'] += seconds
 
-        if 'dialogue ends' in user_utter.lower():
-            break
+            if 'dialogue ends' in user_utter.lower():
+                break
 
-        agent_utter = agent(user_utter)
-        cprint(f'AI Assistant: {agent_utter}', color='yellow', attrs=['bold'], force_color=True, end='\n\n')
+            agent_utter, seconds = run_role('agent', agent, user_utter)
+            wall_time['agent'] += seconds
 
         logs.append({'turn_idx': turn_idx, 'user': user_utter, 'agent': agent_utter})
 
@@ -52,13 +67,54 @@ def transform_dialog(dialog):
 
 
 class CostHandler(BaseCallbackHandler):
+    '''Cost and usage (LLM calls, tokens and function calls) of the role the handler is given to.'''
 
     def __init__(self):
         self.cost = 0.0
+        self.usage = make_usage()
+
+    def on_llm_end(self, response, **kwargs):
+        usage = completion_usage(response.llm_output['model_name'], response.llm_output['token_usage'])
+        add_usage(self.usage, usage)
+        self.cost += usage['cost']
+
+    def on_tool_end(self, output, **kwargs):
+        self.usage['function_calls'] += 1
+
+    def on_function_call_end(self, function_name, args, result):
+        self.usage['function_calls'] += 1
+
+
+class TraceHandler(BaseCallbackHandler):
+    '''Spans of the LLM and tool calls inside langchain chains and agents.'''
+
+    def __init__(self):
+        self.spans = {}  # langchain run id -> span
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.spans[kwargs['run_id']] = tracer.start_span('llm', 'llm', n_messages=len(prompts),
+                                                         prompt_chars=sum(len(p) for p in prompts))
 
     def on_llm_end(self, response, **kwargs):
-        cost = calc_openai_cost(response.llm_output['model_name'], response.llm_output['token_usage'])
-        self.cost += cost
+        span = self.spans.pop(kwargs['run_id'])
+        span.set(model=response.llm_output.get('model_name'))
+        span.set_usage(response.llm_output.get('token_usage', {}))
+        tracer.end_span(span)
+
+    def on_llm_error(self, error, **kwargs):
+        tracer.end_span(self.spans.pop(kwargs['run_id']), error)
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        self.spans[kwargs['run_id']] = tracer.start_span(serialized.get('name', 'tool'), 'function',
+                                                         args_chars=len(input_str))
+
+    def on_tool_end(self, output, **kwargs):
+        span = self.spans.pop(kwargs['run_id'])
+        span.set(result_chars=len(str(output)))
+        tracer.end_span(span)
+
+    def on_tool_error(self, error, **kwargs):
+        tracer.end_span(self.spans.pop(kwargs['run_id']), error)
 
 
 class AgentUtterTrimHandler:
@@ -90,12 +146,14 @@ def run(dialog, agent_type, model=None, agent_model=None, user_model=None, log_f
 
     final_sys_model = agent_model if agent_model else model
     if agent_type == 'func':
-        assert final_sys_model.startswith('gpt-3.5-turbo-0613')
+        assert supports_function_call(final_sys_model), f'{final_sys_model = } does not support function call in the model registry.'
         agent = FuncAgent(model=final_sys_model)
     else:
         agent = Agent(model=final_sys_model)
 
-    cost_handler = CostHandler()
+    user_cost_handler = CostHandler()
+    agent_cost_handler = CostHandler()
+    function_call_collect = FunctionCallCollectCallback()
     trim = AgentUtterTrimHandler(
         patterns=['\nSure! I can help you with that.',
                   '\nSure, I can help you with that.',],
@@ -103,26 +161,28 @@ def run(dialog, agent_type, model=None, agent_model=None, user_model=None, log_f
         verbose=True,
     )
 
+    agent_bus = CallbackBus([agent_cost_handler, trim, function_call_collect])
+
+    wall_time = {'user': 0.0, 'agent': 0.0}  # not in the usage, which the bus updates on its thread
     logs = []
     turn_idx = 1
     sys_utter = None
     finish_status = None
     for turn_idx in range(1, max_iter + 1):
-        print(HEADER_COLOR + '=' * HEADER_WIDTH + f' Turn {turn_idx} ' + '=' * HEADER_WIDTH + RESET_COLOR, end='\n\n')
-        
-        user_utter = user(sys_utter, callbacks=[cost_handler])
-        print(USER_COLOR + f'User: {user_utter}' + RESET_COLOR, end='\n')
-
-        if 'dialogue ends' in user_utter.lower():
-            finish_status = 'dialogue ends'
-            break
-
-        callbacks = [cost_handler]
-        if agent_type == 'func':
-            callbacks.append(trim)
-        sys_utter = agent(user_utter, callbacks=callbacks)
-        print()
-        print(AGENT_COLOR + f'AI Assistant: {sys_utter}' + RESET_COLOR, end='\n\n')
+        with tracer.span('turn', 'turn', turn_idx=turn_idx):
+            user_utter, seconds = run_role('user', user, sys_utter, callbacks=[user_cost_handler, TraceHandler()])
+            wall_time['user'] += seconds
+
+            if 'dialogue ends' in user_utter.lower():
+                finish_status = 'dialogue ends'
+                break
+
+            if agent_type == 'func':  # FuncAgent traces its own calls
+                callbacks = [agent_bus]
+            else:
+                callbacks = [agent_cost_handler, TraceHandler()]
+            sys_utter, seconds = run_role('agent', agent, user_utter, callbacks=callbacks)
+            wall_time['agent'] += seconds
 
         logs.append({
             'turn_idx': turn_idx,
@@ -130,14 +190,19 @@ def run(dialog, agent_type, model=None, agent_model=None, user_model=None, log_f
             'agent': sys_utter,
         })
 
+    agent_bus.flush()
+    user_cost_handler.usage['wall_time'] += wall_time['user']
+    agent_cost_handler.usage['wall_time'] += wall_time['agent']
     goals, goal_messages, dialog_refer = transform_dialog(dialog)
     result = {
-        'cost': cost_handler.cost,
+        'cost': user_cost_handler.cost + agent_cost_handler.cost,
+        'usage': {'user': user_cost_handler.usage, 'agent': agent_cost_handler.usage},
         'dialog_pred': logs,
         'goals': goals,
         'goal_messages': goal_messages,
         'dialog_refer': dialog_refer,
         'finish_status': finish_status,
+        'callings': function_call_collect.callings,
     }
 
     if log_file:
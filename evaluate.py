@@ -1,16 +1,26 @@
+from concurrent.futures import ThreadPoolExecutor
 import json
+import os
 from pprint import pprint
+import re
 
 import openai
 import tenacity
 
 import booking
 import db
-from utils import (DOMAINS, OPENAI_API_KEY, calc_openai_cost, clean_time,
-                   prepare_goals_string, tenacity_retry_log)
+from judge_cache import load_judge_cache, make_judge_key
+from model_registry import supports_function_call
+from tracing import in_current_context, tracer
+from utils import (DOMAINS, OPENAI_API_KEY, add_usage, clean_time, completion_usage, make_usage,
+                   parse_llm_json, prepare_goals_string, tenacity_retry_log)
 
 openai.api_key = OPENAI_API_KEY
 
+# The judge of the MultiWOZ results. It has no function calling, so it answers in JSON; a judge model with function
+# calling, e.g. gpt-3.5-turbo-0613, answers by calling the answer function, but its scores differ from the results.
+JUDGE_MODEL = os.environ.get('JUDGE_MODEL', 'gpt-3.5-turbo-0301')
+
 
 SYSTEM_PROMPT = '''You are a calm, objective and professional judger and good at to evaluate quality of dialuges between user and AI Assistant. Your judging results are always accurate and concise.'''
 
@@ -46,6 +56,11 @@ Answer:
 ```'''
 
 
+FUNCTION_ANSWER_FORMAT = '''Answer Format:
+
+Please call the function `answer_questions` with the answers. If no answer for a question, please fill `none`.'''
+
+
 def prepare_dialog_string_with_action(dialog):
     dialog_str = []
     for turn in dialog:
@@ -73,6 +88,33 @@ def prepare_dialog_string(dialog):
     return dialog_str
 
 
+def join_questions(questions, answer_formats):
+    questions = '\n'.join(questions)
+
+    answer_formats = [' ' * 4 + s for s in answer_formats]
+    answer_formats = '\n'.join(answer_formats)
+    answer_formats = ANSWER_FORMAT_TEMPLATE.format(answer_formats=answer_formats)
+
+    return questions, answer_formats
+
+
+def get_answer_key(answer_format):
+    return re.match(r'"(.+?)":', answer_format)[1]
+
+
+def make_answer_properties(questions, answer_formats):
+    '''Properties of the answer function schema: answer key -> question.'''
+    return {get_answer_key(a): {'type': 'string', 'description': q} for q, a in zip(questions, answer_formats)}
+
+
+def make_answer_schema(properties):
+    return {
+        'name': 'answer_questions',
+        'description': 'Submit the answers of the questions. If no answer for a question, fill `none`.',
+        'parameters': {'type': 'object', 'properties': properties, 'required': list(properties)},
+    }
+
+
 # region: Taxi
 
 TAXI_SLOT_MAP = {
@@ -85,7 +127,7 @@ TAXI_SLOT_MAP = {
 }
 
 
-def prepare_taxi_questions(goal):
+def prepare_taxi_questions(goal, join=True):
     '''
     Goal:
         'info': {'arriveBy', 'departure', 'destination', 'leaveAt'}
@@ -113,13 +155,9 @@ def prepare_taxi_questions(goal):
         answer_formats.append(a)
         q_idx += 1
 
-    questions = '\n'.join(questions)
-
-    answer_formats = [' ' * 4 + s for s in answer_formats]
-    answer_formats = '\n'.join(answer_formats)
-    answer_formats = ANSWER_FORMAT_TEMPLATE.format(answer_formats=answer_formats)
-
-    return questions, answer_formats
+    if not join:
+        return questions, answer_formats
+    return join_questions(questions, answer_formats)
 
 
 def evaluate_by_domain_taxi(goal, llm_answer):
@@ -175,7 +213,7 @@ TRAIN_SLOT_MAP = {
 }
 
 
-def prepare_train_questions(goal):
+def prepare_train_questions(goal, join=True):
     '''
     Goal:
         'info': {'arriveBy', 'day', 'departure', 'destination', 'leaveAt'},
@@ -215,13 +253,9 @@ def prepare_train_questions(goal):
             answer_formats.append(a)
             q_idx += 1
 
-    questions = '\n'.join(questions)
-
-    answer_formats = [' ' * 4 + s for s in answer_formats]
-    answer_formats = '\n'.join(answer_formats)
-    answer_formats = ANSWER_FORMAT_TEMPLATE.format(answer_formats=answer_formats)
-
-    return questions, answer_formats
+    if not join:
+        return questions, answer_formats
+    return join_questions(questions, answer_formats)
 
 
 def evaluate_by_domain_train(goal, llm_answer):
@@ -286,7 +320,7 @@ def evaluate_by_domain_train(goal, llm_answer):
 
 # region: hotel, restaurant, attraction
 
-def prepare_hotel_questions(goal):
+def prepare_hotel_questions(goal, join=True):
     '''
     Goal:
         'info': {'area', 'internet', 'name', 'parking', 'pricerange', 'stars', 'type'},
@@ -359,16 +393,12 @@ def prepare_hotel_questions(goal):
             answer_formats.append(a)
             q_idx += 1
 
-    questions = '\n'.join(questions)
-
-    answer_formats = [' ' * 4 + s for s in answer_formats]
-    answer_formats = '\n'.join(answer_formats)
-    answer_formats = ANSWER_FORMAT_TEMPLATE.format(answer_formats=answer_formats)
-
-    return questions, answer_formats
+    if not join:
+        return questions, answer_formats
+    return join_questions(questions, answer_formats)
 
 
-def prepare_restaurant_questions(goal):
+def prepare_restaurant_questions(goal, join=True):
     '''
     Goal:
         'info': {'area', 'food', 'name', 'pricerange'},
@@ -431,16 +461,12 @@ def prepare_restaurant_questions(goal):
             answer_formats.append(a)
             q_idx += 1
 
-    questions = '\n'.join(questions)
-
-    answer_formats = [' ' * 4 + s for s in answer_formats]
-    answer_formats = '\n'.join(answer_formats)
-    answer_formats = ANSWER_FORMAT_TEMPLATE.format(answer_formats=answer_formats)
-
-    return questions, answer_formats
+    if not join:
+        return questions, answer_formats
+    return join_questions(questions, answer_formats)
 
 
-def prepare_attraction_questions(goal):
+def prepare_attraction_questions(goal, join=True):
     '''
     Goal:
         'info': {'area', 'name', 'type'},
@@ -487,13 +513,9 @@ def prepare_attraction_questions(goal):
             answer_formats.append(a)
             q_idx += 1
 
-    questions = '\n'.join(questions)
-
-    answer_formats = [' ' * 4 + s for s in answer_formats]
-    answer_formats = '\n'.join(answer_formats)
-    answer_formats = ANSWER_FORMAT_TEMPLATE.format(answer_formats=answer_formats)
-
-    return questions, answer_formats
+    if not join:
+        return questions, answer_formats
+    return join_questions(questions, answer_formats)
 
 
 def evaluate_by_domain_others(goal, llm_answer, domain):  # restaurant, hotel, attraction
@@ -565,11 +587,55 @@ def evaluate_by_domain_others(goal, llm_answer, domain):  # restaurant, hotel, a
 
 # endregion
 
+def judge_completion(human_prompt, model, answer_schema=None):
+    '''Ask the judge and parse its answer.
+
+    With an answer schema, the judge answers by calling the function if the model supports it.
+    Otherwise the json in the content is parsed, with repair if it is malformed. Answers are
+    cached in the judge cache, and a cached answer costs nothing. Returns the answer, the cost
+    and the usage of the call.
+    '''
+    use_function = answer_schema is not None and supports_function_call(model)
+
+    judge_cache = load_judge_cache()
+    key = make_judge_key(model, human_prompt, answer_schema if use_function else None)
+    if (cached := judge_cache.get(key)) is not None:
+        return cached[0], 0.0, make_usage()
+
+    kwargs = {'functions': [answer_schema], 'function_call': {'name': answer_schema['name']}} if use_function else {}
+
+    with tracer.span('judge', 'llm', model=model, n_messages=2, prompt_chars=len(human_prompt)) as span:
+        completion = openai.ChatCompletion.create(
+            model=model,
+            temperature=0,
+            messages=[
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": human_prompt},
+            ],
+            request_timeout=10,
+            **kwargs,
+        )
+        span.set_usage(completion['usage'])
+    usage = completion_usage(model, completion['usage'], wall_time=span.duration)
+    cost = usage['cost']
+    message = completion['choices'][0]['message']
+    if use_function and message.get('function_call'):
+        result_origin = message['function_call']['arguments']
+    else:
+        result_origin = message['content'] or ''
+
+    llm_answer = parse_llm_json(result_origin)
+    judge_cache.put(key, model, llm_answer, cost)
+    return llm_answer, cost, usage
+
+
 @tenacity.retry(wait=tenacity.wait_exponential(min=2, max=60),
                 stop=tenacity.stop_after_attempt(8),
                 before_sleep=tenacity_retry_log,
                 retry=tenacity.retry_if_exception_type((openai.OpenAIError, json.JSONDecodeError)))
-def llm_qa(goal_messages, dialog_pred, questions, answer_formats, model):
+def llm_qa(goal_messages, dialog_pred, questions, answer_formats, model, answer_schema=None):
+    if answer_schema is not None and supports_function_call(model):
+        answer_formats = FUNCTION_ANSWER_FORMAT
     goals_str = prepare_goals_string(goal_messages)
     dialog_str = prepare_dialog_string(dialog_pred)
     human_prompt = HUMAN_TEMPLATE.format(
@@ -578,29 +644,7 @@ def llm_qa(goal_messages, dialog_pred, questions, answer_formats, model):
         questions=questions, 
         answer_formats=answer_formats,
     )
-
-    completion = openai.ChatCompletion.create(
-        model=model,
-        temperature=0,
-        messages=[
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": human_prompt},
-        ],
-        request_timeout=10,
-    )
-    cost = calc_openai_cost(model, completion['usage'])
-    result_origin = completion['choices'][0]['message']['content']
-
-    # Clean json string
-    def clean_json_string(text):
-        text = text.strip('`')
-        if (pos := text.find('```')) > -1:
-            text = text[:pos]
-        return text
-    result_cleann = clean_json_string(result_origin)
-
-    llm_answer = json.loads(result_cleann)
-    return llm_answer, cost
+    return judge_completion(human_prompt, model, answer_schema)
 
 
 def show_eval_result(result):
@@ -628,43 +672,305 @@ def show_eval_result(result):
             pprint(v)
 
 
-def evaluate_by_domain(domain, run_result, model='gpt-3.5-turbo-0301', verbose=True):
-    assert run_result['goals'].get(domain)
-    
-    goal_dict = run_result['goals'][domain]
-    dialog_pred = run_result['dialog_pred']
-    goal_messages = run_result['goal_messages']
+# region: Pre-extraction
 
-    if domain == 'hotel':
-        questions, answer_formats = prepare_hotel_questions(goal_dict)
-        llm_answer, cost = llm_qa(goal_messages, dialog_pred, questions, answer_formats, model)
-        result = evaluate_by_domain_others(goal_dict, llm_answer, domain)
+BOOK_FUNCTION_DOMAINS = {
+    'book_restaurant': 'restaurant',
+    'book_hotel': 'hotel',
+    'buy_train_tickets': 'train',
+    'book_taxi': 'taxi',
+}
 
-    elif domain == 'restaurant':
-        questions, answer_formats = prepare_restaurant_questions(goal_dict)
-        llm_answer, cost = llm_qa(goal_messages, dialog_pred, questions, answer_formats, model)
-        result = evaluate_by_domain_others(goal_dict, llm_answer, domain)
+QUERY_FUNCTION_DOMAINS = {
+    'query_restaurants': 'restaurant',
+    'query_hotels': 'hotel',
+    'query_attractions': 'attraction',
+    'query_trains': 'train',
+}
+
+REFER_NUMBER_PATTERN = re.compile(r'^Booking succeed\. The reference number is (\w+)\.$')
 
-    elif domain == 'attraction':
-        questions, answer_formats = prepare_attraction_questions(goal_dict)
-        llm_answer, cost = llm_qa(goal_messages, dialog_pred, questions, answer_formats, model)
-        result = evaluate_by_domain_others(goal_dict, llm_answer, domain)
+
+def extract_call_trace(callings):
+    '''Index the succeeded bookings and the query results of the function calls by domain.'''
+    trace = {domain: {'bookings': [], 'query_results': []} for domain in DOMAINS}
+    for call in callings:
+        if domain := BOOK_FUNCTION_DOMAINS.get(call['name']):
+            if call['result'].startswith('Booking succeed.'):
+                trace[domain]['bookings'].append(call)
+        elif domain := QUERY_FUNCTION_DOMAINS.get(call['name']):
+            trace[domain]['query_results'].append(call['result'])
+    return trace
+
+
+def parse_result_column(result, column):
+    '''Values of the column in the table string returned by a query function.'''
+    lines = [line for line in result.split('\n') if line.startswith('| ')]
+    if len(lines) < 2:
+        return []
+    header = [x.strip() for x in lines[0].strip('|').split('|')]
+    if column not in header:
+        return []
+    idx = header.index(column)
+    values = []
+    for line in lines[2:]:
+        cells = [x.strip() for x in line.strip('|').split('|')]
+        if len(cells) == len(header):
+            values.append(cells[idx])
+    return values
+
+
+def agent_text(dialog_pred):
+    return '\n'.join(turn['agent'] or '' for turn in dialog_pred).lower()
+
+
+def find_mentions(value, text):
+    '''Spans of the mentions of the value as whole words in the text.'''
+    return [m.span() for m in re.finditer(r'(?<!\w)' + re.escape(value.lower()) + r'(?!\w)', text)]
+
+
+def pick_mentioned(candidates, dialog_pred):
+    '''The candidate mentioned last by the AI Assistant, as whole words, otherwise None.
+
+    A mention inside the mention of a longer candidate, e.g. a name contained in another name, does not count.
+    '''
+    text = agent_text(dialog_pred)
+    mentions = [(span, c) for c in set(candidates) if c not in ['', 'None'] for span in find_mentions(c, text)]
+    mentions = [(span, c) for span, c in mentions
+                if not any(s[0] <= span[0] and span[1] <= s[1] and s != span for s, _ in mentions)]
+    return max(mentions)[1] if mentions else None
+
+
+def pick_told_refer_number(booking, dialog_pred):
+    '''The reference number of the booking if the AI Assistant told it to the user, otherwise None.'''
+    refer_number = REFER_NUMBER_PATTERN.match(booking['result'])[1]
+    return refer_number if find_mentions(refer_number, agent_text(dialog_pred)) else None
+
+
+def pre_extract_answers(domain, goal, trace, dialog_pred):
+    '''Answer the questions of the domain that can be answered from the function calls.
+
+    Only unambiguous answers are extracted: the venue of a single succeeded booking and its
+    reference number if the AI Assistant told it, or the queried venue name / train id mentioned
+    last by the AI Assistant. The taxi questions are left to the judge, since the booking arguments
+    may differ from what was said. The keys are the same as in the answer of the LLM judge.
+    '''
+    answers = {}
+    bookings = trace[domain]['bookings']
+    booking = bookings[0] if len(bookings) == 1 else None
+
+    if domain in ['restaurant', 'hotel', 'attraction']:
+        if booking:
+            answers[domain] = booking['args']['name']
+            if refer_number := pick_told_refer_number(booking, dialog_pred):
+                answers['reference number'] = refer_number
+        else:
+            names = [name for result in trace[domain]['query_results'] for name in parse_result_column(result, 'name')]
+            if name := pick_mentioned(names, dialog_pred):
+                answers[domain] = name
 
     elif domain == 'train':
-        questions, answer_formats = prepare_train_questions(goal_dict)
-        llm_answer, cost = llm_qa(goal_messages, dialog_pred, questions, answer_formats, model)
-        result = evaluate_by_domain_train(goal_dict, llm_answer)
+        if booking:
+            if refer_number := pick_told_refer_number(booking, dialog_pred):
+                answers['reference number'] = refer_number
+        elif 'trainID' in goal.get('reqt', []):
+            ids = [id_ for result in trace[domain]['query_results'] for id_ in parse_result_column(result, 'trainID')]
+            if train_id := pick_mentioned(ids, dialog_pred):
+                answers[TRAIN_SLOT_MAP['trainID']] = train_id
+
+    return answers
 
+
+def renumber_questions(questions, answer_formats, start=1):
+    questions = [re.sub(r'^\d+(?=\.)', str(idx), q) for idx, q in enumerate(questions, start=start)]
+    answer_formats = [re.sub(r'(?<=question )\d+', str(idx), a) for idx, a in enumerate(answer_formats, start=start)]
+    return questions, answer_formats
+
+
+def drop_answered_questions(questions, answer_formats, answers):
+    '''Drop the questions with answers and renumber the left ones.
+
+    Returns the left questions and answer formats, and the answers of the dropped questions.
+    '''
+    left_questions, left_answer_formats, used_answers = [], [], {}
+    for q, a in zip(questions, answer_formats):
+        key = get_answer_key(a)
+        if key in answers:
+            used_answers[key] = answers[key]
+        else:
+            left_questions.append(q)
+            left_answer_formats.append(a)
+    left_questions, left_answer_formats = renumber_questions(left_questions, left_answer_formats)
+    return left_questions, left_answer_formats, used_answers
+
+# endregion: Pre-extraction
+
+
+def prepare_questions(domain, goal, join=True):
+    if domain == 'hotel':
+        return prepare_hotel_questions(goal, join)
+    elif domain == 'restaurant':
+        return prepare_restaurant_questions(goal, join)
+    elif domain == 'attraction':
+        return prepare_attraction_questions(goal, join)
+    elif domain == 'train':
+        return prepare_train_questions(goal, join)
     elif domain == 'taxi':
-        questions, answer_formats = prepare_taxi_questions(goal_dict)
-        llm_answer, cost = llm_qa(goal_messages, dialog_pred, questions, answer_formats, model)
-        result = evaluate_by_domain_taxi(goal_dict, llm_answer)
+        return prepare_taxi_questions(goal, join)
+    else:
+        raise ValueError(f'{domain = }')
+
+
+def prepare_left_questions(domain, goal, trace, dialog_pred):
+    '''Questions of the domain left for the LLM judge, and the answers extracted in advance.'''
+    pre_answers = pre_extract_answers(domain, goal, trace, dialog_pred)
+    questions, answer_formats = prepare_questions(domain, goal, join=False)
+    return drop_answered_questions(questions, answer_formats, pre_answers)
+
 
+def check_by_domain(domain, goal, llm_answer):
+    if domain in ['hotel', 'restaurant', 'attraction']:
+        return evaluate_by_domain_others(goal, llm_answer, domain)
+    elif domain == 'train':
+        return evaluate_by_domain_train(goal, llm_answer)
+    elif domain == 'taxi':
+        return evaluate_by_domain_taxi(goal, llm_answer)
     else:
         raise ValueError(f'{domain = }')
+
+
+def evaluate_by_domain(domain, run_result, model=JUDGE_MODEL, verbose=True, trace=None):
+    assert run_result['goals'].get(domain)
+    
+    goal_dict = run_result['goals'][domain]
+    dialog_pred = run_result['dialog_pred']
+    goal_messages = run_result['goal_messages']
+    if trace is None:
+        trace = extract_call_trace(run_result.get('callings', []))
+
+    questions, answer_formats, pre_answers = prepare_left_questions(domain, goal_dict, trace, dialog_pred)
+    if questions:
+        answer_schema = make_answer_schema(make_answer_properties(questions, answer_formats))
+        questions, answer_formats = join_questions(questions, answer_formats)
+        llm_answer, cost, usage = llm_qa(goal_messages, dialog_pred, questions, answer_formats, model, answer_schema)
+    else:
+        llm_answer, cost, usage = {}, 0.0, make_usage()
+    result = check_by_domain(domain, goal_dict, {**llm_answer, **pre_answers})
+    result['pre_answers'] = pre_answers
     
     if verbose:
         show_eval_result(result)
 
     result['cost'] = cost
+    result['usage'] = usage
     return result
+
+
+def evaluate_by_domains_parallel(domains, run_result, model=JUDGE_MODEL, verbose=True):
+    '''Evaluate the domains with one judge call per domain, issued concurrently.
+
+    Returns domain -> result, or the exception if the evaluation of the domain failed.
+    '''
+    if not domains:
+        return {}
+
+    trace = extract_call_trace(run_result.get('callings', []))
+    with ThreadPoolExecutor(max_workers=len(domains)) as executor:
+        futures = {domain: executor.submit(in_current_context(evaluate_by_domain), domain, run_result, model, False, trace)
+                   for domain in domains}
+
+    results = {}
+    for domain, future in futures.items():
+        try:
+            result = future.result()
+        except Exception as e:
+            result = e
+        else:
+            if verbose:
+                show_eval_result(result)
+        results[domain] = result
+    return results
+
+
+# region: Merged Evaluation
+
+def prepare_merged_questions(domain_questions):
+    '''Merge the questions of the domains (domain -> (questions, answer_formats)) into one prompt.
+
+    Questions are numbered continuously across the domains and the answer is nested by domain:
+    `{"hotel": {"hotel": ..., "reference number": ...}, "train": {...}}`. Returns the questions,
+    the answer formats and the answer function schema.
+    '''
+    questions = []
+    answer_formats = []
+    properties = {}
+    q_idx = 1
+    for domain, (domain_questions, domain_answer_formats) in domain_questions.items():
+        domain_questions, domain_answer_formats = renumber_questions(domain_questions, domain_answer_formats, q_idx)
+        domain_properties = make_answer_properties(domain_questions, domain_answer_formats)
+        properties[domain] = {'type': 'object', 'properties': domain_properties, 'required': list(domain_properties)}
+
+        if questions:
+            questions.append('')
+        questions.append(f'{domain.capitalize()}:')
+        questions += domain_questions
+
+        answer_formats.append(f'"{domain}": {{')
+        answer_formats += [' ' * 4 + a for a in domain_answer_formats]
+        answer_formats.append('}')
+
+        q_idx += len(domain_questions)
+
+    questions, answer_formats = join_questions(questions, answer_formats)
+    return questions, answer_formats, make_answer_schema(properties)
+
+
+def evaluate_by_domains(domains, run_result, model=JUDGE_MODEL, verbose=True):
+    '''Evaluate the domains with one judge call over the merged questions.
+
+    The cost and usage of the call are split equally over the domains asked. A domain missing from the
+    answer is evaluated by its own call. Returns domain -> result, or the exception if the
+    check of the domain failed.
+    '''
+    trace = extract_call_trace(run_result.get('callings', []))
+    if len(domains) == 1:
+        return {domains[0]: evaluate_by_domain(domains[0], run_result, model, verbose, trace)}
+
+    goals = run_result['goals']
+    dialog_pred = run_result['dialog_pred']
+    assert all(goals.get(domain) for domain in domains)
+
+    domain_questions, pre_answers = {}, {}
+    for domain in domains:
+        questions, answer_formats, pre_answers[domain] = prepare_left_questions(domain, goals[domain], trace, dialog_pred)
+        if questions:
+            domain_questions[domain] = (questions, answer_formats)
+
+    if domain_questions:
+        questions, answer_formats, answer_schema = prepare_merged_questions(domain_questions)
+        llm_answer, cost, usage = llm_qa(run_result['goal_messages'], dialog_pred, questions, answer_formats, model, answer_schema)
+    else:
+        llm_answer, cost, usage = {}, 0.0, make_usage()
+
+    results = {}
+    for domain in domains:
+        try:
+            if domain not in domain_questions or isinstance(llm_answer.get(domain), dict):
+                domain_answer = llm_answer.get(domain) if domain in domain_questions else {}
+                result = check_by_domain(domain, goals[domain], {**domain_answer, **pre_answers[domain]})
+                result['pre_answers'] = pre_answers[domain]
+                share = 1 / len(domain_questions) if domain in domain_questions else 0.0
+                result['cost'] = cost * share
+                result['usage'] = add_usage(make_usage(), usage, share)
+                if verbose:
+                    show_eval_result(result)
+            else:
+                result = evaluate_by_domain(domain, run_result, model, verbose, trace)
+                result['cost'] += cost / len(domain_questions)
+                add_usage(result['usage'], usage, 1 / len(domain_questions))
+        except Exception as e:
+            result = e
+        results[domain] = result
+    return results
+
+# endregion: Merged Evaluation
@@ -0,0 +1,95 @@
+import atexit
+import queue
+import threading
+
+from termcolor import colored
+
+
+IDLE_TIMEOUT = 1.0
+
+
+class EventDispatcher:
+    '''Runs the submitted calls in order on one background thread, so that slow handlers do not block the caller.
+
+    The thread is started by the first call and exits after `IDLE_TIMEOUT` seconds without calls, so a
+    dispatcher per run does not leave a thread behind.
+    '''
+
+    def __init__(self, name='event-dispatcher'):
+        self.name = name
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, func, *args):
+        with self.lock:
+            self.queue.put((func, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                func, args = self.queue.get(timeout=IDLE_TIMEOUT)
+            except queue.Empty:
+                with self.lock:
+                    if self.queue.empty():
+                        self.thread = None
+                        return
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                msg = f'Event handler {func.__qualname__} failed as {e.__class__.__name__}: '
+                print(colored(msg, 'red') + str(e))
+
+    def flush(self):
+        '''Wait until the calls submitted so far are done.'''
+        with self.lock:
+            if self.thread is None:  # the queue is empty
+                return
+        done = threading.Event()
+        self.submit(done.set)
+        done.wait()
+
+
+dispatcher = EventDispatcher()
+atexit.register(dispatcher.flush)
+
+
+class CallbackBus:
+    '''The callbacks of a run behind one callback.
+
+    The observational hooks (`on_llm_end`, `on_function_call_end`) are dispatched to the background
+    thread of the bus, so the callbacks never add to the dialog latency. `on_turn_end` transforms the
+    utterance, so it runs inline. Flush the bus before reading the state of its callbacks, e.g. the cost.
+    Each bus has its own dispatcher, so flushing it does not wait for the events of other dialogs.
+    '''
+
+    def __init__(self, callbacks=()):
+        self.callbacks = list(callbacks)
+        self.dispatcher = EventDispatcher(name='callback-bus')
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def publish(self, hook, *args):
+        for callback in self.callbacks:
+            if handler := getattr(callback, hook, None):
+                self.dispatcher.submit(handler, *args)
+
+    def on_llm_end(self, completion, **kwargs):
+        self.publish('on_llm_end', completion)
+
+    def on_function_call_end(self, function_name, args, result, **kwargs):
+        self.publish('on_function_call_end', function_name, args, result)
+
+    def on_turn_end(self, utter, turn_idx, **kwargs):
+        for callback in self.callbacks:
+            if hasattr(callback, 'on_turn_end'):
+                utter = callback.on_turn_end(utter, turn_idx)
+        return utter
+
+    def flush(self):
+        self.dispatcher.flush()
@@ -1,7 +1,8 @@
+import copy
 import json
 import re
 import sqlite3
-from functools import partial
+from functools import lru_cache, partial
 
 import openai
 from langchain import SQLDatabase
@@ -9,13 +10,9 @@ from langchain.schema import LLMResult
 import tenacity
 
 from booking import make_booking_db, make_booking_taxi
+from tracing import tracer
 from utils import DB_PATH, tenacity_retry_log
 
-GREEN_COLOR = '\u001b[1;32m'
-MAG_COLOR = '\u001b[1;35m'
-CYAN_COLOR = '\u001b[1;36m'
-RESET_COLOR = '\u001b[0m'
-
 
 system_prompt = '''You are an intelligent AI Assistant to help the user complete complex tasks. The task may contain several sub-tasks, and you first determines which sub-tasks are involved in the user's utterance, and then completes the user's request according to the instructions of the corresponding sub-tasks.
 
@@ -103,8 +100,20 @@ The AI Assistant can only make a reservation if the restaurant name and people,
 '''
 
 
+@lru_cache(maxsize=None)
+def get_table_info(domain, db_path=DB_PATH):
+    db = SQLDatabase.from_uri(
+        database_uri=f'sqlite:///{db_path}',
+        include_tables=[domain],
+        sample_rows_in_table_info=2,
+    )
+    table_info = db.get_table_info()
+    return table_info
 
-def prepare_query_db_functions(domain, db_path=DB_PATH):
+
+# The builders are cached and their results are shared, so the factories below hand out copies of them.
+@lru_cache(maxsize=None)
+def build_query_db_functions(domain, db_path=DB_PATH):
 
     def query_db(sql, table=None, db_path=DB_PATH):
         # if 'SELECT *' in sql:
@@ -146,16 +155,6 @@ def prepare_query_db_functions(domain, db_path=DB_PATH):
         result = '\n'.join(result)
         return result
 
-
-    def get_table_info(domain, db_path):
-        db = SQLDatabase.from_uri(
-            database_uri=f'sqlite:///{DB_PATH}',
-            include_tables=[domain],
-            sample_rows_in_table_info=2,
-        )
-        table_info = db.get_table_info()
-        return table_info
-    
     def make_schema(domain, name, table_info):
         func_desc_temp = '''Use an SQL statement to query the {domain} table to get required information.
 
@@ -182,14 +181,15 @@ def prepare_query_db_functions(domain, db_path=DB_PATH):
 
     assert domain in ['restaurant', 'hotel', 'attraction', 'train']
     name = f'query_{domain}s'  # query_restaurants, query_hotels, query_attractions, query_trains
-    function = partial(query_db, table=domain)
+    function = partial(query_db, table=domain, db_path=db_path)
     table_info = get_table_info(domain, db_path)
     schema = make_schema(domain, name, table_info)
 
     return {'name': name, 'function': function, 'schema': schema}
 
 
-def prepare_book_functions(domain):
+@lru_cache(maxsize=None)
+def build_book_functions(domain):
     if domain == 'restaurant':
 
         def book_restaurant(name, people, day, time):
@@ -336,6 +336,14 @@ def prepare_book_functions(domain):
         raise ValueError(f'{domain = }')
 
 
+def prepare_query_db_functions(domain, db_path=DB_PATH):
+    return copy.deepcopy(build_query_db_functions(domain, db_path))
+
+
+def prepare_book_functions(domain):
+    return copy.deepcopy(build_book_functions(domain))
+
+
 class FuncAgent:
 
     def __init__(self, model='gpt-3.5-turbo-0613'):
@@ -366,18 +374,21 @@ class FuncAgent:
                     before_sleep=tenacity_retry_log,
                     retry=tenacity.retry_if_exception_type(openai.OpenAIError))
     def chat(self, messages, callbacks: list[LLMResult] =[]):
-        completion = openai.ChatCompletion.create(
-            model=self.model,
-            temperature=0,
-            messages=messages,
-            functions=self.schemas,
-            request_timeout=10,
-        )
+        with tracer.span('chat', 'llm', model=self.model, n_messages=len(messages),
+                         prompt_chars=sum(len(m['content'] or '') for m in messages)) as span:
+            completion = openai.ChatCompletion.create(
+                model=self.model,
+                temperature=0,
+                messages=messages,
+                functions=self.schemas,
+                request_timeout=10,
+            )
+            span.set_usage(completion['usage'])
 
         llm_output = {'model_name': completion['model'], 'token_usage': completion['usage']}
         reponse = LLMResult(generations=[], llm_output=llm_output)
         for callback in callbacks:
-            if hasattr(callable, 'on_llm_end'):
+            if hasattr(callback, 'on_llm_end'):
                 callback.on_llm_end(reponse)
 
         return completion['choices'][0]['message']
@@ -401,19 +412,20 @@ class FuncAgent:
             # Function calling
             succeed, check_msg, name, args = self.parse_function_call(msg.get('function_call'))
             if succeed:
-                print()
-                print('Function: ' + MAG_COLOR + f'{name}' + RESET_COLOR)
-                print('Arguments: ' + GREEN_COLOR + f'{args}' + RESET_COLOR)
                 func = self.func_map[name]
-                result = func(**args)
+                with tracer.span(name, 'function') as span:
+                    span.show(args=args)
+                    result = func(**args)
+                    span.set(result_chars=len(str(result)))
+                    span.show(result=result)
+                for handler in callbacks:
+                    if hasattr(handler, 'on_function_call_end'):
+                        handler.on_function_call_end(name, args, result)
             else:
-                print()
-                print('Function parsing error:')
-                print(f'function_call: {msg.get("function_call")}')
-                print(check_msg)
                 result = check_msg
+                with tracer.span(str(name), 'function', parse_error=check_msg) as span:
+                    span.show(function_call=msg.get('function_call'), result=result)
 
-            print('Result: ' + CYAN_COLOR + f'{result}' + RESET_COLOR)
             self.messages.append({'role': 'function', 'name': name, 'content': result})
 
     def parse_function_call(self, function_call):
@@ -0,0 +1,64 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+
+JUDGE_CACHE_PATH = 'data/judge_cache.db'
+
+
+def make_judge_key(model, human_prompt, answer_schema=None):
+    '''Hash of the judge model, the prompt (goals, dialog, questions) and the answer schema.
+
+    Whitespace of the prompt is normalized, so a dialog re-rendered with other spacing still hits.
+    '''
+    prompt = re.sub(r'\s+', ' ', human_prompt).strip()
+    key = json.dumps([model, prompt, answer_schema], sort_keys=True)
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+class JudgeCache:
+    '''Judge answers in sqlite, keyed on `make_judge_key`.
+
+    With `replay_only`, a miss raises instead of calling the judge, which is used to re-score
+    logs with the current evaluator for free.
+    '''
+
+    def __init__(self, cache_path=JUDGE_CACHE_PATH, replay_only=False):
+        self.cache_path = cache_path
+        self.replay_only = replay_only
+        os.makedirs(os.path.dirname(cache_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS answers '
+                              '(key TEXT PRIMARY KEY, model TEXT, answer TEXT, cost REAL)')
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute('SELECT answer, cost FROM answers WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            if self.replay_only:
+                raise RuntimeError(f'Judge answer is not cached in "{self.cache_path}": {key = }')
+            return None
+        return json.loads(row[0]), row[1]
+
+    def put(self, key, model, answer, cost):
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?)',
+                              (key, model, json.dumps(answer), cost))
+
+
+judge_cache = None
+
+
+def load_judge_cache(cache_path=None, replay_only=None):
+    '''The judge cache in use. With a cache path, switch to the cache at the path.'''
+    global judge_cache
+
+    if judge_cache is None or (cache_path and judge_cache.cache_path != cache_path):
+        judge_cache = JudgeCache(cache_path or JUDGE_CACHE_PATH)
+    if replay_only is not None:
+        judge_cache.replay_only = replay_only
+    return judge_cache
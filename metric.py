@@ -1,23 +1,29 @@
-import json
 from collections import defaultdict
+import json
+import os
+import sys
 
 import click
 
-from utils import DOMAINS
+from bootstrap import N_RESAMPLES
+from run_log import open_run_log
+from utils import DOMAINS, BaseMetricTracker
 
 
-class MetricTracker:
+class MetricTracker(BaseMetricTracker):
     '''Dialog Metric Tracker
     - Fields: restaurant, hotel, attraction, train, taxi, domain, dialog
     - Metrics: inform, success, book, combine
     '''
 
     METICS = ['inform', 'success', 'book']
+    COUNTER_FIELDS = ['domain_scores', 'fuse_domain_scores', 'dialog_scores', 'combine_scores']
+    SAMPLE_KEYS = [('domain', 'inform'), ('domain', 'success'), ('domain', 'book'), ('domain', 'combine'),
+                   ('dialog', 'inform'), ('dialog', 'success'), ('dialog', 'book'), ('dialog', 'combine')]
 
-    def __init__(self):
+    def __init__(self, keep_raw=True, raw_file=None):
+        super().__init__(keep_raw, raw_file)
         self.raw = defaultdict(dict)
-        self.cost = defaultdict(float)
-        self.cost_total = 0.0
 
         self.domain_scores = {}  # domain -> metric -> score (restaurant -> inform -> score)
         for domain in DOMAINS:
@@ -32,10 +38,11 @@ class MetricTracker:
 
     def add_domain_eval_result(self, dialog_id, domain, eval_result):
         assert domain in DOMAINS
-        assert domain not in self.raw[dialog_id]
         if status := eval_result.get('status'):
             assert status == 'succeed'
-        self.raw[dialog_id][domain] = eval_result
+        if self.keep_raw:
+            assert domain not in self.raw[dialog_id]
+            self.raw[dialog_id][domain] = eval_result
 
         # Inform, Success, Book Score
         for k in self.METICS:
@@ -61,7 +68,9 @@ class MetricTracker:
         self.combine_scores['domain']['total'] += 1
 
     def add_dialog_eval_results(self, dialog_id, eval_results):
-        assert dialog_id not in self.raw
+        if self.keep_raw:
+            assert dialog_id not in self.raw
+        self.add_dialog(dialog_id, eval_results)
     
         # Each Domain & Domain Level
         for domain, eval_result in eval_results.items():
@@ -84,6 +93,22 @@ class MetricTracker:
         self.combine_scores['dialog']['accum'] += combine_score
         self.combine_scores['dialog']['total'] += 1
 
+        if self.keep_raw:
+            self.samples[dialog_id] = self.make_sample(eval_results, scores, combine_score)
+
+    def make_sample(self, eval_results, scores, combine_score):
+        '''[hit, total] of each score in SAMPLE_KEYS of one dialog.'''
+        sample = {}
+        for m in self.METICS:
+            complete_list = [result[m]['complete'] for result in eval_results.values() if result[m]['complete'] is not None]
+            sample[f'domain-{m}'] = [sum(complete_list), len(complete_list)]
+            sample[f'dialog-{m}'] = [scores[m], 1] if scores[m] is not None else [0, 0]
+        domain_combines = [self.calc_combine_score(result['inform']['complete'], result['success']['complete'],
+                                                   result['book']['complete']) for result in eval_results.values()]
+        sample['domain-combine'] = [sum(domain_combines), len(domain_combines)]
+        sample['dialog-combine'] = [combine_score, 1]
+        return sample
+
     @staticmethod
     def calc_combine_score(inform, success, book):
         '''Formula
@@ -103,19 +128,6 @@ class MetricTracker:
 
         return score
 
-    def add_cost(self, dialog_id, cost):
-        self.cost[dialog_id] += cost
-        self.cost_total += cost
-
-    def get_cost(self):
-        n_dialog = len(self.raw)
-        avg = self.cost_total / n_dialog if n_dialog > 0 else 0.0
-        return {
-            'total': self.cost_total,
-            'n_dialog': n_dialog,
-            'average': avg,
-        }
-
     def generate_postfix_str(self, fields=['cost', 'inform', 'success', 'book'], prefixes=[]):
         postfix_str = [s for s in prefixes]
 
@@ -218,23 +230,8 @@ class MetricTracker:
         table = '\n'.join(table)
         return table
     
-    def generate_cost_table(self):
-        # #dialogs Total($) Average($)
-        #    n        x        y
-        d = self.get_cost()
-        total, n_dialog, average = d['total'], d['n_dialog'], d['average']
-
-        head = ['#dialogs', 'Total ($)', 'Average ($)']
-        body = [str(n_dialog), f'{total:.4f}', f'{average:.4f}']
-
-        table = []
-        table.append('| ' + ' | '.join(head) + ' |')
-        table.append('| ' + ' | '.join([':---:'] * len(head)) + ' |')
-        table.append('| ' + ' | '.join(body) + ' |')
-        table = '\n'.join(table)
-        return table
-
-    def generate_summary_tables(self):
+    def generate_summary_tables(self, n_resamples=0):
+        '''With `n_resamples`, the bootstrap confidence intervals of the scores are added.'''
         summary = []
         summary.append('## Comprehensive Metrics')
         summary.append(self.generate_fuse_table())
@@ -242,28 +239,65 @@ class MetricTracker:
         summary.append('## Domain Metrics')
         summary.append(self.generate_detail_table())
         summary.append('')
-        summary.append('## Cost')
-        summary.append(self.generate_cost_table())
+        summary += self.generate_common_tables(n_resamples)
         summary = '\n'.join(summary)
         return summary
 
 
+def summarize_result(result):
+    '''The part of a result kept in the run log index: enough to score without reading the log.'''
+    summary = {'status': result.get('status'), 'cost': result.get('cost', 0.0), 'eval_results': None,
+               'n_turns': None, 'latency': result.get('latency'), 'usage': result.get('usage')}
+    if isinstance(run_result := result.get('run_result'), dict) and 'dialog_pred' in run_result:
+        summary['n_turns'] = len(run_result['dialog_pred'])
+    if result.get('status') == 'succeed':
+        summary['eval_results'] = {domain: {m: {'complete': eval_result[m]['complete']} for m in MetricTracker.METICS}
+                                   for domain, eval_result in result['eval_results'].items()}
+    return summary
+
+
+track_run_log = MetricTracker.track_run_log
+track_stream = MetricTracker.track_stream
+
+
 @click.command()
-@click.option('--log_file')
+@click.option('--log_file', help='"-" to read the log from stdin, which implies --stream.')
 @click.option('--score_table_file')
-def metric(log_file, score_table_file):
-    with open(log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
-
-    metric_tracker = MetricTracker()
-    for item in data[1:]:
-        if item['status'] != 'succeed':
-            print(f'Skip dialog: {item["dialog_id"]}, status: {item["status"]}')
-            continue
-        metric_tracker.add_dialog_eval_results(item['dialog_id'], item['eval_results'])
-        metric_tracker.add_cost(item['dialog_id'], item['cost'])
-
-    summary = metric_tracker.generate_summary_tables()
+@click.option('--stream', is_flag=True, help='Read the log line by line without the index and keep only the counters. '
+              'Every record is counted, so compact a log with superseded records first.')
+@click.option('--raw_file', default=None, help='Spill the eval results to the JSONL file in stream mode.')
+@click.option('--state_files', default=None, help='Comma separated tracker states to merge, instead of a log.')
+@click.option('--save_state', default=None, help='Save the tracker state to the JSON file, to be merged later.')
+@click.option('--bootstrap', type=int, default=0, help='Number of bootstrap resamples for the confidence intervals.')
+@click.option('--compare_log_file', default=None, help='Compare with the run of this log by paired bootstrap.')
+def metric(log_file, score_table_file, stream, raw_file, state_files, save_state, bootstrap, compare_log_file):
+    if raw_file and os.path.exists(raw_file):
+        raise RuntimeError(f'{raw_file = } exists.')
+    if (bootstrap or compare_log_file) and (stream or log_file == '-'):
+        raise RuntimeError('Bootstrap needs the per-dialog scores, which stream mode does not keep.')
+
+    if state_files:
+        metric_tracker = MetricTracker(keep_raw=False)
+        for state_file in state_files.split(','):
+            with open(state_file) as f:
+                metric_tracker.add_state(json.load(f))
+    elif log_file == '-':
+        metric_tracker, _ = track_stream(sys.stdin.buffer, raw_file, verbose=True)
+    elif stream:
+        with open(log_file, 'rb') as f:
+            metric_tracker, _ = track_stream(f, raw_file, verbose=True)
+    else:
+        metric_tracker, _ = track_run_log(open_run_log(log_file, summarize_result), verbose=True)
+
+    if save_state:
+        with open(save_state, 'w') as f:
+            json.dump(metric_tracker.to_state(), f)
+
+    summary = metric_tracker.generate_summary_tables(bootstrap)
+    if compare_log_file:
+        other_tracker, _ = track_run_log(open_run_log(compare_log_file, summarize_result))
+        summary += f'\n\n## Paired Bootstrap (A: {log_file or state_files}, B: {compare_log_file})\n'
+        summary += metric_tracker.generate_paired_table(other_tracker, bootstrap or N_RESAMPLES)
     with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
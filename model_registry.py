@@ -0,0 +1,70 @@
+import json
+import os
+
+from termcolor import cprint
+
+MODEL_REGISTRY_PATH = os.environ.get('MODEL_REGISTRY_PATH',
+                                     os.path.join(os.path.dirname(os.path.abspath(__file__)), 'model_registry.json'))
+MODEL_FIELDS = ['api', 'input_price', 'output_price', 'context_length', 'tokenizer', 'function_call', 'streaming']
+
+
+model_registry = None
+warned_models = set()
+
+
+def load_model_registry(path=None):
+    '''The model registry in use: {'default': spec, 'models': name -> spec}. With a path, switch to the registry at the path.'''
+    global model_registry
+
+    if model_registry is None or path:
+        with open(path or MODEL_REGISTRY_PATH) as f:
+            model_registry = json.load(f)
+    return model_registry
+
+
+def register_model(name, **spec):
+    '''Add or update a model for this process, e.g. a local OpenAI compatible server. Unset fields use the default.'''
+    registry = load_model_registry()
+    if unknown := set(spec) - set(MODEL_FIELDS):
+        raise ValueError(f'Unknown model fields {unknown = }')
+    registry['models'][name] = {**registry['default'], **registry['models'].get(name, {}), **spec}
+
+
+def get_model(model):
+    '''Spec of the model: the entry of the longest prefix of the name, or the default entry.'''
+    registry = load_model_registry()
+    names = [name for name in registry['models'] if model.startswith(name)]
+    if names:
+        return {**registry['default'], **registry['models'][max(names, key=len)]}
+
+    if model not in warned_models:
+        warned_models.add(model)
+        cprint(f'Model {model} is not in the model registry. Use the default spec (free, no function call).', 'red')
+    return dict(registry['default'])
+
+
+def calc_cost(model, usage):
+    '''Cost ($) of the token usage of a response of the model.'''
+    spec = get_model(model)
+    prompt_tokens = usage.get('prompt_tokens', 0)
+    completion_tokens = usage.get('completion_tokens', usage.get('total_tokens', 0) - prompt_tokens)
+    return (prompt_tokens * spec['input_price'] + completion_tokens * spec['output_price']) / 1000
+
+
+def supports_function_call(model):
+    return get_model(model)['function_call']
+
+
+def is_completion_model(model):
+    '''Whether the model is served by the completion API instead of the chat API.'''
+    return get_model(model)['api'] == 'completion'
+
+
+if __name__ == '__main__':
+    registry = load_model_registry()
+    head = ['model'] + MODEL_FIELDS
+    print('| ' + ' | '.join(head) + ' |')
+    print('| ' + ' | '.join([':---:'] * len(head)) + ' |')
+    for name in registry['models']:
+        spec = get_model(name)
+        print('| ' + ' | '.join([name] + [str(spec[field]) for field in MODEL_FIELDS]) + ' |')
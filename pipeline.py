@@ -0,0 +1,57 @@
+import queue
+import threading
+
+STOP = object()
+
+
+def run_pipeline(items, stages, sink, queue_size=4):
+    '''Pass each item through the stages, then call the sink in the main thread in the order of items.
+
+    `stages` is a list of (func, n_workers). The first stage takes the item and each later stage
+    takes the output of the stage before it. Each stage has its own worker threads, and the stages
+    are connected by bounded queues, so a slow stage blocks the stages before it (back-pressure).
+    An exception raised by a stage is passed on as the output, the later stages skip it, and the
+    sink gets it as `sink(item, output)`.
+    '''
+    items = list(items)
+    queues = [queue.Queue(maxsize=queue_size) for _ in range(len(stages) + 1)]
+    # Bound the items between the feeder and the sink, as the sink waits for them in order
+    in_flight = threading.BoundedSemaphore(queue_size * (len(stages) + 1) + sum(n for _, n in stages))
+
+    def feed():
+        for idx, item in enumerate(items):
+            in_flight.acquire()
+            queues[0].put((idx, item))
+
+    def work(func, in_queue, out_queue):
+        while (task := in_queue.get()) is not STOP:
+            idx, value = task
+            if not isinstance(value, Exception):
+                try:
+                    value = func(value)
+                except Exception as e:
+                    value = e
+            out_queue.put((idx, value))
+
+    threads = [threading.Thread(target=feed, daemon=True)]
+    for (func, n_workers), in_queue, out_queue in zip(stages, queues, queues[1:]):
+        threads += [threading.Thread(target=work, args=(func, in_queue, out_queue), daemon=True)
+                    for _ in range(n_workers)]
+    for thread in threads:
+        thread.start()
+
+    pending = {}
+    next_idx = 0
+    while next_idx < len(items):
+        idx, output = queues[-1].get()
+        pending[idx] = output
+        while next_idx in pending:
+            sink(items[next_idx], pending.pop(next_idx))
+            in_flight.release()
+            next_idx += 1
+
+    for (_, n_workers), in_queue in zip(stages, queues):
+        for _ in range(n_workers):
+            in_queue.put(STOP)
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,238 @@
+from datetime import datetime
+import os
+import sqlite3
+
+import click
+
+from metric import summarize_result as summarize_mwoz_result
+from run_log import open_run_log, read_header
+from sgd.metric import summarize_result as summarize_sgd_result
+
+RESULTS_DB_PATH = 'data/results.db'
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    name TEXT UNIQUE,
+    benchmark TEXT,
+    log_file TEXT,
+    agent_model TEXT,
+    user_model TEXT,
+    eval_mode TEXT,
+    ingested_at TEXT
+);
+CREATE TABLE IF NOT EXISTS dialogs (
+    run_id INTEGER,
+    dialog_id TEXT,
+    status TEXT,
+    cost REAL,
+    n_turns INTEGER,
+    latency REAL,
+    PRIMARY KEY (run_id, dialog_id)
+);
+CREATE TABLE IF NOT EXISTS scores (
+    run_id INTEGER,
+    dialog_id TEXT,
+    domain TEXT,
+    intent TEXT,
+    metric TEXT,
+    value INTEGER
+);
+CREATE INDEX IF NOT EXISTS scores_run_metric ON scores (run_id, metric, domain);
+'''
+
+# level -> the keys a score is aggregated over within a dialog. Lower level scores are combined with MIN,
+# i.e. a domain (SGD service) succeeds if all its intents succeed and a dialog if all its domains succeed.
+LEVEL_KEYS = {'row': ['domain', 'intent'], 'domain': ['domain'], 'dialog': []}
+GROUP_COLUMNS = {'run': 'runs.name', 'benchmark': 'runs.benchmark', 'agent_model': 'runs.agent_model',
+                 'domain': 's.domain', 'intent': 's.intent'}
+
+
+def connect_results_db(db_path=RESULTS_DB_PATH):
+    os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+# region: Ingestion
+
+def detect_benchmark(header):
+    return 'sgd' if 'model_name' in header else 'mwoz'
+
+
+def mwoz_score_rows(eval_results):
+    '''(domain, intent, metric, value) of the MultiWOZ eval results.'''
+    rows = []
+    for domain, eval_result in eval_results.items():
+        for metric in ['inform', 'success', 'book']:
+            if (value := eval_result[metric]['complete']) is not None:
+                rows.append((domain, None, metric, value))
+    return rows
+
+
+def sgd_score_rows(eval_results):
+    '''(service, intent, metric, value) of the SGD eval results.'''
+    rows = []
+    for service_name, service_results in eval_results.items():
+        for intent_name, intent_results in service_results.items():
+            for metric in ['inform', 'success']:
+                if (value := intent_results[metric]) is not None:
+                    rows.append((service_name, intent_name, metric, value))
+    return rows
+
+
+def ingest_run_log(conn, log_file, name=None, benchmark=None, overwrite=False):
+    '''Load the latest results of a run log into the results DB from the run log index. Returns the run id.'''
+    header = read_header(log_file)
+    name = name or os.path.basename(log_file).split('.')[0]
+    benchmark = benchmark or detect_benchmark(header)
+    if benchmark == 'sgd':
+        run_log, score_rows = open_run_log(log_file, summarize_sgd_result), sgd_score_rows
+    else:
+        run_log, score_rows = open_run_log(log_file, summarize_mwoz_result), mwoz_score_rows
+
+    with conn:
+        if row := conn.execute('SELECT run_id FROM runs WHERE name = ?', (name,)).fetchone():
+            if not overwrite:
+                raise RuntimeError(f'Run {name = } is already in the results DB. Use --overwrite to replace it.')
+            for table in ['runs', 'dialogs', 'scores']:
+                conn.execute(f'DELETE FROM {table} WHERE run_id = ?', row)
+
+        run_id = conn.execute(
+            'INSERT INTO runs (name, benchmark, log_file, agent_model, user_model, eval_mode, ingested_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (name, benchmark, os.path.abspath(log_file), header.get('agent_model', header.get('model_name')),
+             header.get('user_model'), header.get('eval_mode'), datetime.now().isoformat(timespec='seconds')),
+        ).lastrowid
+
+        for dialog_id in run_log.dialog_ids():
+            summary = run_log.get_summary(dialog_id)
+            if summary['status'] == 'succeed':
+                conn.executemany('INSERT INTO scores VALUES (?, ?, ?, ?, ?, ?)',
+                                 [(run_id, dialog_id, *row) for row in score_rows(summary['eval_results'])])
+            conn.execute('INSERT INTO dialogs VALUES (?, ?, ?, ?, ?, ?)',
+                         (run_id, dialog_id, summary['status'], summary['cost'], summary.get('n_turns'),
+                          summary.get('latency')))
+    return run_id
+
+# endregion
+
+
+# region: Query
+
+def query_scores(conn, runs=None, level='domain', group_by=('run',), metrics=None):
+    '''Average scores grouped by `group_by` and the metric, as (*group values, metric, score, count) rows.
+
+    `level` is the unit of a score: `row` (a MultiWOZ domain or a SGD intent), `domain` (a MultiWOZ
+    domain or a SGD service) or `dialog`.
+    '''
+    assert level in LEVEL_KEYS, f'Unknown {level = }'
+    for key in group_by:
+        assert key in GROUP_COLUMNS, f'Unknown group by {key = }'
+        assert key not in ['domain', 'intent'] or key in LEVEL_KEYS[level], f'Can not group {level = } scores by {key}'
+
+    keys = ['run_id', 'dialog_id'] + LEVEL_KEYS[level] + ['metric']
+    if level == 'row':
+        scores_sql = 'SELECT * FROM scores'
+    else:
+        scores_sql = f'SELECT {", ".join(keys)}, MIN(value) AS value FROM scores GROUP BY {", ".join(keys)}'
+
+    columns = [GROUP_COLUMNS[key] for key in group_by] + ['s.metric']
+    sql = f'SELECT {", ".join(columns)}, AVG(s.value), COUNT(*) FROM ({scores_sql}) s JOIN runs USING (run_id)'
+    conditions, params = [], []
+    if runs:
+        conditions.append(f'runs.name IN ({", ".join("?" * len(runs))})')
+        params += runs
+    if metrics:
+        conditions.append(f's.metric IN ({", ".join("?" * len(metrics))})')
+        params += metrics
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += f' GROUP BY {", ".join(columns)} ORDER BY {", ".join(columns)}'
+    return conn.execute(sql, params).fetchall()
+
+
+def query_run_stats(conn, runs=None):
+    '''Per run: (name, benchmark, #dialogs, succeed rate, total cost, average cost, average turns, average latency).'''
+    sql = ('SELECT runs.name, runs.benchmark, COUNT(*), AVG(dialogs.status = \'succeed\'), SUM(dialogs.cost), '
+           'AVG(dialogs.cost), AVG(dialogs.n_turns), AVG(dialogs.latency) FROM dialogs JOIN runs USING (run_id)')
+    params = []
+    if runs:
+        sql += f' WHERE runs.name IN ({", ".join("?" * len(runs))})'
+        params += runs
+    sql += ' GROUP BY runs.run_id ORDER BY runs.name'
+    return conn.execute(sql, params).fetchall()
+
+
+def format_table(head, rows):
+    table = []
+    table.append('| ' + ' | '.join(head) + ' |')
+    table.append('| ' + ' | '.join([':---:'] * len(head)) + ' |')
+    for row in rows:
+        table.append('| ' + ' | '.join(row) + ' |')
+    return '\n'.join(table)
+
+# endregion
+
+
+@click.group()
+def results_db():
+    pass
+
+
+@results_db.command()
+@click.argument('log_files', nargs=-1, required=True)
+@click.option('--db_path', default=RESULTS_DB_PATH)
+@click.option('--name', default=None, help='Run name. Default: the log file name. Only for a single log file.')
+@click.option('--benchmark', type=click.Choice(['mwoz', 'sgd']), default=None, help='Default: detected from the log header.')
+@click.option('--overwrite', is_flag=True)
+def ingest(log_files, db_path, name, benchmark, overwrite):
+    if name and len(log_files) > 1:
+        raise RuntimeError(f'--name is given for {len(log_files)} log files.')
+    conn = connect_results_db(db_path)
+    for log_file in log_files:
+        run_id = ingest_run_log(conn, log_file, name, benchmark, overwrite)
+        n_dialog = conn.execute('SELECT COUNT(*) FROM dialogs WHERE run_id = ?', (run_id,)).fetchone()[0]
+        print(f'Ingested {n_dialog} dialogs of "{log_file}" to "{db_path}".')
+    conn.close()
+
+
+@results_db.command()
+@click.option('--db_path', default=RESULTS_DB_PATH)
+@click.option('--runs', default=None, help='Comma separated run names. Default: all runs.')
+@click.option('--level', type=click.Choice(list(LEVEL_KEYS)), default='domain')
+@click.option('--group_by', default='run', help=f'Comma separated keys of {", ".join(GROUP_COLUMNS)}.')
+@click.option('--metrics', default=None, help='Comma separated metrics. Default: all metrics.')
+def scores(db_path, runs, level, group_by, metrics):
+    '''Print the grouped scores of the runs.'''
+    runs = runs.split(',') if runs else None
+    group_by = group_by.split(',') if group_by else []
+    metrics = metrics.split(',') if metrics else None
+
+    conn = connect_results_db(db_path)
+    rows = query_scores(conn, runs, level, group_by, metrics)
+    conn.close()
+    rows = [[str(v) for v in row[:-2]] + [f'{row[-2] * 100:.1f}', str(row[-1])] for row in rows]
+    print(format_table(group_by + ['metric', 'score', '#'], rows))
+
+
+@results_db.command()
+@click.option('--db_path', default=RESULTS_DB_PATH)
+@click.option('--runs', default=None, help='Comma separated run names. Default: all runs.')
+def runs(db_path, runs):
+    '''Print the number of dialogs, succeed rate, cost, turns and latency of the runs.'''
+    runs = runs.split(',') if runs else None
+
+    conn = connect_results_db(db_path)
+    rows = query_run_stats(conn, runs)
+    conn.close()
+    head = ['run', 'benchmark', '#dialogs', 'succeed', 'Total ($)', 'Average ($)', 'turns', 'latency (s)']
+    rows = [[name, benchmark, str(n_dialog), f'{succeed * 100:.1f}', f'{total:.4f}', f'{average:.4f}',
+             f'{turns:.1f}' if turns is not None else '--', f'{latency:.1f}' if latency is not None else '--']
+            for name, benchmark, n_dialog, succeed, total, average, turns, latency in rows]
+    print(format_table(head, rows))
+
+
+if __name__ == '__main__':
+    results_db()
@@ -0,0 +1,391 @@
+import itertools
+import json
+import os
+import shutil
+import zlib
+
+RUN_LOG_INDEX_VERSION = 1
+PACKED_MAGIC = b'RUNLOG-ZLIB 1\n'
+PACKED_BLOCK_SIZE = 64  # records per compressed block
+READ_SIZE = 1 << 16
+
+
+def get_index_path(log_file):
+    return log_file + '.idx'
+
+
+def summarize_record(record):
+    return {'status': record.get('status'), 'cost': record.get('cost', 0.0)}
+
+
+class RunLog:
+    '''Append-only JSONL run log with a sidecar index.
+
+    The first line of the log is the header and each later line is a record of one dialog. A
+    record appended later for the same dialog id (a patch) supersedes the earlier ones. The index
+    `<log_file>.idx` is append-only as well: one line of [dialog id, offset, length, summary] per
+    record, where the summary is made by `summarize(record)` and is small enough to keep in memory.
+    So resuming and patching a run read and write only the lines they need.
+
+    Opening a log never changes it or its index, since a batch run may still be writing them: the
+    records after the indexed ones are indexed in memory, up to the last complete line. Only the
+    writers (`create`, `append`, `compact`) repair the log and save the index, see `repair`.
+    '''
+
+    def __init__(self, log_file, summarize=summarize_record):
+        self.log_file = log_file
+        self.index_path = get_index_path(log_file)
+        self.summarize = summarize
+        self.entries = {}  # dialog id -> (offset, length, summary), the latest record
+        self.end = 0  # the end of the last indexed line of the log
+        self.unsaved = []  # index lines of the records indexed since the index file was loaded
+        self.index_partial = False  # the index file ends with a partly written line
+        self.repaired = False
+
+        with open(log_file, 'rb') as f:
+            self.header = json.loads(f.readline())
+            self.header_end = f.tell()
+
+        # The summaries are rebuilt when they were made by another summarize function
+        self.index_header = {'version': RUN_LOG_INDEX_VERSION, 'summarize': summarize.__qualname__}
+        self.index_loaded = self.load_index()
+        if not self.index_loaded:
+            self.entries, self.end = {}, self.header_end
+        if os.path.getsize(log_file) > self.end:
+            self.catch_up()
+
+    @classmethod
+    def create(cls, log_file, header, summarize=summarize_record):
+        with open(log_file, 'w') as f:
+            f.write(json.dumps(header) + '\n')
+        if os.path.exists(get_index_path(log_file)):
+            os.remove(get_index_path(log_file))
+        run_log = cls(log_file, summarize)
+        run_log.repair()
+        return run_log
+
+    def load_index(self):
+        '''Load the index. Returns False if it is missing or does not match the log.'''
+        if not os.path.exists(self.index_path):
+            return False
+        with open(self.index_path) as f:
+            lines = f.read().splitlines()
+        if not lines or json.loads(lines[0]) != self.index_header:
+            return False
+
+        end = self.header_end
+        for line in lines[1:]:
+            try:
+                dialog_id, *entry = json.loads(line)
+            except ValueError:
+                self.index_partial = True  # a partly written last line
+                break
+            self.entries[dialog_id] = tuple(entry)
+            end = max(end, entry[0] + entry[1])
+        if end > os.path.getsize(self.log_file):
+            return False  # the log was truncated or rewritten
+        self.end = end
+        return True
+
+    def catch_up(self):
+        '''Index the records appended to the log since the last indexed one, in memory.'''
+        with open(self.log_file, 'rb') as f:
+            f.seek(self.end)
+            offset = self.end
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break  # a partly written last line
+                if line.strip():
+                    self.add_entry(json.loads(line), offset, len(line))
+                offset += len(line)
+            self.end = offset
+
+    def add_entry(self, record, offset, length):
+        summary = self.summarize(record)
+        self.entries[record['dialog_id']] = (offset, length, summary)
+        self.unsaved.append(json.dumps([record['dialog_id'], offset, length, summary]) + '\n')
+
+    def save_index(self):
+        '''Append the unsaved index lines, or rewrite the index file if it did not match the log.'''
+        if self.index_loaded and not self.index_partial:
+            with open(self.index_path, 'a') as f_index:
+                f_index.writelines(self.unsaved)
+        else:
+            with open(self.index_path, 'w') as f_index:
+                f_index.write(json.dumps(self.index_header) + '\n')
+                f_index.writelines(json.dumps([dialog_id, *entry]) + '\n' for dialog_id, entry in self.entries.items())
+            self.index_loaded, self.index_partial = True, False
+        self.unsaved = []
+
+    def repair(self):
+        '''Prepare the log for appending: drop a partly written last line, so that appends start on a new
+        line, and save the index. Only for the writer of the log.'''
+        if os.path.getsize(self.log_file) > self.end:
+            os.truncate(self.log_file, self.end)
+        self.save_index()
+        self.repaired = True
+
+    def append(self, record, default=None):
+        '''Append a record, which supersedes the earlier records of the same dialog.'''
+        if not self.repaired:
+            self.repair()
+        line = (json.dumps(record, default=default) + '\n').encode('utf-8')
+        with open(self.log_file, 'ab') as f:
+            offset = f.tell()
+            f.write(line)
+        self.add_entry(record, offset, len(line))
+        self.save_index()
+        self.end = offset + len(line)
+
+    def __contains__(self, dialog_id):
+        return dialog_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def dialog_ids(self):
+        '''Dialog ids with records, in the order of the header and then of the first records.'''
+        header_ids = [dialog_id for dialog_id in self.header.get('dialog_ids', []) if dialog_id in self.entries]
+        header_id_set = set(header_ids)
+        return header_ids + [dialog_id for dialog_id in self.entries if dialog_id not in header_id_set]
+
+    def get_summary(self, dialog_id):
+        return self.entries[dialog_id][2]
+
+    def get(self, dialog_id):
+        offset, length, _ = self.entries[dialog_id]
+        with open(self.log_file, 'rb') as f:
+            f.seek(offset)
+            return json.loads(f.read(length))
+
+    def records(self):
+        '''The latest record of each dialog.'''
+        with open(self.log_file, 'rb') as f:
+            for dialog_id in self.dialog_ids():
+                offset, length, _ = self.entries[dialog_id]
+                f.seek(offset)
+                yield json.loads(f.read(length))
+
+    def compact(self, output_file=None):
+        '''Rewrite the log with the header and the latest record of each dialog only.'''
+        output_file = output_file or self.log_file
+        tmp_file = output_file + '.tmp'
+        with open(self.log_file, 'rb') as f, open(tmp_file, 'wb') as f_out:
+            f_out.write(json.dumps(self.header).encode('utf-8') + b'\n')
+            for dialog_id in self.dialog_ids():
+                offset, length, _ = self.entries[dialog_id]
+                f.seek(offset)
+                f_out.write(f.read(length))
+        if os.path.exists(get_index_path(output_file)):
+            os.remove(get_index_path(output_file))
+        os.replace(tmp_file, output_file)
+        run_log = RunLog(output_file, self.summarize)
+        run_log.repair()
+        return run_log
+
+
+# region: Packed Run Log
+
+def get_field(record, path):
+    for key in path:
+        if not isinstance(record, dict) or key not in record:
+            return None
+        record = record[key]
+    return record
+
+
+def drop_ref_fields(record, ref_fields):
+    '''Drop the fields equal to the dataset, which are listed in `dataset_refs` of the record.
+
+    `ref_fields` is {path (tuple of keys): value} of the fields of the record copied from the
+    dataset. The dicts along the dropped paths are copied, so the record is not changed.
+    '''
+    record = dict(record)
+    refs = []
+    for path, value in ref_fields.items():
+        parent = get_field(record, path[:-1])
+        if not isinstance(parent, dict) or path[-1] not in parent or parent[path[-1]] != value:
+            continue
+        node = record
+        for key in path[:-1]:
+            node[key] = dict(node[key])
+            node = node[key]
+        del node[path[-1]]
+        refs.append(list(path))
+    if refs:
+        record['dataset_refs'] = refs
+    return record
+
+
+def fill_ref_fields(record, ref_fields):
+    for path in record.pop('dataset_refs', []):
+        get_field(record, path[:-1])[path[-1]] = ref_fields[tuple(path)]
+    return record
+
+
+def iter_blocks(f, offset=None):
+    '''Yield (offset, length, lines) of the zlib blocks of the file from the offset on, or from the current position.'''
+    if offset is None:
+        offset = 0
+    else:
+        f.seek(offset)
+    buffer = b''
+    while buffer or (buffer := f.read(READ_SIZE)):
+        decompressor = zlib.decompressobj()
+        data, length = [], 0
+        while not decompressor.eof:
+            if not buffer and not (buffer := f.read(READ_SIZE)):
+                return  # a partly written last block
+            data.append(decompressor.decompress(buffer))
+            length += len(buffer) - len(decompressor.unused_data)
+            buffer = decompressor.unused_data
+        yield offset, length, b''.join(data).splitlines()
+        offset += length
+
+
+class PackedRunLog(RunLog):
+    '''Read-only run log of zlib compressed blocks of records, written by `pack`.
+
+    The index `<log_file>.idx` has one line of [dialog id, block offset, block length, summary,
+    position in the block] per record, so a record is read by decompressing only its block. Fields
+    copied from the dataset are dropped from the records and filled back on reading by
+    `get_ref_fields(record)`, which returns {path: value} of them. Without it, the records keep
+    the paths of the dropped fields in `dataset_refs`.
+    '''
+
+    def __init__(self, log_file, summarize=summarize_record, get_ref_fields=None):
+        self.log_file = log_file
+        self.index_path = get_index_path(log_file)
+        self.summarize = summarize
+        self.get_ref_fields = get_ref_fields
+        self.entries = {}  # dialog id -> (block offset, block length, summary, position)
+        self.block_cache = (None, None)  # offset and lines of the last read block
+
+        with open(log_file, 'rb') as f:
+            if f.read(len(PACKED_MAGIC)) != PACKED_MAGIC:
+                raise RuntimeError(f'{log_file = } is not a packed run log.')
+            offset, length, lines = next(iter_blocks(f, len(PACKED_MAGIC)))
+            self.header = json.loads(lines[0])
+            self.header_end = offset + length
+
+        self.index_header = {'version': RUN_LOG_INDEX_VERSION, 'summarize': summarize.__qualname__, 'packed': True}
+        if not self.load_index() or os.path.getsize(log_file) > self.end:
+            self.build_index()
+
+    def build_index(self):
+        '''Index the blocks in memory. Like a plain log, opening never writes the index, see `save_index`.'''
+        self.entries = {}
+        self.end = self.header_end
+        with open(self.log_file, 'rb') as f:
+            for offset, length, lines in iter_blocks(f, self.header_end):
+                for position, line in enumerate(lines):
+                    record = json.loads(line)
+                    self.entries[record['dialog_id']] = (offset, length, self.summarize(record), position)
+                self.end = offset + length
+
+    def save_index(self):
+        '''Write the index file, only by `pack`.'''
+        with open(self.index_path, 'w') as f_index:
+            f_index.write(json.dumps(self.index_header) + '\n')
+            f_index.writelines(json.dumps([dialog_id, *entry]) + '\n' for dialog_id, entry in self.entries.items())
+
+    def read_block(self, offset, length):
+        if self.block_cache[0] != offset:
+            with open(self.log_file, 'rb') as f:
+                f.seek(offset)
+                self.block_cache = (offset, zlib.decompress(f.read(length)).splitlines())
+        return self.block_cache[1]
+
+    def get(self, dialog_id):
+        offset, length, _, position = self.entries[dialog_id]
+        record = json.loads(self.read_block(offset, length)[position])
+        if 'dataset_refs' in record and self.get_ref_fields:
+            record = fill_ref_fields(record, self.get_ref_fields(record))
+        return record
+
+    def records(self):
+        '''The records in order, decompressing each block once.'''
+        for dialog_id in self.dialog_ids():
+            yield self.get(dialog_id)
+
+    def append(self, record, default=None):
+        raise RuntimeError(f'Packed run log "{self.log_file}" is read-only.')
+
+    def compact(self, output_file=None):
+        raise RuntimeError(f'Packed run log "{self.log_file}" is already compact.')
+
+
+def read_header(log_file):
+    with open(log_file, 'rb') as f:
+        if f.read(len(PACKED_MAGIC)) == PACKED_MAGIC:
+            return json.loads(next(iter_blocks(f, len(PACKED_MAGIC)))[2][0])
+        f.seek(0)
+        return json.loads(f.readline())
+
+
+def stream_run_log(f):
+    '''Yield the header and then the records of a run log, plain or packed, read from the binary file object
+    line by line (block by block) without the index, e.g. from stdin. Superseded records are yielded as well.
+    '''
+    magic = f.read(len(PACKED_MAGIC))
+    if magic == PACKED_MAGIC:
+        for _, _, lines in iter_blocks(f):
+            yield from map(json.loads, lines)
+        return
+
+    # The bytes read for the magic are the header line and maybe the start of the next lines
+    head = magic if b'\n' in magic else magic + f.readline()
+    header_line, rest = head.split(b'\n', 1) if b'\n' in head else (head, b'')
+    yield json.loads(header_line)
+    for line in itertools.chain((rest + f.readline()).splitlines() if rest else [], f):
+        if line.strip():
+            yield json.loads(line)
+
+
+def copy_run_log(log_file, output_file, summarize=summarize_record):
+    '''Copy a plain run log and its index, and open the copy to append to it.'''
+    shutil.copyfile(log_file, output_file)
+    if os.path.exists(get_index_path(log_file)):
+        shutil.copyfile(get_index_path(log_file), get_index_path(output_file))
+    elif os.path.exists(get_index_path(output_file)):
+        os.remove(get_index_path(output_file))
+    return RunLog(output_file, summarize)
+
+
+def open_run_log(log_file, summarize=summarize_record, get_ref_fields=None):
+    '''Open a run log, plain or packed.'''
+    with open(log_file, 'rb') as f:
+        packed = f.read(len(PACKED_MAGIC)) == PACKED_MAGIC
+    if packed:
+        return PackedRunLog(log_file, summarize, get_ref_fields)
+    return RunLog(log_file, summarize)
+
+
+def pack(run_log, output_file, get_ref_fields=None, block_size=PACKED_BLOCK_SIZE, level=9):
+    '''Write the latest records of the run log to a packed run log.
+
+    With `get_ref_fields`, the fields copied from the dataset are stored as references.
+    '''
+    tmp_file = output_file + '.tmp'
+    with open(tmp_file, 'wb') as f:
+        f.write(PACKED_MAGIC)
+        f.write(zlib.compress(json.dumps(run_log.header).encode('utf-8') + b'\n', level))
+        block = []
+        for record in run_log.records():
+            if get_ref_fields:
+                record = drop_ref_fields(record, get_ref_fields(record))
+            block.append(json.dumps(record).encode('utf-8'))
+            if len(block) == block_size:
+                f.write(zlib.compress(b'\n'.join(block) + b'\n', level))
+                block = []
+        if block:
+            f.write(zlib.compress(b'\n'.join(block) + b'\n', level))
+
+    if os.path.exists(get_index_path(output_file)):
+        os.remove(get_index_path(output_file))
+    os.replace(tmp_file, output_file)
+    packed_run_log = PackedRunLog(output_file, run_log.summarize, get_ref_fields)
+    packed_run_log.save_index()
+    return packed_run_log
+
+# endregion
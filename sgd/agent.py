@@ -1,11 +1,12 @@
-from functools import partial
+from functools import lru_cache, partial
+from types import MappingProxyType
 
 from termcolor import cprint
 
 from base_agent import BaseAgent
 from sgd.function_schema import make_function_schemas
 from sgd.functions import sgd_function
-from sgd.utils import load_schemas
+from sgd.utils import load_registry, load_schemas
 
 TEMPLATE = '''You are an intelligent AI Assistant to help the user complete complex tasks. There are many services to fulfill the user's goals. Each service consists of mulitple functions that the AI Assistant can call. The AI Assistant can choose to call a function in order to provide information or make a transaction for the user.
 
@@ -48,6 +49,35 @@ Book bus journeys from the biggest bus network in the country.
 - FindBus: Find a bus journey for a given pair of cities. (Query function)
 - BuyBusTicket: Buy tickets for a bus journey. (Transaction function)
 '''
+
+
+@lru_cache(maxsize=None)
+def make_service_prompt(service_name):
+    service = load_registry()[service_name]
+    functions_info = []
+    for intent_name, intent in service['intents'].items():
+        func_info = f'- {service_name}_{intent_name}: {intent["description"]}.'
+        if not service['transactional'][intent_name]:
+            func_info += ' (Query function)'
+        else:
+            func_info += ' (Transaction function)'
+        functions_info.append(func_info)
+    functions_info = '\n'.join(functions_info)
+    service_info = SERVICE_TEMPLATE.format(service_name=service_name,
+                                           service_desc=service['schema']['description'],
+                                           functions_info=functions_info)
+    return service_info
+
+
+@lru_cache(maxsize=None)
+def make_service_function_map(service_name):
+    '''Function name -> function of the service. Shared by all agents, so it is read-only.'''
+    function_map = {}
+    for intent_name in load_registry()[service_name]['intents']:
+        func_name = f'{service_name}_{intent_name}'
+        func = partial(sgd_function, service_name=service_name, intent_name=intent_name)
+        function_map[func_name] = func
+    return MappingProxyType(function_map)
             
 
 class SgdAgent(BaseAgent):
@@ -60,22 +90,7 @@ class SgdAgent(BaseAgent):
         super().__init__(model_name, callbacks)
 
     def make_system_prompt(self):
-        services_info = []
-        for service_name in self.service_names:
-            service_schema = self.sgd_schemas[service_name]
-            functions_info = []
-            for intent in service_schema['intents']:
-                func_info = f'- {service_name}_{intent["name"]}: {intent["description"]}.'
-                if not intent['is_transactional']:
-                    func_info += ' (Query function)'
-                else:
-                    func_info += ' (Transaction function)'
-                functions_info.append(func_info)
-            functions_info = '\n'.join(functions_info)
-            service_info = SERVICE_TEMPLATE.format(service_name=service_name, 
-                                                service_desc=service_schema['description'],
-                                                functions_info=functions_info)
-            services_info.append(service_info)
+        services_info = [make_service_prompt(service_name) for service_name in self.service_names]
         services_info = '\n\n'.join(services_info)
 
         prompt = TEMPLATE.format(services_info=services_info)
@@ -88,12 +103,7 @@ class SgdAgent(BaseAgent):
     def make_function_map(self):
         function_map = {}
         for service_name in self.service_names:
-            service_schema = self.sgd_schemas[service_name]
-            for intent in service_schema['intents']:
-                intent_name = intent['name']
-                func_name = f'{service_name}_{intent_name}'
-                func = partial(sgd_function, service_name=service_name, intent_name=intent_name)
-                function_map[func_name] = func
+            function_map.update(make_service_function_map(service_name))
         return function_map
     
     def fix_function_call(self, function_call):
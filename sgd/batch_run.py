@@ -1,28 +1,43 @@
-import json
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import copy
 import os
-import random
+import time
 
 import click
 import tenacity
-from termcolor import colored
+from termcolor import colored, cprint
 from tqdm import tqdm
 
+from bootstrap import N_RESAMPLES
+from judge_cache import JUDGE_CACHE_PATH, load_judge_cache
+from pipeline import run_pipeline
+from run_log import RunLog, copy_run_log, open_run_log, pack
+from sgd.dialog_store import load_dialog_store
 from sgd.engine import run
 from sgd.evaluate import evaluate, show_eval_result
-from sgd.metric import MetricTracker
-from sgd.utils import DATA_DIR, load_dialogs
+from sgd.metric import MetricTracker, summarize_result, track_run_log
+from sgd.utils import DATA_DIR
+from tracing import configure_tracing, tracer
 
 
 def run_and_evaluate(dialog, dialog_id, model_name):
+    run_output = run_dialog(dialog, dialog_id, model_name)
+    return evaluate_stage(run_output, dialog)
+
+
+def run_dialog(dialog, dialog_id, model_name):
+    '''Run the dialog and fill the logs, callings, cost and usage of the result.'''
     result = {
         'dialog_id': dialog_id,
         'status': None,
         'eval_results': None,
         'cost': 0.0,
+        'latency': None,
+        'usage': None,
         'run_result': None,
+        'callings': None,
     }
 
-    # Step 1. Run dialog
     def before_sleep_func(retry_state):
         e = retry_state.outcome.exception()
         msg = f'Tenacity: Retrying {retry_state.fn} as it raise {e.__class__.__name__}: '
@@ -30,8 +45,10 @@ def run_and_evaluate(dialog, dialog_id, model_name):
         print(msg)
 
     retrying = tenacity.Retrying(stop=tenacity.stop_after_attempt(2), before_sleep=before_sleep_func, reraise=True)
+    start = time.time()
     try:
-        logs, cost, callings = retrying(run, dialog=dialog, model_name=model_name)
+        with tracer.span('dialog', 'dialog', dialog_id=dialog_id):
+            logs, cost, callings, usage = retrying(run, dialog=dialog, model_name=model_name)
     except Exception as e:
         msg = f'Run dialog failed as {e.__class__.__name__}: '
         print(colored(msg, 'red') + str(e))
@@ -40,30 +57,100 @@ def run_and_evaluate(dialog, dialog_id, model_name):
         return False, result
     else:
         result['run_result'] = logs
+        result['callings'] = callings
         result['cost'] += cost
+        result['usage'] = usage
+        result['latency'] = time.time() - start
+        return True, result
 
-    # Step 2. Evaluate
+
+def evaluate_stage(run_output, dialog):
+    succeed, result = run_output
+    if not succeed:
+        return False, result
+    succeed = evaluate_run(result, dialog, result['run_result'], result['callings'])
+    return succeed, result
+
+
+def evaluate_run(result, dialog, logs, callings):
+    '''Evaluate the logs and fill the eval results, status, cost and judge usage of the result.'''
     try:
-        eval_result, cost = evaluate(dialog, logs, callings)
+        with tracer.span('evaluate', 'eval', dialog_id=result['dialog_id']):
+            eval_result, cost, usage = evaluate(dialog, logs, callings)
     except Exception as e:
         # raise e
         msg = f'Run dialog failed as {e.__class__.__name__}: '
         print(colored(msg, 'red') + str(e))
         result['eval_results'] = {'exception': msg + str(e)}
         result['status'] = 'failed on eval dialog'
-        return False, result
+        return False
     else:
         result['eval_results'] = eval_result
-        result['cost'] += cost
+        result['usage'] = result.get('usage') or {}
+        if 'user' in result['usage']:  # run cost plus the judge cost, replacing that of an earlier evaluation
+            result['cost'] = result['usage']['user']['cost'] + result['usage']['agent']['cost'] + cost
+        # Otherwise a log from before the usage was recorded: its run cost is not known apart from the judge
+        # cost of its first evaluation, so keep the logged cost.
+        result['usage']['judge'] = usage
         show_eval_result(eval_result)
 
     result['status'] = 'succeed'
-    return True, result
+    return True
+
+
+def run_batch(data, run_log, metric_tracker, model_name, run_workers=1, eval_workers=1, n_done=0, n_succeed=0):
+    '''Run and evaluate the (dialog id, dialog) pairs in a pipeline and append the results to the log in order.
+
+    Simulation and evaluation are separate stages with their own workers, so a dialog is evaluated
+    while the next ones are simulated.
+    '''
+    pbar = tqdm(total=len(data))
+    counter = {'done': n_done, 'succeed': n_succeed}
+
+    def sink(item, output):
+        dialog_id, _ = item
+        if isinstance(output, Exception):
+            msg = f'run_and_evaluate failed as {output.__class__.__name__}: '
+            print(colored(msg, 'red') + str(output))
+            result = {'dialog_id': dialog_id, 'status': 'run_and_evaluate', 'exception': msg + str(output)}
+            succeed = False
+        else:
+            succeed, result = output
+        if succeed:
+            metric_tracker.add_dialog_eval_results(dialog_id, result['eval_results'])
+            metric_tracker.add_cost(dialog_id, result['cost'])
+            summary = summarize_result(result)
+            metric_tracker.add_usage(dialog_id, summary['usage'], summary['n_turns'], summary['latency'])
+
+        run_log.append(result)
+
+        counter['done'] += 1
+        counter['succeed'] += succeed
+        succeed_rate = counter['succeed'] / counter['done']
+        succeed_str = f'succeed: {succeed_rate:.0%} ({counter["succeed"]}/{counter["done"]})'
+
+        pbar.update()
+        pbar.set_description(f'Finished {dialog_id}')
+        postfix_str = metric_tracker.generate_postfix_str(prefixes=[succeed_str])
+        pbar.set_postfix_str(postfix_str, refresh=False)
+
+    # The stages pass on (dialog, run output), as the evaluation needs the dialog goals
+    stages = [
+        (lambda item: (item[1], run_dialog(item[1], item[0], model_name)), run_workers),
+        (lambda task: evaluate_stage(task[1], task[0]), eval_workers),
+    ]
+    run_pipeline(data, stages, sink)
+    pbar.close()
 
 
 @click.group()
-def batch_run():
-    pass
+@click.option('--trace_file', default=None, help='Export the spans of the dialogs and evaluations to the JSONL file.')
+@click.option('--chrome_trace_file', default=None, help='Export the spans in the Chrome trace event format.')
+@click.option('--quiet', is_flag=True, help='Do not print the dialogs.')
+@click.pass_context
+def batch_run(ctx, trace_file, chrome_trace_file, quiet):
+    configure_tracing(trace_file, chrome_trace_file, print_spans=not quiet)
+    ctx.call_on_close(tracer.close)
 
 
 @batch_run.command()
@@ -71,8 +158,12 @@ def batch_run():
 @click.option('--score_table_file')
 @click.option('--max_dialog', type=int, default=100)
 @click.option('--data_dir', default=DATA_DIR)
+@click.option('--services', default=None, help='Comma separated services. Only sample dialogs with any of them.')
 @click.option('--model_name', default='gpt-3.5-turbo-0613')
-def new(log_file, score_table_file, max_dialog, data_dir, model_name):
+@click.option('--run_workers', type=int, default=1, help='Number of dialogs simulated at the same time.')
+@click.option('--eval_workers', type=int, default=1, help='Number of dialogs evaluated at the same time.')
+@click.option('--bootstrap', type=int, default=0, help=f'Bootstrap resamples of the score table, e.g. {N_RESAMPLES}. 0 to skip.')
+def new(log_file, score_table_file, max_dialog, data_dir, services, model_name, run_workers, eval_workers, bootstrap):
     # Step 0. Check
     if os.path.exists(log_file):
         raise RuntimeError(f'mode = new and {log_file = } exists.')
@@ -80,50 +171,22 @@ def new(log_file, score_table_file, max_dialog, data_dir, model_name):
         raise RuntimeError(f'mode = new and {score_table_file = } exists.')
 
     # Step 1. Sample Dialogs  # TODO: more elaborate samplings
-    dialogs = load_dialogs(data_dir)
-    dialog_ids = list(dialogs.keys())
-    random.shuffle(dialog_ids)
-    dialog_ids = dialog_ids[:max_dialog]
+    dialogs = load_dialog_store(data_dir)
+    services = services.split(',') if services else None
+    dialog_ids = dialogs.sample(max_dialog, services=services)
     data = [(idx, dialogs[idx]) for idx in dialog_ids]
 
     first_line = {'max_dialog': max_dialog, 'dialog_ids': dialog_ids, 'model_name': model_name}
-    with open(log_file, 'w') as f:
-        f.write(json.dumps(first_line) + '\n')
+    run_log = RunLog.create(log_file, first_line, summarize_result)
 
-    print(f'Sampled {max_dialog} dialogs from "{data_dir}".')
+    print(f'Sampled {len(dialog_ids)} dialogs from "{data_dir}".')
 
     # Step 2. Batch Run
     metric_tracker = MetricTracker()
-    n_succeed = 0
-    pbar = tqdm(data)
-    for idx, (dialog_id, dialog) in enumerate(pbar, start=1):
-        pbar.set_description(f'Processing {dialog_id}')
-
-        try:
-            succeed, result = run_and_evaluate(dialog, dialog_id, model_name)
-        except Exception as e:
-            # raise e
-            msg = f'run_and_evaluate failed as {e.__class__.__name__}: '
-            print(colored(msg, 'red') + str(e))
-            result = {'dialog_id': dialog_id, 'status': 'run_and_evaluate', 'exception': msg + str(e)}
-            succeed = False
-        if succeed:
-            metric_tracker.add_dialog_eval_results(dialog_id, result['eval_results'])
-            metric_tracker.add_cost(dialog_id, result['cost'])
-            pass
-
-        with open(log_file, 'a') as f:
-            f.write(json.dumps(result) + '\n')
-
-        n_succeed += succeed
-        succeed_rate = n_succeed / idx
-        succeed_str = f'succeed: {succeed_rate:.0%} ({n_succeed}/{idx})'
-
-        postfix_str = metric_tracker.generate_postfix_str(prefixes=[succeed_str])
-        pbar.set_postfix_str(postfix_str, refresh=False)
+    run_batch(data, run_log, metric_tracker, model_name, run_workers, eval_workers)
 
     # Step 3. Summary
-    summary = metric_tracker.generate_all_tables()
+    summary = metric_tracker.generate_all_tables(bootstrap)
     with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
@@ -132,7 +195,10 @@ def new(log_file, score_table_file, max_dialog, data_dir, model_name):
 @click.option('--log_file')
 @click.option('--score_table_file')
 @click.option('--data_dir', default=DATA_DIR)
-def recover(log_file, score_table_file, data_dir):
+@click.option('--run_workers', type=int, default=1, help='Number of dialogs simulated at the same time.')
+@click.option('--eval_workers', type=int, default=1, help='Number of dialogs evaluated at the same time.')
+@click.option('--bootstrap', type=int, default=0, help=f'Bootstrap resamples of the score table, e.g. {N_RESAMPLES}. 0 to skip.')
+def recover(log_file, score_table_file, data_dir, run_workers, eval_workers, bootstrap):
     # Step 0. Check
     if not os.path.exists(log_file):
         raise RuntimeError(f'mode = recover and {log_file = } does not exist.')
@@ -140,62 +206,26 @@ def recover(log_file, score_table_file, data_dir):
         raise RuntimeError(f'mode = recover and {score_table_file = } exists.')
     
     # Step 1. Load
-    all_data = load_dialogs(data_dir)
-    
-    with open(log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
-    n_target_dialogs = len(data[0]['dialog_ids'])
-    n_finish_dialogs = len(data) - 1
-    n_left_dialogs = n_target_dialogs - n_finish_dialogs
-    print(f'Recover: Target: {n_target_dialogs}, Finish: {n_finish_dialogs}, Left: {n_left_dialogs}')
-    model_name = data[0]['model_name']
+    all_data = load_dialog_store(data_dir)
+
+    # Only the index is read: the finished dialogs and their metrics
+    run_log = open_run_log(log_file, summarize_result)
+    header = run_log.header
+    left_dialog_ids = [dialog_id for dialog_id in header['dialog_ids'] if dialog_id not in run_log]
+    n_target_dialogs = len(header['dialog_ids'])
+    n_finish_dialogs = n_target_dialogs - len(left_dialog_ids)
+    print(f'Recover: Target: {n_target_dialogs}, Finish: {n_finish_dialogs}, Left: {len(left_dialog_ids)}')
+    model_name = header['model_name']
     print(f'Run parameters: {model_name = }')
 
-    # Step 2. Check dialog ids
-    dialog_ids = data[0]['dialog_ids']
-    for dialog_id, item in zip(dialog_ids, data[1:]):
-        assert dialog_id == item['dialog_id']
-
-    # Step 3. Batch Run
-    metric_tracker = MetricTracker()
-    n_succeed = 0
-
-    # finished dialogs
-    for result in data[1:]:
-        n_succeed += result['status'] == 'succeed'
-        metric_tracker.add_dialog_eval_results(result['dialog_id'], result['eval_results'])
-        metric_tracker.add_cost(result['dialog_id'], result['cost'])
-
-    # new dialogs
-    dialog_ids = data[0]['dialog_ids'][n_finish_dialogs:]
-    pbar = tqdm(dialog_ids)
-    for idx, dialog_id in enumerate(pbar, start=n_finish_dialogs + 1):
-        pbar.set_description(f'Processing {dialog_id}')
-        dialog = all_data[dialog_id]
-
-        try:
-            succeed, result = run_and_evaluate(dialog, dialog_id, model_name)
-        except Exception as e:
-            msg = f'run_and_evaluate failed as {e.__class__.__name__}: '
-            print(colored(msg, 'red') + str(e))
-            result = {'dialog_id': dialog_id, 'status': 'run_and_evaluate', 'exception': msg + str(e)}
-            succeed = False
-        if succeed:
-            metric_tracker.add_dialog_eval_results(dialog_id, result['eval_results'])
-            metric_tracker.add_cost(dialog_id, result['cost'])
-
-        with open(log_file, 'a') as f:
-            f.write(json.dumps(result) + '\n')
-
-        n_succeed += succeed
-        succeed_rate = n_succeed / idx
-        succeed_str = f'succeed: {succeed_rate:.0%} ({n_succeed}/{idx})'
-
-        postfix_str = metric_tracker.generate_postfix_str(prefixes=[succeed_str])
-        pbar.set_postfix_str(postfix_str, refresh=False)
+    # Step 2. Batch Run
+    metric_tracker, n_succeed = track_run_log(run_log)
+    new_data = [(dialog_id, all_data[dialog_id]) for dialog_id in left_dialog_ids]
+    run_batch(new_data, run_log, metric_tracker, model_name, run_workers, eval_workers,
+              n_done=n_finish_dialogs, n_succeed=n_succeed)
 
     # Step 3. Summary
-    summary = metric_tracker.generate_all_tables()
+    summary = metric_tracker.generate_all_tables(bootstrap)
     with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
@@ -206,6 +236,7 @@ def recover(log_file, score_table_file, data_dir):
 @click.option('--updated_score_table_file', default='logs_updated_table.md')
 @click.option('--data_dir', default=DATA_DIR)
 def update(log_file, updated_log_file, updated_score_table_file, data_dir):
+    '''Re-run the failed dialogs and append their results as patches to a copy of the log, the updated log.'''
     # Step 0. Check
     if not os.path.exists(log_file):
         raise RuntimeError(f'mode = update and {log_file = } does not exist.')
@@ -215,28 +246,21 @@ def update(log_file, updated_log_file, updated_score_table_file, data_dir):
         raise RuntimeError(f'mode = update and {updated_score_table_file = } exists.')
     
     # Step 1. Load
-    all_data = load_dialogs(data_dir)
-    
-    with open(log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
-    n_dialog = len(data) - 1
-    print(f'Loaded {n_dialog} dialogus from "{log_file}".')
-    agent_type, agent_model, user_model = data[0]['agent_type'], data[0]['agent_model'], data[0]['user_model']
-    print(f'Run parameters: {agent_type = }, {agent_model = }, {user_model = }')
+    all_data = load_dialog_store(data_dir)
+
+    run_log = open_run_log(log_file, summarize_result)
+    header = run_log.header
+    print(f'Loaded {len(run_log)} dialogs from "{log_file}".')
+    model_name = header['model_name']
+    print(f'Run parameters: {model_name = }')
 
     # Step 2. Check dialog ids
-    dialog_ids = data[0]['dialog_ids']
-    assert len(dialog_ids) == len(data) - 1
-    for dialog_id, item in zip(dialog_ids, data[1:]):
-        assert dialog_id == item['dialog_id']
+    if left_dialog_ids := [dialog_id for dialog_id in header['dialog_ids'] if dialog_id not in run_log]:
+        raise RuntimeError(f'mode = update and {len(left_dialog_ids)} dialogs are not finished. Use recover first.')
 
     # Step 3. Scan failed dialogs
-    data_fails = []
-    for i, item in enumerate(data[1:], start=1):
-        if item['status'] != 'succeed':
-            dialog_id = data[0]['dialog_ids'][i - 1]
-            dialog = all_data[dialog_id]
-            data_fails.append((i, dialog_id, dialog))
+    data_fails = [(dialog_id, all_data[dialog_id]) for dialog_id in run_log.dialog_ids()
+                  if run_log.get_summary(dialog_id)['status'] != 'succeed']
     if len(data_fails) > 0:
         print(f'{len(data_fails)} failed dialogs found.')
     else:
@@ -244,25 +268,22 @@ def update(log_file, updated_log_file, updated_score_table_file, data_dir):
         return
 
     # Step 4. Update
+    run_log = copy_run_log(log_file, updated_log_file, summarize_result)
     pbar = tqdm(data_fails)
     n_total, n_succeed = 0, 0
-    for i, dialog_id, dialog in pbar:
+    for dialog_id, dialog in pbar:
         pbar.set_description(f'Processing {dialog_id}')
 
         try:
-            succeed, result = run_and_evaluate(dialog, dialog_id, agent_type, agent_model, user_model)
+            succeed, result = run_and_evaluate(dialog, dialog_id, model_name)
         except Exception as e:
-            # raise e
             msg = f'run_and_evaluate failed as {e.__class__.__name__}: '
             print(colored(msg, 'red') + str(e))
-            print(f'Update dialog faided: Line {i + 1}, Dialog_id: {dialog_id}')
+            print(f'Update dialog faided: Dialog_id: {dialog_id}')
             succeed = False
         else:
-            data[i] = result
-            with open(updated_log_file, 'w') as f:
-                data_raw = [json.dumps(item) for item in data]
-                f.write('\n'.join(data_raw) + '\n')
-            print(f'Updated to "{updated_log_file}": Line {i + 1}, Dialog_id: {dialog_id}')
+            run_log.append(result)
+            print(f'Updated to "{updated_log_file}": Dialog_id: {dialog_id}')
 
         n_total += 1
         n_succeed += succeed
@@ -271,20 +292,152 @@ def update(log_file, updated_log_file, updated_score_table_file, data_dir):
     print(f'Finish: succeed: {succeed_rate:.0%} ({n_succeed}/{n_total})')
 
     # Step 5. Summary
-    with open(updated_log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
+    metric_tracker, _ = track_run_log(run_log)
+    summary = metric_tracker.generate_all_tables()
+    with open(updated_score_table_file, 'w') as f:
+        f.write(summary + '\n')
+
+
+@batch_run.command()
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--compacted_log_file', default=None, help='Default: compact the log in place.')
+def compact(log_file, compacted_log_file):
+    '''Drop the records superseded by patches from the log.'''
+    if not os.path.exists(log_file):
+        raise RuntimeError(f'mode = compact and {log_file = } does not exist.')
+    size = os.path.getsize(log_file)
+    run_log = open_run_log(log_file, summarize_result).compact(compacted_log_file)
+    print(f'Compacted {len(run_log)} dialogs to "{run_log.log_file}": '
+          f'{size / 2**20:.1f} MB -> {os.path.getsize(run_log.log_file) / 2**20:.1f} MB')
+
+
+@batch_run.command('pack')
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--packed_log_file', default=None, help='Default: <log_file>.z')
+@click.option('--block_size', type=int, default=64, help='Number of results per compressed block.')
+def pack_log(log_file, packed_log_file, block_size):
+    '''Pack the latest results of the log into compressed blocks.'''
+    packed_log_file = packed_log_file or log_file + '.z'
+    if not os.path.exists(log_file):
+        raise RuntimeError(f'mode = pack and {log_file = } does not exist.')
+    if os.path.exists(packed_log_file):
+        raise RuntimeError(f'mode = pack and {packed_log_file = } exists.')
+    size = os.path.getsize(log_file)
+    run_log = pack(open_run_log(log_file, summarize_result), packed_log_file, block_size=block_size)
+    print(f'Packed {len(run_log)} dialogs to "{packed_log_file}": '
+          f'{size / 2**20:.1f} MB -> {os.path.getsize(packed_log_file) / 2**20:.1f} MB')
+
+
+def reevaluate_logs(data, indices, dialogs, workers=1, keep_cost=False):
+    '''Re-evaluate the run results of the log items `data[i]` in parallel, in place. Never re-run dialogs.
+
+    With `keep_cost`, the logged cost and judge usage are kept, for judge answers replayed from the cache.
+    '''
+    def reevaluate(i):
+        result = copy.deepcopy(data[i])
+        succeed = evaluate_run(result, dialogs[result['dialog_id']], result['run_result'], result['callings'])
+        if keep_cost:
+            result['cost'] = data[i]['cost']
+            if judge_usage := (data[i].get('usage') or {}).get('judge'):
+                result['usage']['judge'] = copy.deepcopy(judge_usage)
+        return i, succeed, result
+
+    n_total, n_succeed = 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(reevaluate, i) for i in indices]
+        pbar = tqdm(as_completed(futures), total=len(futures))
+        for future in pbar:
+            i, succeed, result = future.result()
+            data[i] = result
+            n_total += 1
+            n_succeed += succeed
+            pbar.set_postfix_str(f'succeed: {n_succeed / n_total:.0%} ({n_succeed}/{n_total})', refresh=False)
+    print(f'Finish: {n_succeed} of {n_total} re-evaluated dialogs succeed.')
+
+
+def save_logs_and_summary(data, log_file, score_table_file):
+    run_log = RunLog.create(log_file, data[0], summarize_result)
+    for item in data[1:]:
+        run_log.append(item)
+    print(f'Saved to "{log_file}".')
 
     metric_tracker = MetricTracker()
     for item in data[1:]:
         if item['status'] == 'succeed':
             metric_tracker.add_dialog_eval_results(item['dialog_id'], item['eval_results'])
             metric_tracker.add_cost(item['dialog_id'], item['cost'])
+            summary = summarize_result(item)
+            metric_tracker.add_usage(item['dialog_id'], summary['usage'], summary['n_turns'], summary['latency'])
 
-    # Step 6. Summary
-    summary = metric_tracker.generate_summary_tables()
-    with open(updated_score_table_file, 'w') as f:
+    summary = metric_tracker.generate_all_tables()
+    with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
 
 
+def load_logs_for_evaluation(log_file, output_files, mode):
+    for path in output_files:
+        if os.path.exists(path):
+            raise RuntimeError(f'mode = {mode} and {path = } exists.')
+    if not os.path.exists(log_file):
+        raise RuntimeError(f'mode = {mode} and {log_file = } does not exist.')
+
+    run_log = open_run_log(log_file, summarize_result)
+    data = [run_log.header, *run_log.records()]
+    print(f'Loaded {len(data) - 1} dialogs from "{log_file}".')
+
+    # Dialogs failed on run, or logged without callings, can not be evaluated
+    evaluable = [i for i, item in enumerate(data[1:], start=1)
+                 if isinstance(item.get('run_result'), list) and item.get('callings') is not None]
+    if n_skip := len(data) - 1 - len(evaluable):
+        cprint(f'{n_skip} dialogs failed on run or without callings are skipped.', 'red')
+    return data, evaluable
+
+
+@batch_run.command('evaluate')
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--evaluated_log_file', default='logs_evaluated.jsonl')
+@click.option('--evaluated_score_table_file', default='logs_evaluated_table.md')
+@click.option('--dialog_ids', default=None, help='Comma separated dialog ids. Default: the dialogs failed on evaluation.')
+@click.option('--data_dir', default=DATA_DIR)
+@click.option('--workers', type=int, default=4)
+def evaluate_logs(log_file, evaluated_log_file, evaluated_score_table_file, dialog_ids, data_dir, workers):
+    '''Re-evaluate the failed or selected dialogs of the log from their run results.'''
+    # Step 1. Load
+    data, evaluable = load_logs_for_evaluation(log_file, [evaluated_log_file, evaluated_score_table_file], 'evaluate')
+    dialogs = load_dialog_store(data_dir)
+
+    # Step 2. Select
+    if dialog_ids:
+        dialog_ids = set(dialog_ids.split(','))
+        indices = [i for i in evaluable if data[i]['dialog_id'] in dialog_ids]
+        if missing := dialog_ids - {data[i]['dialog_id'] for i in indices}:
+            cprint(f'Skip dialogs not found or not evaluable: {", ".join(sorted(missing))}', 'red')
+    else:
+        indices = [i for i in evaluable if data[i]['status'] != 'succeed']
+    print(f'Evaluate {len(indices)} dialogs.')
+
+    # Step 3. Evaluate
+    reevaluate_logs(data, indices, dialogs, workers)
+    save_logs_and_summary(data, evaluated_log_file, evaluated_score_table_file)
+
+
+@batch_run.command()
+@click.option('--log_file', default='logs.jsonl')
+@click.option('--rescored_log_file', default='logs_rescored.jsonl')
+@click.option('--rescored_score_table_file', default='logs_rescored_table.md')
+@click.option('--data_dir', default=DATA_DIR)
+@click.option('--judge_cache_path', default=JUDGE_CACHE_PATH)
+@click.option('--workers', type=int, default=4)
+def re_score(log_file, rescored_log_file, rescored_score_table_file, data_dir, judge_cache_path, workers):
+    '''Re-score the logs with the current evaluator and the cached judge answers only.'''
+    data, evaluable = load_logs_for_evaluation(log_file, [rescored_log_file, rescored_score_table_file], 're-score')
+    dialogs = load_dialog_store(data_dir)
+    load_judge_cache(judge_cache_path, replay_only=True)
+
+    # The replayed answers cost nothing now, so keep the judge cost paid in the run of the log
+    reevaluate_logs(data, evaluable, dialogs, workers, keep_cost=True)
+    save_logs_and_summary(data, rescored_log_file, rescored_score_table_file)
+
+
 if __name__ == '__main__':
     batch_run()
@@ -0,0 +1,207 @@
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+import sqlite3
+import time
+
+import click
+
+from sgd.dialog_store import list_dialog_files
+from sgd.function_schema import detect_field_data_type, record_key, save_field_data_type
+from sgd.functions import check_info_indexes, create_info_indexes, quote_identifier, to_sql_value
+from sgd.utils import DATA_DIR, FIELD_DATA_TYPE_PATH, INFO_DB_PATH, TRANS_DB_PATH, compile_service, read_schemas
+
+DB_TYPES = {'integer': 'INTEGER', 'number': 'REAL', 'boolean': 'TEXT', 'string': 'TEXT'}
+
+
+def collect_file_records(path, transactional, services=None):
+    '''Deduplicated service results of one dialog file: service -> record key -> record.
+
+    `transactional` is service -> intent -> whether the intent is transactional, of the schemas of the data dir.
+    '''
+    with open(path) as f:
+        dialogs = json.load(f)
+
+    info_tables, trans_tables = defaultdict(dict), defaultdict(dict)
+    for dialog in dialogs:
+        for turn in dialog['turns']:
+            if turn['speaker'] != 'SYSTEM':
+                continue
+            for frame in turn['frames']:
+                if 'service_results' not in frame:
+                    continue
+                service_name = frame['service']
+                if services and service_name not in services:
+                    continue
+                if transactional[service_name][frame['service_call']['method']]:
+                    tables = trans_tables
+                else:
+                    tables = info_tables
+                for result in frame['service_results']:
+                    tables[service_name].setdefault(record_key(result), result)
+
+    return dict(info_tables), dict(trans_tables)
+
+
+def collect_records(data_dir, transactional, services=None, workers=1):
+    paths = [os.path.join(data_dir, file) for file in list_dialog_files(data_dir)]
+    transactional_args = [transactional] * len(paths)
+    services_args = [services] * len(paths)
+    if workers > 1:
+        with ProcessPoolExecutor(workers) as executor:
+            file_results = list(executor.map(collect_file_records, paths, transactional_args, services_args, chunksize=4))
+    else:
+        file_results = list(map(collect_file_records, paths, transactional_args, services_args))
+
+    info_tables, trans_tables = defaultdict(dict), defaultdict(dict)
+    for file_info_tables, file_trans_tables in file_results:
+        for tables, file_tables in [(info_tables, file_info_tables), (trans_tables, file_trans_tables)]:
+            for service_name, records in file_tables.items():
+                table = tables[service_name]
+                for key, record in records.items():
+                    table.setdefault(key, record)
+
+    return info_tables, trans_tables
+
+
+def get_info_fields(schema):
+    '''Slots stored in the info table: all slots except those only used by transactional intents.'''
+    query_slots, trans_slots = set(), set()
+    for intent in schema['intents']:
+        slots = query_slots if not intent['is_transactional'] else trans_slots
+        slots.update(intent['required_slots'])
+        slots.update(intent['optional_slots'].keys())
+        slots.update(intent['result_slots'])
+    trans_slots -= query_slots
+    return [slot['name'] for slot in schema['slots'] if slot['name'] not in trans_slots]
+
+
+def apply_type(value, db_type):
+    if db_type == 'INTEGER':
+        return int(value)
+    if db_type == 'REAL':
+        return float(value)
+    return to_sql_value(value)
+
+
+def create_info_tables(conn, schemas, info_tables, info_data_type):
+    for service_name, schema in schemas.items():
+        table = quote_identifier(service_name)
+        fields = get_info_fields(schema)
+        types = {field: DB_TYPES[info_data_type[service_name][field]] for field in fields}
+
+        columns = ['id INTEGER PRIMARY KEY']
+        columns += [f'{quote_identifier(field)} {types[field]} COLLATE NOCASE' for field in fields]
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.execute(f'CREATE TABLE {table} ({", ".join(columns)})')
+
+        records = info_tables.get(service_name, {}).values()
+        rows = ([apply_type(record[field], types[field]) if field in record else None for field in fields]
+                for record in records)
+        fields_str = ', '.join(quote_identifier(field) for field in fields)
+        value_syms = ', '.join(['?'] * len(fields))
+        conn.executemany(f'INSERT INTO {table} ({fields_str}) VALUES ({value_syms})', rows)
+
+
+def create_trans_tables(conn, schemas, field_data_type):
+    for service_name, schema in schemas.items():
+        table = quote_identifier(f'{service_name}_Transaction')
+        columns = ['id INTEGER PRIMARY KEY']
+        for slot in schema['slots']:
+            db_type = DB_TYPES[field_data_type[service_name][slot['name']]]
+            columns.append(f'{quote_identifier(slot["name"])} {db_type} COLLATE NOCASE')
+        columns.append('refer_number TEXT COLLATE NOCASE')
+        conn.execute(f'DROP TABLE IF EXISTS {table}')
+        conn.execute(f'CREATE TABLE {table} ({", ".join(columns)})')
+
+
+def build_db(data_dir=DATA_DIR, info_db_path=INFO_DB_PATH, trans_db_path=TRANS_DB_PATH,
+             field_data_type_path=FIELD_DATA_TYPE_PATH, services=None, workers=1):
+    '''Build the info DB, the transaction DB and the field data type cache.
+
+    With `services`, only the tables of these services are rebuilt in the existing DBs.
+    '''
+    # The schemas of the data dir, not those loaded on import from the default data dir
+    schemas = read_schemas(data_dir)
+    registry = {name: compile_service(schema) for name, schema in schemas.items()}
+    transactional = {name: service['transactional'] for name, service in registry.items()}
+    if services:
+        assert all(name in schemas for name in services), f'Unknown services in {services}'
+        schemas = {name: schemas[name] for name in services}
+    start = time.time()
+
+    # Step 1. Collect records
+    info_tables, trans_tables = collect_records(data_dir, transactional, services, workers)
+    n_records = sum(len(table) for table in info_tables.values())
+    print(f'Collected {n_records} info records of {len(info_tables)} services in {time.time() - start:.1f}s.')
+
+    # Step 2. Data types
+    all_tables = defaultdict(list)
+    for service_name in schemas:
+        info_records = info_tables.get(service_name, {})
+        all_tables[service_name] = list(info_records.values())
+        all_tables[service_name] += [r for k, r in trans_tables.get(service_name, {}).items() if k not in info_records]
+    info_only_tables = defaultdict(list, {name: list(table.values()) for name, table in info_tables.items()})
+    field_data_type = detect_field_data_type(all_tables, schemas)
+    info_data_type = detect_field_data_type(info_only_tables, schemas)
+
+    if services and os.path.exists(field_data_type_path):
+        with open(field_data_type_path) as f:
+            field_data_type = {**json.load(f)['field_data_type'], **field_data_type}
+    save_field_data_type(field_data_type, data_dir, field_data_type_path)
+
+    # Step 3. Info DB: bulk insert in one transaction, then index and analyze
+    os.makedirs(os.path.dirname(info_db_path), exist_ok=True)
+    db_path = info_db_path if services else info_db_path + '.tmp'
+    if not services and os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        create_info_tables(conn, schemas, info_tables, info_data_type)
+    conn.close()
+    built_registry = {name: registry[name] for name in schemas}
+    create_info_indexes(db_path, built_registry)
+    check_info_indexes(db_path, built_registry)
+    conn = sqlite3.connect(db_path)
+    conn.execute('ANALYZE')
+    conn.close()
+    if not services:
+        os.replace(db_path, info_db_path)
+    print(f'Info DB saved to "{info_db_path}" in {time.time() - start:.1f}s.')
+
+    # Step 4. Transaction DB: in a temp file as well, unless only some tables are rebuilt
+    os.makedirs(os.path.dirname(trans_db_path), exist_ok=True)
+    db_path = trans_db_path if services else trans_db_path + '.tmp'
+    if not services and os.path.exists(db_path):
+        os.remove(db_path)
+    conn = sqlite3.connect(db_path)
+    with conn:
+        create_trans_tables(conn, schemas, field_data_type)
+    conn.close()
+    if not services:
+        os.replace(db_path, trans_db_path)
+    print(f'Transaction DB saved to "{trans_db_path}" in {time.time() - start:.1f}s.')
+
+
+@click.command()
+@click.option('--data_dir', default=DATA_DIR)
+@click.option('--info_db_path', default=INFO_DB_PATH)
+@click.option('--trans_db_path', default=TRANS_DB_PATH)
+@click.option('--field_data_type_path', default=FIELD_DATA_TYPE_PATH)
+@click.option('--services', default=None, help='Comma separated services. Only rebuild their tables.')
+@click.option('--workers', type=int, default=os.cpu_count())
+@click.option('--overwrite', is_flag=True)
+def build(data_dir, info_db_path, trans_db_path, field_data_type_path, services, workers, overwrite):
+    # Step 0. Check
+    services = services.split(',') if services else None
+    if not services and not overwrite:
+        for path in [info_db_path, trans_db_path]:
+            if os.path.exists(path):
+                raise RuntimeError(f'{path = } exists. Use --overwrite to rebuild the whole DB.')
+
+    build_db(data_dir, info_db_path, trans_db_path, field_data_type_path, services, workers)
+
+
+if __name__ == '__main__':
+    build()
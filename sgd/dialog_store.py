@@ -0,0 +1,188 @@
+from collections.abc import Mapping
+import hashlib
+import json
+import os
+import random
+import re
+
+import click
+
+from sgd.utils import DATA_DIR, SPLITS
+
+DIALOG_INDEX_VERSION = 1
+DIALOG_INDEX_NAME = 'dialog_index.json'
+DIALOG_INDEX_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'autotod', 'sgd')
+
+WHITESPACE = re.compile(r'\s*')
+
+
+def iter_json_array(text):
+    '''Yield (item, start, end) for each top-level item of a json array string.'''
+    decoder = json.JSONDecoder()
+    pos = WHITESPACE.match(text, 0).end()
+    assert text[pos] == '[', f'Expect a json array, got {text[pos]!r}'
+    pos = WHITESPACE.match(text, pos + 1).end()
+    while text[pos] != ']':
+        item, end = decoder.raw_decode(text, pos)
+        yield item, pos, end
+        pos = WHITESPACE.match(text, end).end()
+        if text[pos] == ',':
+            pos = WHITESPACE.match(text, pos + 1).end()
+
+
+def list_dialog_files(data_dir=DATA_DIR):
+    files = []
+    for split in SPLITS:
+        names = sorted(name for name in os.listdir(os.path.join(data_dir, split)) if name.startswith('dialogues_'))
+        files += [os.path.join(split, name) for name in names]
+    return files
+
+
+def stat_file(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def get_dialog_index_path(data_dir=DATA_DIR):
+    '''The index in the data dir, or in the cache dir if the data dir is not writable, e.g. a read-only checkout.'''
+    if os.access(data_dir, os.W_OK):
+        return os.path.join(data_dir, DIALOG_INDEX_NAME)
+    key = hashlib.sha256(os.path.abspath(data_dir).encode()).hexdigest()[:16]
+    return os.path.join(DIALOG_INDEX_CACHE_DIR, f'dialog_index_{key}.json')
+
+
+def build_dialog_index(data_dir=DATA_DIR, index_path=None):
+    '''Scan the dialog files once and save dialog id -> (file, byte offset, byte length, services, #turns).'''
+    index_path = index_path or get_dialog_index_path(data_dir)
+
+    files = {}
+    dialogs = {}
+    for file in list_dialog_files(data_dir):
+        path = os.path.join(data_dir, file)
+        with open(path, 'rb') as f:
+            raw = f.read()
+        text = raw.decode('utf-8')
+        is_ascii = len(text) == len(raw)
+
+        byte_pos, char_pos = 0, 0
+        for dialog, start, end in iter_json_array(text):
+            if is_ascii:
+                offset, length = start, end - start
+            else:
+                byte_pos += len(text[char_pos:start].encode('utf-8'))
+                length = len(text[start:end].encode('utf-8'))
+                offset = byte_pos
+                byte_pos += length
+                char_pos = end
+            split = file.split(os.sep)[0]
+            dialog_id = split + '_' + dialog['dialogue_id']
+            dialogs[dialog_id] = [file, offset, length, dialog['services'], len(dialog['turns'])]
+
+        files[file] = stat_file(path)
+
+    index = {'version': DIALOG_INDEX_VERSION, 'files': files, 'dialogs': dialogs}
+    os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+    print(f'Dialog index of {len(dialogs)} dialogs saved to "{index_path}".')
+    return index
+
+
+def is_index_fresh(index, data_dir=DATA_DIR):
+    if index.get('version') != DIALOG_INDEX_VERSION:
+        return False
+    files = list_dialog_files(data_dir)
+    if set(files) != set(index['files']):
+        return False
+    return all(stat_file(os.path.join(data_dir, file)) == index['files'][file] for file in files)
+
+
+class DialogStore(Mapping):
+    '''Read-only mapping of dialog id -> dialog, loading each dialog from its file on demand.'''
+
+    def __init__(self, data_dir, index):
+        self.data_dir = data_dir
+        self.index = index['dialogs']
+
+    def __getitem__(self, dialog_id):
+        file, offset, length, _, _ = self.index[dialog_id]
+        with open(os.path.join(self.data_dir, file), 'rb') as f:
+            f.seek(offset)
+            raw = f.read(length)
+        dialog = json.loads(raw)
+        dialog['dialogue_id'] = dialog_id
+        return dialog
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, dialog_id):
+        return dialog_id in self.index
+
+    def get_services(self, dialog_id):
+        return self.index[dialog_id][3]
+
+    def get_n_turns(self, dialog_id):
+        return self.index[dialog_id][4]
+
+    def filter(self, services=None, match='any', splits=None):
+        '''Return the dialog ids with any/all of the services, without loading any dialog.'''
+        assert match in ['any', 'all']
+        services = set(services) if services else None
+        dialog_ids = []
+        for dialog_id, (file, _, _, dialog_services, _) in self.index.items():
+            if splits and file.split(os.sep)[0] not in splits:
+                continue
+            if services:
+                hits = services.intersection(dialog_services)
+                if match == 'any' and not hits:
+                    continue
+                if match == 'all' and hits != services:
+                    continue
+            dialog_ids.append(dialog_id)
+        return dialog_ids
+
+    def sample(self, n, services=None, match='any', splits=None):
+        dialog_ids = self.filter(services, match, splits)
+        return random.sample(dialog_ids, min(n, len(dialog_ids)))
+
+
+dialog_store = None
+
+
+def load_dialog_store(data_dir=DATA_DIR, index_path=None):
+    global dialog_store
+
+    if dialog_store is not None:
+        return dialog_store
+
+    index_path = index_path or get_dialog_index_path(data_dir)
+    index = None
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if not is_index_fresh(index, data_dir):
+            print(f'Dialog index "{index_path}" is stale. Rebuilding...')
+            index = None
+    else:
+        print(f'Dialog index "{index_path}" not found. Building...')
+
+    if index is None:
+        index = build_dialog_index(data_dir, index_path)
+
+    dialog_store = DialogStore(data_dir, index)
+    return dialog_store
+
+
+@click.command()
+@click.option('--data_dir', default=DATA_DIR)
+@click.option('--index_path', default=None)
+def build(data_dir, index_path):
+    build_dialog_index(data_dir, index_path)
+
+
+if __name__ == '__main__':
+    build()
@@ -1,16 +1,21 @@
 from callback import AgentUtterTrimCallback, CostCallback, FunctionCallCollectCallback
 from engine import run_with_user_agent
+from event_bus import CallbackBus
 from sgd.agent import SgdAgent
 from sgd.user import SgdUser
 
 
 def run(dialog, model_name='gpt-3.5-turbo-0613', max_iter=15, save_prompts=False):
-    cost_callback = CostCallback()
+    user_cost_callback = CostCallback()
+    agent_cost_callback = CostCallback()
     trim_callback = AgentUtterTrimCallback()
     func_callback = FunctionCallCollectCallback()
 
-    user = SgdUser(dialog, model_name, callbacks=[cost_callback])
-    agent = SgdAgent(model_name, dialog['services'], callbacks=[cost_callback, trim_callback, func_callback])
+    user_bus = CallbackBus([user_cost_callback])
+    agent_bus = CallbackBus([agent_cost_callback, trim_callback, func_callback])
+
+    user = SgdUser(dialog, model_name, callbacks=[user_bus])
+    agent = SgdAgent(model_name, dialog['services'], callbacks=[agent_bus])
 
     if save_prompts:
         with open('agent_prompt.txt', 'w') as f:
@@ -18,5 +23,12 @@ def run(dialog, model_name='gpt-3.5-turbo-0613', max_iter=15, save_prompts=False
         with open('user_prompt.txt', 'w') as f:
             f.write(user.prompt)
 
-    logs = run_with_user_agent(user, agent, max_iter=max_iter)
-    return logs, cost_callback.cost, func_callback.callings
+    wall_time = {'user': 0.0, 'agent': 0.0}
+    logs = run_with_user_agent(user, agent, max_iter=max_iter, wall_time=wall_time)
+    user_bus.flush()
+    agent_bus.flush()
+    user_cost_callback.usage['wall_time'] += wall_time['user']
+    agent_cost_callback.usage['wall_time'] += wall_time['agent']
+    usage = {'user': user_cost_callback.usage, 'agent': agent_cost_callback.usage}
+    cost = user_cost_callback.cost + agent_cost_callback.cost
+    return logs, cost, func_callback.callings, usage
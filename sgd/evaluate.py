@@ -1,17 +1,21 @@
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import json
-import sqlite3
 
 import openai
 import tenacity
 from termcolor import cprint
 
-from evaluate import ANSWER_FORMAT_TEMPLATE, HUMAN_TEMPLATE, SYSTEM_PROMPT
+from evaluate import (ANSWER_FORMAT_TEMPLATE, FUNCTION_ANSWER_FORMAT, HUMAN_TEMPLATE,
+                      judge_completion, make_answer_properties, make_answer_schema)
+from model_registry import supports_function_call
+from sgd.functions import build_info_query, get_db_conn, quote_identifier
 from sgd.user import prepare_goals_str
-from sgd.utils import INFO_DB_PATH, load_schemas
-from utils import calc_openai_cost, tenacity_retry_log
+from sgd.utils import INFO_DB_PATH, load_registry
+from tracing import in_current_context
+from utils import tenacity_retry_log
 
-schemas = load_schemas()
+registry = load_registry()
 
 def extract_user_goals_canonical(dialog):
     goals = OrderedDict()
@@ -85,26 +89,25 @@ def prepare_log_dialog_str(logs):
     return dialog_str
 
 
-def prepare_questions_and_answer_formarts(goals):
+def prepare_questions_and_answer_formarts(goals, join=True):
     questions = []
     answer_formats = []
     q_idx = 1
 
     for service_name, service in goals.items():
+        intent_descs = registry[service_name]['intent_descs']
+        slot_descs = registry[service_name]['slot_descs']
         for intent_name, intent in service.items():
-            intent_dict = {it['name']: it for it in schemas[service_name]['intents']}
-            slot_dict = {it['name']: it for it in schemas[service_name]['slots']}
             for slot in intent['request']:
-                intent_desc = intent_dict[intent_name]['description']
-                intent_desc = intent_desc[0].lower() + intent_desc[1:]
-
-                slot_desc = slot_dict[slot]['description']
-                slot_desc = slot_desc[0].lower() + slot_desc[1:]
+                intent_desc = intent_descs[intent_name]
+                slot_desc = slot_descs[slot]
 
                 questions.append(f'{q_idx}. When the user {intent_desc}, what is the {slot_desc}?')
                 answer_formats.append(f'"{service_name} {slot}": "<fill the answer of question {q_idx}>"')
                 q_idx += 1
 
+    if not join:
+        return questions, answer_formats
 
     questions = '\n'.join(questions)
 
@@ -115,12 +118,19 @@ def prepare_questions_and_answer_formarts(goals):
     return questions, answer_formats
 
 
+def prepare_answer_schema(goals):
+    questions, answer_formats = prepare_questions_and_answer_formarts(goals, join=False)
+    return make_answer_schema(make_answer_properties(questions, answer_formats))
+
+
 @tenacity.retry(wait=tenacity.wait_exponential(min=2, max=60),
                 stop=tenacity.stop_after_attempt(8),
                 reraise=True,
                 before_sleep=tenacity_retry_log,
                 retry=tenacity.retry_if_exception_type((openai.OpenAIError, json.JSONDecodeError)))
-def request_slots_llm_qa(goals_str, dialog_str, questions, answer_formats, model_name):
+def request_slots_llm_qa(goals_str, dialog_str, questions, answer_formats, model_name, answer_schema=None):
+    if answer_schema is not None and supports_function_call(model_name):
+        answer_formats = FUNCTION_ANSWER_FORMAT
     human_prompt = HUMAN_TEMPLATE.format(
         goals=goals_str, 
         dialog=dialog_str, 
@@ -128,77 +138,68 @@ def request_slots_llm_qa(goals_str, dialog_str, questions, answer_formats, model
         answer_formats=answer_formats,
     )
 
-    completion = openai.ChatCompletion.create(
-        model=model_name,
-        temperature=0,
-        request_timeout=10,
-        messages=[{"role": "system", "content": SYSTEM_PROMPT},
-                  {"role": "user", "content": human_prompt}],
-    )
-    cost = calc_openai_cost(model_name, completion['usage'])
-    result_origin = completion['choices'][0]['message']['content']
-
-    # Clean json string
-    def clean_json_string(text):
-        text = text.strip('`')
-        if (pos := text.find('```')) > -1:
-            text = text[:pos]
-        return text
-    result_cleann = clean_json_string(result_origin)
-
-    llm_answer = json.loads(result_cleann)
+    llm_answer, cost, usage = judge_completion(human_prompt, model_name, answer_schema)
 
     # Clean
     llm_answer2 = {}
     for k, v in llm_answer.items():
-        if k.endswith('price') and v.startswith('$'):
+        if k.endswith('price') and isinstance(v, str) and v.startswith('$'):
             llm_answer2[k] = v.lstrip('$')
         else:
             llm_answer2[k] = v
     llm_answer = llm_answer2
 
-    return llm_answer, cost
+    return llm_answer, cost, usage
 
 # endregion
 
 # region: Success: match
 
-def sgd_function_info(service_name, intent, args, db_path=INFO_DB_PATH):
-    fields = ', '.join(f'"{field}"' for field in intent['result_slots'])
-    sql = f'SELECT {fields} FROM {service_name}'
-    if args:
-        conditions = ' AND '.join(f'"{k}" = "{v}"' for k, v in args.items())
-        sql += f' WHERE {conditions}'
-
-    conn = sqlite3.connect(db_path)
-    cursor = conn.execute(sql)
-
-    slots = [desc[0] for desc in cursor.description]
-    records = []
-    for item in cursor:
-        record = {slot: value for slot, value in zip(slots, item)}
-        records.append(record)
-
-    conn.close()
-    return records
-
+def query_satisfying(service_name, intent, args, slot_values, db_path=INFO_DB_PATH):
+    '''Whether any record returned by calling the intent with args has the slot values.
+
+    A record satisfies the slot values if `str(value).lower()` is equal for every slot,
+    where a slot missing from the record has the value None. The check runs in SQL.
+    '''
+    sql, params = build_info_query(service_name, intent['result_slots'], args)
+
+    conditions = []
+    for slot, value in slot_values.items():
+        value = str(value)
+        column = quote_identifier(slot)
+        if slot not in intent['result_slots']:
+            conditions.append('1' if value.lower() == 'none' else '0')
+        elif value.lower() == 'none':
+            conditions.append(f'({column} IS NULL OR CAST({column} AS TEXT) = ? COLLATE NOCASE)')
+            params.append(value)
+        else:
+            conditions.append(f'CAST({column} AS TEXT) = ? COLLATE NOCASE')
+            params.append(value)
+    if conditions:
+        sql += (' AND ' if args else ' WHERE ') + ' AND '.join(conditions)
+    sql += ' LIMIT 1'
 
-def record_satisfying(record, slot_values):
-    for k, v in slot_values.items():
-        v = str(v).lower()
-        vv = record.get(k)
-        vv = str(vv).lower()
-        if v != vv:
-            return False
-    return True
+    conn = get_db_conn(db_path)
+    return conn.execute(sql, params).fetchone() is not None
 
 
-def check_success(service_name, intent, callings, slot_values):
+def check_success(service_name, intent, callings, slot_values, cache=None, db_path=INFO_DB_PATH):
+    cache = {} if cache is None else cache
+    slot_values_key = json.dumps(slot_values, sort_keys=True, default=str)
+    checked_args = set()
     for call in callings:
-        if call['name'].startswith(service_name):
-            records = sgd_function_info(service_name, intent, call['args'])
-            if any(record_satisfying(record, slot_values) for record in records):
-                return True
+        if not call['name'].startswith(service_name):
+            continue
+        args_key = json.dumps(call['args'], sort_keys=True, default=str)
+        if args_key in checked_args:
+            continue
+        checked_args.add(args_key)
+
+        key = (service_name, intent['name'], args_key, slot_values_key)
+        if key not in cache:
+            cache[key] = query_satisfying(service_name, intent, call['args'], slot_values, db_path)
+        if cache[key]:
+            return True
     return False
 
 
@@ -208,6 +209,7 @@ def make_request_eval_result(llm_answer, gold_goals, callings):
         print(f'{k}: {v}')
     print()
     result = {}
+    cache = {}  # (service, intent, args, slot values) -> satisfying, for this dialog
     for service_name, service in gold_goals.items():
         result[service_name] = {}
         for intent_name, intent_goals in service.items():
@@ -215,9 +217,8 @@ def make_request_eval_result(llm_answer, gold_goals, callings):
                 result[service_name][intent_name] = None
                 continue
             slot_values = {slot: llm_answer.get(f'{service_name} {slot}') for slot in intent_goals['request']}
-            intent_dict = {it['name']: it for it in schemas[service_name]['intents']}
-            intent = intent_dict[intent_name]
-            success = check_success(service_name, intent, callings, slot_values)
+            intent = registry[service_name]['intents'][intent_name]
+            success = check_success(service_name, intent, callings, slot_values, cache)
             result[service_name][intent_name] = int(success)
     return result
 
@@ -232,20 +233,24 @@ def evaluate_request(dialog, logs, callings, model_name='gpt-3.5-turbo-0613'):
 
     gold_goals = extract_user_goals_canonical(dialog)
     questions, answer_formats = prepare_questions_and_answer_formarts(gold_goals)
+    answer_schema = prepare_answer_schema(gold_goals)
 
-    llm_answer, cost = request_slots_llm_qa(goals_str, dialog_str, questions, answer_formats, model_name)
+    llm_answer, cost, usage = request_slots_llm_qa(goals_str, dialog_str, questions, answer_formats, model_name, answer_schema)
 
     result = make_request_eval_result(llm_answer, gold_goals, callings)
 
-    return result, cost
+    return result, cost, usage
 
 # endregion
 
 # region: Evaluation (Inform & Success)
 
 def evaluate(dialog, logs, callings):
-    inform_result = evaluate_inform(dialog, callings)
-    success_result, cost = evaluate_request(dialog, logs, callings)
+    # The inform check runs while the request judge call and its DB checks are in flight.
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        request_future = executor.submit(in_current_context(evaluate_request), dialog, logs, callings)
+        inform_result = evaluate_inform(dialog, callings)
+        success_result, cost, usage = request_future.result()
     
     eval_result = {}
     gold_goals = extract_user_goals_canonical(dialog)
@@ -259,7 +264,7 @@ def evaluate(dialog, logs, callings):
             intent_result['inform'] = int(inform)
             intent_result['success'] = success if success is None else int(inform and success)
 
-    return eval_result, cost
+    return eval_result, cost, usage
 
 # endregion
 
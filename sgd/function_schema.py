@@ -1,8 +1,17 @@
 from collections import defaultdict
+import copy
+from functools import lru_cache
+import json
 import os
-from sgd.utils import load_schemas, load_dialogs
+
+import click
+
+from sgd.utils import DATA_DIR, FIELD_DATA_TYPE_PATH, load_dialogs, load_registry, load_schemas, schema_checksum
+
+FIELD_DATA_TYPE_VERSION = 1
 
 schemas = load_schemas()
+registry = load_registry()
 
 
 def collect_db_records(dialogs):
@@ -20,13 +29,29 @@ def collect_db_records(dialogs):
 
     # Deduplication
     for name, table in tables.items():
-        d = {str(a): a for a in table}
-        tables[name] = list(d.values())
+        tables[name] = dedup_records(table)
 
     return tables
 
 
-def detect_field_data_type(tables):
+def record_key(record):
+    return tuple(sorted(record.items()))
+
+
+def dedup_records(records):
+    seen = set()
+    unique_records = []
+    for record in records:
+        key = record_key(record)
+        if key not in seen:
+            seen.add(key)
+            unique_records.append(record)
+    return unique_records
+
+
+def detect_field_data_type(tables, service_schemas=None):
+    '''Data type of each slot of each service: the schemas loaded on import unless `service_schemas` is given.'''
+    service_schemas = schemas if service_schemas is None else service_schemas
 
     def is_float(string):
         try:
@@ -36,7 +61,7 @@ def detect_field_data_type(tables):
             return False
 
     field_data_type = defaultdict(dict)  # service -> field -> type
-    for service_name, schema in schemas.items():
+    for service_name, schema in service_schemas.items():
         table = tables[service_name]
         for slot in schema['slots']:
             field = slot['name']
@@ -52,22 +77,62 @@ def detect_field_data_type(tables):
     return field_data_type
 
 
-def get_field_data_type():
-    # file_name = os.path.basename(__file__)
-    # print(f'{file_name}: Temporary load dialogs for detecting field type.')
-    dialogs = load_dialogs()
+def get_field_data_type(data_dir=DATA_DIR):
+    dialogs = load_dialogs(data_dir)
     tables = collect_db_records(dialogs)
     field_data_type = detect_field_data_type(tables)
     return field_data_type
 
 
-field_data_type = get_field_data_type()
+def build_field_data_type(data_dir=DATA_DIR, output_path=FIELD_DATA_TYPE_PATH):
+    '''Scan all dialogs once and persist the detected field types with the schema checksum.'''
+    field_data_type = get_field_data_type(data_dir)
+    save_field_data_type(field_data_type, data_dir, output_path)
+    return field_data_type
+
+
+def save_field_data_type(field_data_type, data_dir=DATA_DIR, output_path=FIELD_DATA_TYPE_PATH):
+    artifact = {
+        'version': FIELD_DATA_TYPE_VERSION,
+        'schema_checksum': schema_checksum(data_dir),
+        'field_data_type': field_data_type,
+    }
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(artifact, f, indent=2)
+    print(f'Field data types of {len(field_data_type)} services saved to "{output_path}".')
+
+
+field_data_type = None
+
+
+def load_field_data_type(data_dir=DATA_DIR, path=FIELD_DATA_TYPE_PATH):
+    global field_data_type
+
+    if field_data_type is not None:
+        return field_data_type
+
+    if os.path.exists(path):
+        with open(path) as f:
+            artifact = json.load(f)
+        if artifact.get('version') != FIELD_DATA_TYPE_VERSION:
+            print(f'Field data type cache "{path}" is outdated (version {artifact.get("version")}). Rebuilding...')
+        elif artifact.get('schema_checksum') != schema_checksum(data_dir):
+            print(f'Field data type cache "{path}" does not match the schema files. Rebuilding...')
+        else:
+            field_data_type = artifact['field_data_type']
+            return field_data_type
+    else:
+        print(f'Field data type cache "{path}" not found. Building...')
+
+    field_data_type = build_field_data_type(data_dir, path)
+    return field_data_type
 
 
 def make_one_function_schema(service_schema, intent_name):
     service_name = service_schema['service_name']
-    intent_dict = {intent['name']: intent for intent in service_schema['intents']}
-    intent = intent_dict[intent_name]
+    service = registry[service_name]
+    intent = service['intents'][intent_name]
 
     func_schema = {
         'name': f'{service_name}_{intent_name}',
@@ -80,20 +145,20 @@ def make_one_function_schema(service_schema, intent_name):
     }
 
     desc = intent['description'] + '.'
-    if not intent['is_transactional']:
+    if not service['transactional'][intent_name]:
         desc += ' (Query function. Return db recored that meets conditions.)'
     else:
         desc += ' (Transaction function. Return a reference number when calling succeeds.)'
     func_schema['description'] = desc
 
-    slot_dict = {slot['name']: slot for slot in service_schema['slots']}
     for slot_name in intent['required_slots'] + list(intent['optional_slots'].keys()):
-        slot = slot_dict[slot_name]
+        slot = service['slots'][slot_name]
 
         # Apply data type
         service_name = service_schema['service_name']
-        if slot_name in field_data_type[service_name]:
-            field_type = field_data_type[service_name][slot_name]
+        service_field_type = load_field_data_type().get(service_name, {})
+        if slot_name in service_field_type:
+            field_type = service_field_type[slot_name]
         elif set(slot['possible_values']) == {'True', 'False'}:
             field_type = 'boolean'
         else:
@@ -121,11 +186,35 @@ def make_one_function_schema(service_schema, intent_name):
     return func_schema
 
 
+@lru_cache(maxsize=None)
+def build_service_function_schemas(service_name):
+    '''Function schemas of all intents of one service, built once and shared by all agents.'''
+    service_schema = schemas[service_name]
+    functions = []
+    for intent in service_schema['intents']:
+        func_schema = make_one_function_schema(service_schema, intent['name'])
+        functions.append(func_schema)
+    return tuple(functions)
+
+
+def make_service_function_schemas(service_name):
+    '''A copy of the shared function schemas of the service, which the caller may modify.'''
+    return copy.deepcopy(build_service_function_schemas(service_name))
+
+
 def make_function_schemas(service_name_list):
     functions = []
     for service_name in service_name_list:
-        service_schema = schemas[service_name]
-        for intent in service_schema['intents']:
-            func_schema = make_one_function_schema(service_schema, intent['name'])
-            functions.append(func_schema)
+        functions += make_service_function_schemas(service_name)
     return functions
+
+
+@click.command()
+@click.option('--data_dir', default=DATA_DIR)
+@click.option('--output_path', default=FIELD_DATA_TYPE_PATH)
+def build(data_dir, output_path):
+    build_field_data_type(data_dir, output_path)
+
+
+if __name__ == '__main__':
+    build()
@@ -1,26 +1,28 @@
 import random
 import sqlite3
+import threading
 
-from sgd.utils import INFO_DB_PATH, TRANS_DB_PATH, load_schemas
+from sgd.utils import INFO_DB_PATH, TRANS_DB_PATH, load_registry
 
-schemas = load_schemas()
+registry = load_registry()
+
+db_conns = threading.local()
 
 
 def sgd_function_check(service_name, intent_name, args):
-    if service_name not in schemas:
+    if service_name not in registry:
         return False, f'Service "{service_name}" does not exist.'
-    schema = schemas[service_name]
+    service = registry[service_name]
 
-    intent_dict = {intent['name']: intent for intent in schema['intents']}
-    if intent_name not in intent_dict:
+    if intent_name not in service['intents']:
         return False, f'Service "{service_name}" does not have the intent "{intent_name}".'
-    intent = intent_dict[intent_name]
+    intent = service['intents'][intent_name]
     
     if missing_args := [arg for arg in intent['required_slots'] if arg not in args]:
         args_str = ', '.join(f'"{x}"' for x in missing_args)
         return False,  f'The required parameters {args_str} are missing.'
     
-    if error_args := [arg for arg in args if arg not in intent['required_slots'] + list(intent['optional_slots'].keys())]:
+    if error_args := [arg for arg in args if arg not in service['intent_args'][intent_name]]:
         error_args_str = ', '.join(f'"{x}"' for x in error_args)
         required_args_str = ', '.join(f'"{x}"' for x in intent['required_slots'])
         optional_args_str = ', '.join(f'"{x}"' for x in intent['optional_slots'])
@@ -62,16 +64,87 @@ def make_table_string(cursor, max_items=5, max_chars=500):
     return result
 
 
-def sgd_function_info(service_name, intent, args, db_path=INFO_DB_PATH):
-    fields = ', '.join(f'"{field}"' for field in intent['result_slots'])
-    sql = f'SELECT {fields} FROM {service_name}'
+def quote_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def to_sql_value(value):
+    if isinstance(value, bool):  # Boolean slots are stored as "True" / "False"
+        return str(value)
+    if value is None or isinstance(value, (str, int, float)):
+        return value
+    return str(value)
+
+
+def build_info_query(service_name, fields, args):
+    '''Return the SELECT statement and its bound parameters for a query function.'''
+    columns = ', '.join(quote_identifier(field) for field in fields)
+    sql = f'SELECT {columns} FROM {quote_identifier(service_name)}'
+    params = []
     if args:
-        conditions = ' AND '.join(f'"{k}" = "{v}"' for k, v in args.items())
+        conditions = ' AND '.join(f'{quote_identifier(k)} = ? COLLATE NOCASE' for k in args)
         sql += f' WHERE {conditions}'
+        params = [to_sql_value(v) for v in args.values()]
+    return sql, params
+
+
+def info_index_slots(conn, registry=None):
+    '''Service -> the slots of its table that the query functions can filter on. The compiled services
+    are those of `registry` if given, e.g. of another data dir, otherwise those loaded on import.'''
+    registry = load_registry() if registry is None else registry
+    index_slots = {}
+    for service_name, service in registry.items():
+        table = quote_identifier(service_name)
+        columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+        slots = set()
+        for intent_name, args in service['intent_args'].items():
+            if not service['transactional'][intent_name]:
+                slots.update(args)
+        index_slots[service_name] = sorted(slots & columns)
+    return index_slots
+
+
+def create_info_indexes(db_path=INFO_DB_PATH, registry=None):
+    '''Index every slot that the query functions can filter on. The indexes are NOCASE like the
+    comparisons of `build_info_query`, otherwise SQLite can not use them and scans the table.'''
+    conn = sqlite3.connect(db_path)
+    with conn:
+        for service_name, slots in info_index_slots(conn, registry).items():
+            table = quote_identifier(service_name)
+            for slot in slots:
+                conn.execute(f'DROP INDEX IF EXISTS {quote_identifier(f"{service_name}_{slot}_idx")}')  # BINARY index of old DBs
+                index = quote_identifier(f'{service_name}_{slot}_nocase_idx')
+                conn.execute(f'CREATE INDEX IF NOT EXISTS {index} ON {table} ({quote_identifier(slot)} COLLATE NOCASE)')
+    conn.close()
+
 
+def check_info_indexes(db_path=INFO_DB_PATH, registry=None):
+    '''Assert that the query of every indexed slot searches its index instead of scanning the table.'''
     conn = sqlite3.connect(db_path)
+    for service_name, slots in info_index_slots(conn, registry).items():
+        for slot in slots:
+            sql, params = build_info_query(service_name, [slot], {slot: ''})
+            plan = ' '.join(row[-1] for row in conn.execute(f'EXPLAIN QUERY PLAN {sql}', params))
+            if not plan.startswith('SEARCH') or f'INDEX {service_name}_{slot}_nocase_idx' not in plan:
+                raise RuntimeError(f'The query of {service_name}.{slot} does not use its index: {plan}')
+    conn.close()
+
+
+def get_db_conn(db_path=INFO_DB_PATH):
+    '''Pooled connection for queries, one per thread and db path.'''
+    if not hasattr(db_conns, 'conns'):
+        db_conns.conns = {}
+    if db_path not in db_conns.conns:
+        db_conns.conns[db_path] = sqlite3.connect(db_path)
+    return db_conns.conns[db_path]
+
+
+def sgd_function_info(service_name, intent, args, db_path=INFO_DB_PATH):
+    sql, params = build_info_query(service_name, intent['result_slots'], args)
+
+    conn = get_db_conn(db_path)
     try:
-        cursor = conn.execute(sql)
+        cursor = conn.execute(sql, params)
     except Exception as e:
         return f'SQL failed: {e.__class__.__name__}: {e}'
 
@@ -110,17 +183,15 @@ def sgd_function(service_name, intent_name,
     if not passed:
         return msg
 
-    schema = schemas[service_name]
-
-    intent_dict = {intent['name']: intent for intent in schema['intents']}
-    intent = intent_dict[intent_name]
+    service = registry[service_name]
+    intent = service['intents'][intent_name]
 
     # sql_args = kwargs.copy()
     # for arg, default_value in intent['optional_slots'].items():
     #     if arg not in sql_args and default_value != 'dontcare':
     #         sql_args[arg] = default_value
 
-    if not intent['is_transactional']:
+    if not service['transactional'][intent_name]:
         return sgd_function_info(service_name, intent, kwargs, info_db_path)
     else:
         return sgd_function_trans(service_name, kwargs, trans_db_path)
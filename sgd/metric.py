@@ -1,14 +1,26 @@
-from collections import defaultdict
 import json
+import os
+import sys
 
 import click
 
+from bootstrap import N_RESAMPLES
+from run_log import open_run_log
 from sgd.utils import load_schemas
+from utils import BaseMetricTracker
 
 
-class MetricTracker:
+class MetricTracker(BaseMetricTracker):
 
-    def __init__(self):
+    COUNTER_FIELDS = ['intent_sep_scores', 'intent_fuse_scores', 'service_sep_scores', 'service_fuse_scores',
+                      'dialog_fuse_scores']
+    SAMPLE_KEYS = [('intent', 'inform'), ('intent', 'success'), ('service', 'inform'), ('service', 'success'),
+                   ('dialog', 'inform'), ('dialog', 'success')]
+    COST_FIELD = 'cost_dict'
+    RAW_FIELD = 'raw_dialog_results'
+
+    def __init__(self, keep_raw=True, raw_file=None):
+        super().__init__(keep_raw, raw_file)
         self.raw_dialog_results = {}
 
         self.schemas = load_schemas()
@@ -46,9 +58,6 @@ class MetricTracker:
             'success': {'score': 0.0, 'hit': 0, 'total': 0},
         }
 
-        self.cost_dict = defaultdict(float)
-        self.cost_total = 0.0
-
     def accum_intent_eval_result(self, service_name, intent_name, inform, success):
         # Separate Intents
         score_dict = self.intent_sep_scores[service_name][intent_name]
@@ -100,8 +109,10 @@ class MetricTracker:
             self.dialog_fuse_scores['success']['hit'] += success
         
     def add_dialog_eval_results(self, dialog_id, eval_results):
-        assert dialog_id not in self.raw_dialog_results, f'{dialog_id = }, {self.raw_dialog_results.keys() = }'
-        self.raw_dialog_results[dialog_id] = eval_results
+        if self.keep_raw:
+            assert dialog_id not in self.raw_dialog_results, f'{dialog_id = }, {self.raw_dialog_results.keys() = }'
+            self.raw_dialog_results[dialog_id] = eval_results
+        self.add_dialog(dialog_id, eval_results)
 
         # Intent Level
         for service_name, service_results in eval_results.items():
@@ -117,18 +128,25 @@ class MetricTracker:
         # Dialog Level
         self.accum_dialog_eval_results(service_dict)
 
-    def add_cost(self, dialog_id, cost):
-        self.cost_dict[dialog_id] += cost
-        self.cost_total += cost
-
-    def get_cost(self):
-        n_dialog = len(self.cost_dict)
-        avg = self.cost_total / n_dialog if n_dialog > 0 else 0.0
-        return {
-            'total': self.cost_total,
-            'n_dialog': n_dialog,
-            'average': avg,
-        }
+        if self.keep_raw:
+            intent_results = [intent for service_results in eval_results.values() for intent in service_results.values()]
+            self.samples[dialog_id] = {
+                **self.make_sample('intent', intent_results),
+                **self.make_sample('service', list(service_dict.values())),
+            }
+            dialog_sample = self.make_sample('dialog', list(service_dict.values()))
+            for m in ['inform', 'success']:
+                hit, total = dialog_sample[f'dialog-{m}']
+                self.samples[dialog_id][f'dialog-{m}'] = [int(hit == total), 1] if total else [0, 0]
+
+    @staticmethod
+    def make_sample(level, results):
+        '''[hit, total] of the inform and success of the results (intents or services) of one dialog.'''
+        sample = {}
+        for m in ['inform', 'success']:
+            values = [result[m] for result in results if result[m] is not None]
+            sample[f'{level}-{m}'] = [sum(values), len(values)]
+        return sample
 
     def generate_postfix_str(self, fields=['cost', 'inform', 'success'], prefixes=[]):
         postfix_str = [s for s in prefixes]
@@ -158,7 +176,7 @@ class MetricTracker:
             hit = self.intent_fuse_scores[m]['hit']
             total = self.intent_fuse_scores[m]['total']
             score = hit / total if total > 0.0 else 0.0
-            self.intent_fuse_scores[m]['total'] = score
+            self.intent_fuse_scores[m]['score'] = score
 
             head.append(f'Intent-{METRIC_ABBR[m]}')
             body.append(f'{score * 100:.1f}')
@@ -216,23 +234,8 @@ class MetricTracker:
         table = '\n'.join(table)
         return table
     
-    def generate_cost_table(self):
-        # #dialogs Total($) Average($)
-        #    n        x        y
-        d = self.get_cost()
-        total, n_dialog, average = d['total'], d['n_dialog'], d['average']
-
-        head = ['#dialogs', 'Total ($)', 'Average ($)']
-        body = [str(n_dialog), f'{total:.4f}', f'{average:.4f}']
-
-        table = []
-        table.append('| ' + ' | '.join(head) + ' |')
-        table.append('| ' + ' | '.join([':---:'] * len(head)) + ' |')
-        table.append('| ' + ' | '.join(body) + ' |')
-        table = '\n'.join(table)
-        return table
-
-    def generate_all_tables(self):
+    def generate_all_tables(self, n_resamples=0):
+        '''With `n_resamples`, the bootstrap confidence intervals of the scores are added.'''
         summary = []
         summary.append('## Comprehensive Metrics')
         summary.append(self.generate_fuse_table())
@@ -240,28 +243,64 @@ class MetricTracker:
         summary.append('## Service Metrics')
         summary.append(self.generate_service_table())
         summary.append('')
-        summary.append('## Cost')
-        summary.append(self.generate_cost_table())
+        summary += self.generate_common_tables(n_resamples)
         summary = '\n'.join(summary)
         return summary
 
 
+def summarize_result(result):
+    '''The part of a result kept in the run log index: enough to score without reading the log.'''
+    summary = {'status': result.get('status'), 'cost': result.get('cost', 0.0), 'eval_results': None,
+               'n_turns': None, 'latency': result.get('latency'), 'usage': result.get('usage')}
+    if isinstance(result.get('run_result'), list):
+        summary['n_turns'] = len(result['run_result'])
+    if result.get('status') == 'succeed':
+        summary['eval_results'] = result['eval_results']  # service -> intent -> inform, success
+    return summary
+
+
+track_run_log = MetricTracker.track_run_log
+track_stream = MetricTracker.track_stream
+
+
 @click.command()
-@click.option('--log_file')
+@click.option('--log_file', help='"-" to read the log from stdin, which implies --stream.')
 @click.option('--score_table_file')
-def metric(log_file, score_table_file):
-    with open(log_file) as f:
-        data = [json.loads(s) for s in f.read().splitlines()]
-
-    metric_tracker = MetricTracker()
-    for item in data[1:]:
-        if item['status'] != 'succeed':
-            print(f'Skip dialog: {item["dialog_id"]}, status: {item["status"]}')
-            continue
-        metric_tracker.add_dialog_eval_results(item['dialog_id'], item['eval_results'])
-        metric_tracker.add_cost(item['dialog_id'], item['cost'])
-
-    summary = metric_tracker.generate_all_tables()
+@click.option('--stream', is_flag=True, help='Read the log line by line without the index and keep only the counters. '
+              'Every record is counted, so compact a log with superseded records first.')
+@click.option('--raw_file', default=None, help='Spill the eval results to the JSONL file in stream mode.')
+@click.option('--state_files', default=None, help='Comma separated tracker states to merge, instead of a log.')
+@click.option('--save_state', default=None, help='Save the tracker state to the JSON file, to be merged later.')
+@click.option('--bootstrap', type=int, default=0, help='Number of bootstrap resamples for the confidence intervals.')
+@click.option('--compare_log_file', default=None, help='Compare with the run of this log by paired bootstrap.')
+def metric(log_file, score_table_file, stream, raw_file, state_files, save_state, bootstrap, compare_log_file):
+    if raw_file and os.path.exists(raw_file):
+        raise RuntimeError(f'{raw_file = } exists.')
+    if (bootstrap or compare_log_file) and (stream or log_file == '-'):
+        raise RuntimeError('Bootstrap needs the per-dialog scores, which stream mode does not keep.')
+
+    if state_files:
+        metric_tracker = MetricTracker(keep_raw=False)
+        for state_file in state_files.split(','):
+            with open(state_file) as f:
+                metric_tracker.add_state(json.load(f))
+    elif log_file == '-':
+        metric_tracker, _ = track_stream(sys.stdin.buffer, raw_file, verbose=True)
+    elif stream:
+        with open(log_file, 'rb') as f:
+            metric_tracker, _ = track_stream(f, raw_file, verbose=True)
+    else:
+        metric_tracker, _ = track_run_log(open_run_log(log_file, summarize_result), verbose=True)
+
+    if save_state:
+        with open(save_state, 'w') as f:
+            json.dump(metric_tracker.to_state(), f)
+
+    summary = metric_tracker.generate_all_tables(bootstrap)
+    if compare_log_file:
+        other_tracker, _ = track_run_log(open_run_log(compare_log_file, summarize_result))
+        summary += f'\n\n## Paired Bootstrap (A: {log_file or state_files}, B: {compare_log_file})\n'
+        summary += metric_tracker.generate_paired_table(other_tracker, bootstrap or N_RESAMPLES)
 
     with open(score_table_file, 'w') as f:
         f.write(summary + '\n')
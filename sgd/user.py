@@ -2,7 +2,7 @@ from collections import OrderedDict
 
 from termcolor import cprint
 
-from sgd.utils import load_schemas
+from sgd.utils import load_registry
 from base_user import BaseUser
 
 TEMPLATE = '''You are a dialogue simulator where you act as a user to talk to an AI assistant to complete some tasks.
@@ -35,7 +35,7 @@ Current conversation:
 AI Assistant: {input}
 User:'''
 
-schemas = load_schemas()
+registry = load_registry()
 
 
 def extract_user_goals(dialog):
@@ -75,11 +75,10 @@ def make_goals_str(goals):
     goals_str = []
     goal_index = 0
     for service_name, service in goals.items():
-        intent_dict = {it['name']: it for it in schemas[service_name]['intents']}
-        slot_dict = {slot['name']: slot for slot in schemas[service_name]['slots']}
+        intent_descs = registry[service_name]['intent_descs']
+        slot_descs = registry[service_name]['slot_descs']
         for intent_name, intent in service.items():
-            intent_desc = intent_dict[intent_name]['description']
-            intent_desc = intent_desc[0].lower() + intent_desc[1:]
+            intent_desc = intent_descs[intent_name]
 
             goal_index += 1
             goals_str.append(f'\nGoal {goal_index}:')
@@ -88,8 +87,7 @@ def make_goals_str(goals):
 
             inform_str = []
             for slot, value_dict in intent['inform'].items():
-                slot_desc = slot_dict[slot]['description']
-                slot_desc = slot_desc[0].lower() + slot_desc[1:]
+                slot_desc = slot_descs[slot]
                 slot_value_str = f"the {slot_desc} is {value_dict['value']}"
                 if 'canonical_value' in value_dict and value_dict['canonical_value'] != value_dict['value']:
                     slot_value_str += f" ({value_dict['canonical_value']})"
@@ -100,8 +98,7 @@ def make_goals_str(goals):
 
             request_str = []
             for slot in intent['request']:
-                slot_desc = slot_dict[slot]['description']
-                slot_desc = slot_desc[0].lower() + slot_desc[1:]
+                slot_desc = slot_descs[slot]
                 request_str.append(f'the {slot_desc}')
             if request_str:
                 request_str = ', '.join(request_str) + '.'
@@ -173,22 +170,19 @@ def make_goals_str_steps(goals):
     for step in goals:
         service, intent, act, slot, value = step['service'], step['intent'], step['act'], step['slot'], step['value']
 
-        intent_dict = {it['name']: it for it in schemas[service]['intents']}
-        slot_dict = {slot['name']: slot for slot in schemas[service]['slots']}
+        intent_descs = registry[service]['intent_descs']
+        slot_descs = registry[service]['slot_descs']
 
         if act == 'INFORM_INTENT':
-            intent_desc = intent_dict[intent]['description']
-            intent_desc = intent_desc[0].lower() + intent_desc[1:]
+            intent_desc = intent_descs[intent]
             goals_str.append(f'The user wants to {intent_desc}.')
 
         elif act == 'INFORM':
-            slot_desc = slot_dict[slot]['description']
-            slot_desc = slot_desc[0].lower() + slot_desc[1:]
+            slot_desc = slot_descs[slot]
             goals_str.append(f'The user will inform the AI Assistant that the {slot_desc} is {value}.')
 
         elif act == 'REQUEST':
-            slot_desc = slot_dict[slot]['description']
-            slot_desc = slot_desc[0].lower() + slot_desc[1:]
+            slot_desc = slot_descs[slot]
             goals_str.append(f'The user wants to ask the AI Assistant to know the {slot_desc}.')
         
     goals_str = '\n'.join(goals_str).strip()
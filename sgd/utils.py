@@ -1,3 +1,4 @@
+import hashlib
 import json
 import os
 import random
@@ -9,28 +10,73 @@ DATA_DIR = 'data/sgd/origin'
 
 INFO_DB_PATH = 'data/sgd/db/sgd.db'
 TRANS_DB_PATH = 'data/sgd/db/sgd_trans.db'
+FIELD_DATA_TYPE_PATH = 'data/sgd/db/field_data_type.json'
+
+SPLITS = ['train', 'dev', 'test']
 
 schemas = None
 
 
+def read_schemas(data_dir=DATA_DIR):
+    '''Service name -> schema, read from the data dir without the process-wide cache of `load_schemas`.'''
+    schema_list = []
+    for split in SPLITS:
+        with open(os.path.join(data_dir, split, 'schema.json')) as f:
+            schema_list += json.load(f)
+    return {schema['service_name']: schema for schema in schema_list}
+
+
 def load_schemas(data_dir=DATA_DIR):
     global schemas
 
     if schemas is not None:
         return schemas
 
-    schema_list = []
-    with open(os.path.join(data_dir, 'train', 'schema.json')) as f:
-        schema_list += json.load(f)
-    with open(os.path.join(data_dir, 'dev', 'schema.json')) as f:
-        schema_list += json.load(f)
-    with open(os.path.join(data_dir, 'test', 'schema.json')) as f:
-        schema_list += json.load(f)
-
-    schemas = {schema['service_name']: schema for schema in schema_list}
+    schemas = read_schemas(data_dir)
     return schemas
 
 
+def lower_first(text):
+    return text[0].lower() + text[1:]
+
+
+def compile_service(schema):
+    intents = {intent['name']: intent for intent in schema['intents']}
+    slots = {slot['name']: slot for slot in schema['slots']}
+    return {
+        'schema': schema,
+        'intents': intents,
+        'slots': slots,
+        'intent_args': {name: set(it['required_slots']) | set(it['optional_slots']) for name, it in intents.items()},
+        'intent_descs': {name: lower_first(it['description']) for name, it in intents.items()},
+        'slot_descs': {name: lower_first(slot['description']) for name, slot in slots.items()},
+        'transactional': {name: it['is_transactional'] for name, it in intents.items()},
+    }
+
+
+registry = None
+
+
+def load_registry(data_dir=DATA_DIR):
+    '''Service name -> compiled service with O(1) access to intents, slots and their derived info.'''
+    global registry
+
+    if registry is not None:
+        return registry
+
+    registry = {name: compile_service(schema) for name, schema in load_schemas(data_dir).items()}
+    return registry
+
+
+def schema_checksum(data_dir=DATA_DIR):
+    '''sha256 over the raw schema files, used to detect stale precomputed artifacts.'''
+    h = hashlib.sha256()
+    for split in SPLITS:
+        with open(os.path.join(data_dir, split, 'schema.json'), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
 dialogs = None
 
 
@@ -53,9 +99,8 @@ def load_dialogs(data_dir=DATA_DIR):
         return dialogs
 
     dialogs = []
-    dialogs += load_dialogs_split('train')
-    dialogs += load_dialogs_split('dev')
-    dialogs += load_dialogs_split('test')
+    for split in SPLITS:
+        dialogs += load_dialogs_split(split)
 
     dialogs = {d['dialogue_id']: d for d in dialogs}
 
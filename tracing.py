@@ -0,0 +1,206 @@
+from contextlib import contextmanager
+import contextvars
+import itertools
+import json
+import os
+import threading
+import time
+
+from termcolor import colored, cprint
+
+from event_bus import dispatcher
+
+HEADER_WIDTH = 50
+GREEN_COLOR = '\u001b[1;32m'
+MAG_COLOR = '\u001b[1;35m'
+CYAN_COLOR = '\u001b[1;36m'
+RESET_COLOR = '\u001b[0m'
+
+current_span = contextvars.ContextVar('current_span', default=None)
+span_ids = itertools.count(1)
+
+
+class Span:
+    '''A timed step of a run: a dialog, a turn, a reply of the user or the agent, an LLM call, a function call
+    or an evaluation. Spans nest by the span in progress in the same context.
+
+    `attrs` (timing, tokens, sizes) are exported by all sinks, `text` (utterances, function results) only
+    by the print sink.
+    '''
+
+    def __init__(self, name, kind, parent=None, **attrs):
+        self.name = name
+        self.kind = kind
+        self.span_id = next(span_ids)
+        self.parent_id = parent.span_id if parent else None
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.thread = threading.get_ident()
+        self.attrs = attrs
+        self.text = {}
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def show(self, **text):
+        self.text.update(text)
+
+    def set_usage(self, token_usage):
+        self.set(prompt_tokens=token_usage.get('prompt_tokens'), completion_tokens=token_usage.get('completion_tokens'))
+
+    def to_record(self):
+        return {'trace_id': self.trace_id, 'span_id': self.span_id, 'parent_id': self.parent_id, 'name': self.name,
+                'kind': self.kind, 'start': self.start, 'duration': self.duration, 'thread': self.thread,
+                'attrs': self.attrs}
+
+
+# region: Sinks
+
+class TraceSink:
+
+    def on_start(self, span):
+        pass
+
+    def on_end(self, span):
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonlSink(TraceSink):
+    '''One line per finished span.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'a')
+        self.lock = threading.Lock()
+
+    def on_end(self, span):
+        line = json.dumps(span.to_record(), default=str) + '\n'
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+class ChromeTraceSink(TraceSink):
+    '''Complete events of the Chrome trace event format, for chrome://tracing or Perfetto.
+
+    The JSON array is closed on `close`, but the viewers also load a file of an unfinished run.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.f = open(path, 'w')
+        self.f.write('[\n')
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+
+    def on_end(self, span):
+        event = {'name': span.name, 'cat': span.kind, 'ph': 'X', 'ts': span.start * 1e6, 'dur': span.duration * 1e6,
+                 'pid': self.pid, 'tid': span.thread, 'args': {'trace_id': span.trace_id, **span.attrs}}
+        line = json.dumps(event, default=str) + ',\n'
+        with self.lock:
+            self.f.write(line)
+            self.f.flush()
+
+    def close(self):
+        meta = {'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': 'AutoTOD'}}
+        with self.lock:
+            self.f.write(json.dumps(meta) + '\n]\n')
+            self.f.close()
+
+
+class PrintSink(TraceSink):
+    '''The colored console output of the dialogs: turn headers, utterances and function calls.'''
+
+    def on_start(self, span):
+        if span.kind == 'turn':
+            print(colored('=' * HEADER_WIDTH + f' Turn {span.attrs["turn_idx"]} ' + '=' * HEADER_WIDTH,
+                          'red', attrs=['bold'], force_color=True), end='\n\n')
+
+    def on_end(self, span):
+        if span.kind == 'role' and 'utter' in span.text:
+            color = 'blue' if span.name == 'user' else 'yellow'
+            speaker = 'User' if span.name == 'user' else 'AI Assistant'
+            cprint(f'{speaker}: {span.text["utter"]}', color=color, attrs=['bold'], force_color=True, end='\n\n')
+        elif span.kind == 'function' and ('args' in span.text or 'parse_error' in span.attrs):
+            print()
+            if 'parse_error' in span.attrs:
+                print('Function parsing error:')
+                print(f'function_call: {span.text.get("function_call")}')
+            else:
+                print('Function: ' + MAG_COLOR + f'{span.name}' + RESET_COLOR)
+                print('Arguments: ' + GREEN_COLOR + f'{span.text.get("args")}' + RESET_COLOR)
+            if 'result' in span.text:
+                print('Result: ' + CYAN_COLOR + f'{span.text["result"]}' + RESET_COLOR)
+
+# endregion
+
+
+class Tracer:
+    '''Starts and ends the spans. The sinks run on the event dispatcher thread, in the order of the spans.'''
+
+    def __init__(self, sinks=None):
+        self.sinks = [PrintSink()] if sinks is None else sinks
+
+    def start_span(self, name, kind, parent=None, **attrs):
+        '''Start a span without making it the span in progress, for steps reported by start and end callbacks.'''
+        span = Span(name, kind, parent or current_span.get(), **attrs)
+        for sink in self.sinks:
+            dispatcher.submit(sink.on_start, span)
+        return span
+
+    def end_span(self, span, error=None):
+        span.duration = time.time() - span.start
+        if error is not None:
+            span.set(error=f'{error.__class__.__name__}: {error}')
+        for sink in self.sinks:
+            dispatcher.submit(sink.on_end, span)
+
+    @contextmanager
+    def span(self, name, kind, **attrs):
+        span = self.start_span(name, kind, **attrs)
+        token = current_span.set(span)
+        error = None
+        try:
+            yield span
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            current_span.reset(token)
+            self.end_span(span, error)
+
+    def close(self):
+        dispatcher.flush()
+        for sink in self.sinks:
+            sink.close()
+
+
+tracer = Tracer()
+
+
+def configure_tracing(trace_file=None, chrome_trace_file=None, print_spans=True):
+    '''Replace the sinks of the tracer. Printing is one of the sinks and the only one by default.'''
+    sinks = []
+    if print_spans:
+        sinks.append(PrintSink())
+    if trace_file:
+        sinks.append(JsonlSink(trace_file))
+    if chrome_trace_file:
+        sinks.append(ChromeTraceSink(chrome_trace_file))
+    tracer.close()
+    tracer.sinks = sinks
+    return tracer
+
+
+def in_current_context(func):
+    '''Wrap `func` to run in a copy of the current context, so that the spans it starts in a worker
+    thread nest under the span in progress here.'''
+    context = contextvars.copy_context()
+    return lambda *args, **kwargs: context.run(func, *args, **kwargs)
@@ -10,6 +10,7 @@ import openai
 import tenacity
 
 from client import MyOpenAI
+from model_registry import is_completion_model
 from utils import OPENAI_API_KEY, prepare_goals_string, tenacity_retry_log
 
 
@@ -60,8 +61,7 @@ def prepare_user_simulator(dialog, model):
     fisrt_user_utter = dialog['log'][0]['text']
 
     # LLM
-    assert model.startswith('text-davinci-') or model.startswith('gpt-3.5-')
-    if model.startswith('text-davinci-'):
+    if is_completion_model(model):
         llm = OpenAI(
             model_name=model,
             temperature=0,
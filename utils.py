@@ -1,17 +1,30 @@
+from collections import defaultdict
+from collections.abc import Mapping
+import hashlib
 from io import StringIO
 import json
 import os
 import random
 import re
+import sqlite3
+import threading
 from pprint import pprint
 
+import numpy as np
 from termcolor import colored
 
+from bootstrap import ALPHA, N_RESAMPLES, bootstrap_scores, paired_bootstrap, point_scores
+from model_registry import calc_cost
+from run_log import stream_run_log
+
 
 DOMAINS = ['hotel', 'restaurant', 'attraction', 'train', 'taxi']
 
 DATA_DIR = 'data/mwoz/origin'
 DATA_PATH = 'data/mwoz/origin/data.json'
+DATA_CACHE_VERSION = 2
+DATA_SPLIT_FILES = {'test': 'testListFile.txt', 'valid': 'valListFile.txt'}
+DATA_SPLITS = ['train', 'valid', 'test']
 
 DB_PATH = 'data/mwoz/db/multiwoz.db'
 BOOK_DB_PATH = 'data/mwoz/db/multiwoz_book.db'
@@ -25,17 +38,6 @@ USER_COLOR = HEADER_COLOR
 AGENT_COLOR = HEADER_COLOR
 RESET_COLOR = '\u001b[0m'
 
-OPENAI_PRICE = {
-    'gpt-3.5-turbo': {
-        'input': 0.0015 / 1000,
-        'output': 0.002 / 1000,
-    },
-    'text-davinci': {
-        'text': 0.02 / 1000,
-    },
-}
-
-
 class TableItem:
 
     def __repr__(self):
@@ -62,16 +64,314 @@ def json_default_func(obj):
                         f'is not JSON serializable')
 
 
-def calc_openai_cost(model, usage):
-    if model.startswith('gpt-3.5-turbo'):
-        price = OPENAI_PRICE['gpt-3.5-turbo']
-        cost = usage['prompt_tokens'] * price['input'] + usage['completion_tokens'] * price['output']
-    elif model.startswith('text-davinci'):
-        price = OPENAI_PRICE['text-davinci']
-        cost = usage['total_tokens'] * price['text']
-    else:
-        raise ValueError(f'{model = }')
-    return cost
+# region: Usage
+
+USAGE_ROLES = ['user', 'agent', 'judge']
+USAGE_FIELDS = ['llm_calls', 'prompt_tokens', 'completion_tokens', 'function_calls', 'wall_time', 'cost']
+
+
+def make_usage(**counts):
+    '''Usage of a role in a dialog: LLM calls, prompt and completion tokens, function calls, wall time (s) and cost.'''
+    usage = {field: 0 for field in USAGE_FIELDS}
+    usage.update(counts)
+    return usage
+
+
+def add_usage(usage, other, scale=1):
+    '''Add the counts of `other` (times `scale`) to `usage` in place.'''
+    for field in USAGE_FIELDS:
+        usage[field] += other.get(field, 0) * scale
+    return usage
+
+
+def completion_usage(model, token_usage, wall_time=0.0):
+    '''Usage of one LLM call from the token usage of its response.'''
+    return make_usage(llm_calls=1, prompt_tokens=token_usage.get('prompt_tokens', 0),
+                      completion_tokens=token_usage.get('completion_tokens', 0), wall_time=wall_time,
+                      cost=calc_cost(model, token_usage))
+
+
+def generate_usage_table(dialog_usages, percentiles=(50, 95)):
+    '''Percentiles, mean and total over the dialogs of the usage of each role, and of the turns and latency.
+
+    `dialog_usages` are {'usage': role -> usage, 'n_turns': .., 'latency': ..} of the dialogs.
+    '''
+    FIELD_NAMES = {'llm_calls': 'LLM calls', 'prompt_tokens': 'Prompt tokens', 'completion_tokens': 'Completion tokens',
+                   'function_calls': 'Function calls', 'wall_time': 'Wall time (s)', 'cost': 'Cost ($)'}
+
+    rows = []  # (role, field, values of the dialogs)
+    for role in USAGE_ROLES + ['total']:
+        for field in USAGE_FIELDS:
+            if role == 'total':
+                values = [sum(usage[field] for usage in d['usage'].values()) for d in dialog_usages]
+            else:
+                values = [d['usage'][role][field] for d in dialog_usages if role in d['usage']]
+            rows.append((role, FIELD_NAMES[field], values))
+    throughputs = []
+    for d in dialog_usages:
+        tokens = sum(usage['prompt_tokens'] + usage['completion_tokens'] for usage in d['usage'].values())
+        wall_time = sum(usage['wall_time'] for usage in d['usage'].values())
+        if wall_time > 0:
+            throughputs.append(tokens / wall_time)
+    rows.append(('total', 'Tokens / s', throughputs))
+    rows.append(('dialog', 'Turns', [d['n_turns'] for d in dialog_usages if d['n_turns'] is not None]))
+    rows.append(('dialog', 'Latency (s)', [d['latency'] for d in dialog_usages if d['latency'] is not None]))
+
+    head = ['Role', 'Field'] + [f'p{p}' for p in percentiles] + ['Mean', 'Total']
+    table = []
+    table.append('| ' + ' | '.join(head) + ' |')
+    table.append('| ' + ' | '.join([':---:'] * len(head)) + ' |')
+    for role, field, values in rows:
+        if not values:
+            continue
+        fmt = '.4f' if field == 'Cost ($)' else '.1f'
+        stats = [*np.percentile(values, percentiles), np.mean(values), np.sum(values)]
+        body = [role, field] + [f'{v:{fmt}}' for v in stats]
+        if field == 'Tokens / s':
+            body[-1] = '--'
+        table.append('| ' + ' | '.join(body) + ' |')
+    table = '\n'.join(table)
+    return table
+
+# endregion
+
+
+# region: Metric
+
+def add_fingerprint(fingerprint, dialog_id):
+    '''Add the dialog to the fingerprint of a set of dialogs: the sum of 128-bit hashes of their ids, which
+    does not depend on the order and takes constant memory.'''
+    digest = hashlib.sha256(str(dialog_id).encode()).digest()
+    return (fingerprint + int.from_bytes(digest[:16], 'big')) % 2**128
+
+
+def merge_counters(counters, other):
+    '''Add the counters of `other` to `counters` in place. `score` is derived from the counters, so it is skipped.'''
+    for k, v in other.items():
+        if isinstance(v, dict):
+            merge_counters(counters.setdefault(k, {}), v)
+        elif k != 'score':
+            counters[k] = counters.get(k, 0) + v
+
+
+class BaseMetricTracker:
+    '''Costs, usage, per-dialog samples and shard fingerprints shared by the MultiWOZ and SGD metric trackers.
+
+    Subclasses define the score counters in COUNTER_FIELDS, the scores of a dialog sample in SAMPLE_KEYS,
+    the attributes of the costs and raw eval results in COST_FIELD and RAW_FIELD, and `add_dialog_eval_results`.
+    '''
+
+    COUNTER_FIELDS = []
+    SAMPLE_KEYS = []  # (level, metric)
+    METRIC_ABBR = {'inform': 'I', 'success': 'S', 'book': 'B', 'combine': 'C'}
+    COST_FIELD = 'cost'
+    RAW_FIELD = 'raw'
+
+    def __init__(self, keep_raw=True, raw_file=None):
+        '''With `keep_raw=False`, only the counters are kept, so the memory does not grow with the dialogs.
+        The eval results are then spilled to `raw_file` (JSONL) if given.
+        '''
+        self.keep_raw = keep_raw
+        self.raw_file = raw_file
+        self.cost_total = 0.0
+        self.n_dialog = 0
+        self.fingerprint = 0  # of the dialogs added to this tracker, see add_fingerprint
+        self.shards = set()  # fingerprints of the merged trackers
+        self.samples = {}  # dialog id -> [hit, total] of each score in SAMPLE_KEYS, for bootstrap
+        self.usage = {}  # dialog id -> usage of the roles, turns and latency, for the percentiles
+        setattr(self, self.COST_FIELD, defaultdict(float))
+
+    def add_dialog(self, dialog_id, eval_results):
+        '''Count the dialog, and spill its eval results to `raw_file` if they are not kept.'''
+        if not self.keep_raw and self.raw_file:
+            with open(self.raw_file, 'a') as f:
+                f.write(json.dumps({'dialog_id': dialog_id, 'eval_results': eval_results}) + '\n')
+        self.n_dialog += 1
+        self.fingerprint = add_fingerprint(self.fingerprint, dialog_id)
+
+    def add_cost(self, dialog_id, cost):
+        if self.keep_raw:
+            getattr(self, self.COST_FIELD)[dialog_id] += cost
+        self.cost_total += cost
+
+    def add_usage(self, dialog_id, usage, n_turns=None, latency=None):
+        '''Usage of the roles (user, agent, judge) in the dialog. Only kept with keep_raw.'''
+        if self.keep_raw and usage:
+            self.usage[dialog_id] = {'usage': usage, 'n_turns': n_turns, 'latency': latency}
+
+    def to_state(self):
+        '''The counters and costs, JSON serializable. The raw eval results are not included.'''
+        state = {field: getattr(self, field) for field in self.COUNTER_FIELDS}
+        state.update({self.COST_FIELD: dict(getattr(self, self.COST_FIELD)), 'cost_total': self.cost_total,
+                      'n_dialog': self.n_dialog, 'samples': self.samples, 'usage': self.usage,
+                      'shards': self.get_shards()})
+        return json.loads(json.dumps(state))
+
+    def get_shards(self):
+        '''Fingerprints of the shards of the dialogs: the merged trackers and the dialogs added to this one.'''
+        shards = set(self.shards)
+        if self.fingerprint:
+            shards.add(f'{self.fingerprint:032x}')
+        return sorted(shards)
+
+    @classmethod
+    def from_state(cls, state, keep_raw=True):
+        return cls(keep_raw).add_state(state)
+
+    def add_state(self, state):
+        '''Add the counters and costs of a tracker state, e.g. of another shard of the dialogs.
+
+        Common dialogs are found by the dialog ids of the costs, which only `keep_raw` trackers have, and by
+        the shard fingerprints. A stream tracker thus rejects a shard merged twice, but not shards that
+        partly overlap.
+        '''
+        cost = getattr(self, self.COST_FIELD)
+        if set(state[self.COST_FIELD]) & set(cost) or set(state.get('shards', [])) & set(self.get_shards()):
+            raise ValueError('The trackers have common dialogs.')
+        for field in self.COUNTER_FIELDS:
+            merge_counters(getattr(self, field), state[field])
+        for dialog_id, dialog_cost in state[self.COST_FIELD].items():
+            cost[dialog_id] += dialog_cost
+        self.cost_total += state['cost_total']
+        self.n_dialog += state['n_dialog']
+        self.samples.update(state.get('samples', {}))
+        self.usage.update(state.get('usage', {}))
+        self.shards.update(state.get('shards', []))
+        return self
+
+    def merge(self, other):
+        '''Add the counters, costs and raw eval results of another tracker.'''
+        self.add_state(other.to_state())
+        if self.keep_raw:
+            raw, other_raw = getattr(self, self.RAW_FIELD), getattr(other, self.RAW_FIELD)
+            if set(other_raw) & set(raw):
+                raise ValueError('The trackers have common dialogs.')
+            raw.update(other_raw)
+        return self
+
+    def get_cost(self):
+        n_dialog = self.n_dialog
+        avg = self.cost_total / n_dialog if n_dialog > 0 else 0.0
+        return {
+            'total': self.cost_total,
+            'n_dialog': n_dialog,
+            'average': avg,
+        }
+
+    def generate_cost_table(self):
+        # #dialogs Total($) Average($)
+        #    n        x        y
+        d = self.get_cost()
+        total, n_dialog, average = d['total'], d['n_dialog'], d['average']
+
+        head = ['#dialogs', 'Total ($)', 'Average ($)']
+        body = [str(n_dialog), f'{total:.4f}', f'{average:.4f}']
+
+        table = []
+        table.append('| ' + ' | '.join(head) + ' |')
+        table.append('| ' + ' | '.join([':---:'] * len(head)) + ' |')
+        table.append('| ' + ' | '.join(body) + ' |')
+        table = '\n'.join(table)
+        return table
+
+    def generate_usage_table(self):
+        return generate_usage_table(list(self.usage.values()))
+
+    def get_samples(self, dialog_ids=None):
+        '''Hits and totals of the scores in SAMPLE_KEYS of the dialogs, each a list of n_dialogs rows.'''
+        if not self.samples:
+            raise RuntimeError('No per-dialog samples for bootstrap. They are not kept with keep_raw=False.')
+        dialog_ids = list(self.samples) if dialog_ids is None else dialog_ids
+        keys = [f'{level}-{m}' for level, m in self.SAMPLE_KEYS]
+        hits = [[self.samples[dialog_id][k][0] for k in keys] for dialog_id in dialog_ids]
+        totals = [[self.samples[dialog_id][k][1] for k in keys] for dialog_id in dialog_ids]
+        return hits, totals
+
+    def generate_bootstrap_table(self, n_resamples=N_RESAMPLES, alpha=ALPHA):
+        scores, low, high = bootstrap_scores(*self.get_samples(), n_resamples, alpha)
+
+        table = []
+        table.append(f'| Score | Estimate | {1 - alpha:.0%} CI |')
+        table.append('| :---: | :---: | :---: |')
+        for (level, m), score, l, h in zip(self.SAMPLE_KEYS, scores, low, high):
+            table.append(f'| {level.capitalize()}-{self.METRIC_ABBR[m]} | {score * 100:.1f} | '
+                         f'[{l * 100:.1f}, {h * 100:.1f}] |')
+        table = '\n'.join(table)
+        return table
+
+    def generate_paired_table(self, other, n_resamples=N_RESAMPLES, alpha=ALPHA):
+        '''Paired bootstrap of the scores of this tracker minus those of the other, over their common dialogs.'''
+        dialog_ids = [dialog_id for dialog_id in self.samples if dialog_id in other.samples]
+        if not dialog_ids:
+            raise RuntimeError('The trackers have no common dialogs to compare.')
+        hits_a, totals_a = self.get_samples(dialog_ids)
+        hits_b, totals_b = other.get_samples(dialog_ids)
+        scores_a, scores_b = point_scores(hits_a, totals_a), point_scores(hits_b, totals_b)
+        deltas, low, high, p_values = paired_bootstrap(hits_a, totals_a, hits_b, totals_b, n_resamples, alpha)
+
+        table = []
+        table.append(f'| Score (#dialogs: {len(dialog_ids)}) | A | B | A - B | {1 - alpha:.0%} CI | p |')
+        table.append('| :---: | :---: | :---: | :---: | :---: | :---: |')
+        for i, (level, m) in enumerate(self.SAMPLE_KEYS):
+            table.append(f'| {level.capitalize()}-{self.METRIC_ABBR[m]} | {scores_a[i] * 100:.1f} | '
+                         f'{scores_b[i] * 100:.1f} | {deltas[i] * 100:+.1f} | '
+                         f'[{low[i] * 100:+.1f}, {high[i] * 100:+.1f}] | {p_values[i]:.3f} |')
+        table = '\n'.join(table)
+        return table
+
+    def generate_common_tables(self, n_resamples=0):
+        '''The cost, usage and bootstrap sections of the summary, as lines.'''
+        summary = []
+        summary.append('## Cost')
+        summary.append(self.generate_cost_table())
+        if self.usage:
+            summary.append('')
+            summary.append('## Usage (per dialog)')
+            summary.append(self.generate_usage_table())
+        if n_resamples:
+            summary.append('')
+            summary.append(f'## Bootstrap ({n_resamples} resamples of dialogs)')
+            if self.samples:
+                summary.append(self.generate_bootstrap_table(n_resamples))
+            else:
+                summary.append('No per-dialog samples: no dialog succeeded, or the tracker keeps only the counters.')
+        return summary
+
+    @classmethod
+    def track_run_log(cls, run_log, verbose=False):
+        '''Metrics of the succeeded dialogs in the run log, from its index only.'''
+        metric_tracker = cls()
+        n_succeed = 0
+        for dialog_id in run_log.dialog_ids():
+            summary = run_log.get_summary(dialog_id)
+            if summary['status'] != 'succeed':
+                if verbose:
+                    print(f'Skip dialog: {dialog_id}, status: {summary["status"]}')
+                continue
+            n_succeed += 1
+            metric_tracker.add_dialog_eval_results(dialog_id, summary['eval_results'])
+            metric_tracker.add_cost(dialog_id, summary['cost'])
+            metric_tracker.add_usage(dialog_id, summary.get('usage'), summary.get('n_turns'), summary.get('latency'))
+        return metric_tracker, n_succeed
+
+    @classmethod
+    def track_stream(cls, f, raw_file=None, verbose=False):
+        '''Metrics of the succeeded dialogs in the run log read from the file object line by line, in constant memory.'''
+        metric_tracker = cls(keep_raw=False, raw_file=raw_file)
+        records = stream_run_log(f)
+        next(records)  # header
+        n_succeed = 0
+        for result in records:  # superseded records are not detected, which would need the dialog ids
+            if result['status'] != 'succeed':
+                if verbose:
+                    print(f'Skip dialog: {result["dialog_id"]}, status: {result["status"]}')
+                continue
+            n_succeed += 1
+            metric_tracker.add_dialog_eval_results(result['dialog_id'], result['eval_results'])
+            metric_tracker.add_cost(result['dialog_id'], result['cost'])
+        return metric_tracker, n_succeed
+
+# endregion
 
 
 def clean_time(time):
@@ -110,7 +410,114 @@ def prepare_goals_string(goals):
     return goals_str
 
 
-def load_data(data_path=DATA_PATH):
+# region: LLM Output
+
+JSON_LITERALS = {'true': 'true', 'false': 'false', 'null': 'null', 'True': 'true', 'False': 'false'}
+
+
+def repair_json_string(text):
+    '''Repair a json object string written by an LLM in one pass.
+
+    Inserts missing commas, drops trailing commas, quotes bare words, closes the unterminated
+    string and brackets, and drops anything after the object.
+    '''
+    out = []
+    stack = []
+    in_string, escape = False, False
+    value_end = False  # a value (or key) just ended, so the next value or key needs a comma
+
+    def drop_trailing_comma():
+        while out and out[-1].isspace():
+            out.pop()
+        if out and out[-1] == ',':
+            out.pop()
+
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if in_string:
+            out.append(c)
+            if escape:
+                escape = False
+            elif c == '\\':
+                escape = True
+            elif c == '"':
+                in_string, value_end = False, True
+            i += 1
+            continue
+
+        if c in '"{[' or c.isalnum() or c == '-':
+            if value_end:
+                out.append(',')
+            value_end = False
+
+        if c == '"':
+            in_string = True
+            out.append(c)
+        elif c in '{[':
+            stack.append('}' if c == '{' else ']')
+            out.append(c)
+        elif c in '}]':
+            if not stack:
+                break
+            drop_trailing_comma()
+            out.append(stack.pop())
+            value_end = True
+            if not stack:
+                break
+        elif c == ':':
+            out.append(c)
+            value_end = False
+        elif c == ',':
+            drop_trailing_comma()
+            out.append(c)
+            value_end = False
+        elif c.isdigit() or c == '-':
+            m = re.compile(r'-?\d+(\.\d+)?([eE][-+]?\d+)?').match(text, i)
+            out.append(m[0] if m else c)
+            i += len(m[0]) - 1 if m else 0
+            value_end = True
+        elif c.isalpha() or c == '_':
+            word = re.compile(r'\w+').match(text, i)[0]
+            out.append(JSON_LITERALS.get(word, json.dumps(word)))
+            i += len(word) - 1
+            value_end = True
+        elif c.isspace():
+            out.append(c)
+        i += 1
+
+    if in_string:
+        if escape:
+            out.pop()
+        out.append('"')
+    drop_trailing_comma()
+    if out and out[-1] == ':':
+        out.append('""')
+    out += reversed(stack)
+    return ''.join(out)
+
+
+def parse_llm_json(text):
+    '''Parse the first json object in an LLM output, repairing it if it is malformed.
+
+    Raises json.JSONDecodeError if no object is found or the repair fails.
+    '''
+    start = text.find('{')
+    if start < 0:
+        raise json.JSONDecodeError('No json object found', text, 0)
+    try:
+        return json.JSONDecoder(strict=False).raw_decode(text, start)[0]
+    except json.JSONDecodeError:
+        pass
+    return json.loads(repair_json_string(text[start:]), strict=False)
+
+# endregion
+
+
+def load_data(data_path=DATA_PATH, use_cache=True):
+    if use_cache:
+        return load_data_cache(data_path)
+
     with open(data_path) as f:
         data = json.load(f)
 
@@ -125,8 +532,13 @@ def load_data(data_path=DATA_PATH):
     return data
 
 
-def load_data_split(split, data_dir=DATA_DIR):
+def load_data_split(split, data_dir=DATA_DIR, use_cache=True):
+    if split not in DATA_SPLITS:
+        raise ValueError(f'{split = }')
     data_path = os.path.join(data_dir, 'data.json')
+    if use_cache:
+        return load_data_cache(data_path, split)
+
     with open(data_path) as f:
         data = json.load(f)
 
@@ -156,6 +568,157 @@ def load_data_split(split, data_dir=DATA_DIR):
     return data
 
 
+# region: Data Cache
+
+def get_data_cache_path(data_path):
+    '''The cache of the data file, e.g. data_cache.db of data.json. Each data file has its own cache.'''
+    return os.path.splitext(data_path)[0] + '_cache.db'
+
+
+def get_data_source_paths(data_path):
+    '''The data file and the split lists next to it.'''
+    data_dir = os.path.dirname(data_path)
+    return [data_path] + [os.path.join(data_dir, name) for name in DATA_SPLIT_FILES.values()]
+
+
+def get_data_source_stats(data_path):
+    '''Absolute path -> [size, mtime] of the source files, None for a missing split list.'''
+    stats = {}
+    for path in get_data_source_paths(data_path):
+        if os.path.exists(path):
+            stat = os.stat(path)
+            stats[os.path.abspath(path)] = [stat.st_size, stat.st_mtime]
+        else:
+            stats[os.path.abspath(path)] = None
+    return json.dumps(stats, sort_keys=True)
+
+
+def read_split_ids(data_path, split):
+    '''Dialog ids of the split list next to the data file, empty if there is no list.'''
+    path = os.path.join(os.path.dirname(data_path), DATA_SPLIT_FILES[split])
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(f.read().strip().splitlines())
+
+
+def build_data_cache(data_path=DATA_PATH, cache_path=None):
+    '''Parse the data file once into sqlite with split and domain indexes.'''
+    cache_path = cache_path or get_data_cache_path(data_path)
+
+    with open(data_path) as f:
+        data = json.load(f)
+    test_ids = read_split_ids(data_path, 'test')
+    valid_ids = read_split_ids(data_path, 'valid')
+
+    dialog_rows, domain_rows = [], []
+    for idx, dialog in data.items():
+        split = 'test' if idx in test_ids else 'valid' if idx in valid_ids else 'train'
+        goal = dialog['goal']
+        excluded = bool(goal['police'] or goal['hospital'])
+        dialog_rows.append((idx, split, int(excluded), json.dumps(dialog)))
+
+        domains = [d for d in DOMAINS if goal.get(d)]
+        for domain in domains:
+            domain_rows.append((idx, domain, int(len(domains) == 1)))
+
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    with conn:
+        conn.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        conn.execute('CREATE TABLE dialogs (id TEXT PRIMARY KEY, split TEXT, excluded INTEGER, data TEXT)')
+        conn.execute('CREATE TABLE dialog_domains (id TEXT, domain TEXT, exclusive INTEGER)')
+        conn.executemany('INSERT INTO dialogs VALUES (?, ?, ?, ?)', dialog_rows)
+        conn.executemany('INSERT INTO dialog_domains VALUES (?, ?, ?)', domain_rows)
+        conn.execute('CREATE INDEX dialogs_split ON dialogs (split, excluded)')
+        conn.execute('CREATE INDEX dialog_domains_domain ON dialog_domains (domain, exclusive)')
+        conn.executemany('INSERT INTO meta VALUES (?, ?)', [
+            ('version', str(DATA_CACHE_VERSION)),
+            ('source_stats', get_data_source_stats(data_path)),
+        ])
+    conn.close()
+    os.replace(tmp_path, cache_path)
+
+    print(f'Data cache of {len(dialog_rows)} dialogs saved to "{cache_path}".')
+    return cache_path
+
+
+def is_data_cache_fresh(cache_path, data_path):
+    conn = sqlite3.connect(cache_path)
+    try:
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+    except sqlite3.Error:
+        return False
+    finally:
+        conn.close()
+    return meta.get('version') == str(DATA_CACHE_VERSION) and \
+        meta.get('source_stats') == get_data_source_stats(data_path)
+
+
+class DialogStore(Mapping):
+    '''Read-only mapping of dialog id -> dialog backed by the sqlite data cache.
+
+    Dialogs in police & hospital are removed, the same as `load_data`.
+    '''
+
+    def __init__(self, cache_path, split=None):
+        if split not in [None] + DATA_SPLITS:
+            raise ValueError(f'{split = }')
+        self.cache_path = cache_path
+        self.split = split
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+        sql = 'SELECT id FROM dialogs WHERE excluded = 0'
+        params = []
+        if split:
+            sql += ' AND split = ?'
+            params.append(split)
+        self.dialog_ids = [row[0] for row in self.conn.execute(sql, params)]
+        self.dialog_id_set = set(self.dialog_ids)
+
+    def __getitem__(self, dialog_id):
+        if dialog_id not in self.dialog_id_set:
+            raise KeyError(dialog_id)
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM dialogs WHERE id = ?', (dialog_id,)).fetchone()
+        return json.loads(row[0])
+
+    def __iter__(self):
+        return iter(self.dialog_ids)
+
+    def __len__(self):
+        return len(self.dialog_ids)
+
+    def __contains__(self, dialog_id):
+        return dialog_id in self.dialog_id_set
+
+    def filter_ids(self, domain='all', exclusive=False):
+        if domain == 'all':
+            return list(self.dialog_ids)
+        sql = 'SELECT id FROM dialog_domains WHERE domain = ?'
+        if exclusive:
+            sql += ' AND exclusive = 1'
+        with self.lock:
+            rows = self.conn.execute(sql, (domain,)).fetchall()
+        return [row[0] for row in rows if row[0] in self.dialog_id_set]
+
+
+def load_data_cache(data_path=DATA_PATH, split=None, cache_path=None):
+    cache_path = cache_path or get_data_cache_path(data_path)
+    if not os.path.exists(cache_path):
+        print(f'Data cache "{cache_path}" not found. Building...')
+        build_data_cache(data_path, cache_path)
+    elif not is_data_cache_fresh(cache_path, data_path):
+        print(f'Data cache "{cache_path}" is stale. Rebuilding...')
+        build_data_cache(data_path, cache_path)
+    return DialogStore(cache_path, split)
+
+# endregion
+
+
 def print_dialog_goal(dialog, dialog_id):
     print(f'[Dialog Id] {dialog_id}', end='\n\n')
 
@@ -170,21 +733,28 @@ def print_dialog_goal(dialog, dialog_id):
             print()
 
 
+def filter_dialog_ids(data, domain='all', exclusive=False):
+    if isinstance(data, DialogStore):
+        return data.filter_ids(domain, exclusive)
+
+    dialog_ids = []
+    for dialog_id, dialog in data.items():
+        goal = dialog['goal']
+        if domain == 'all':
+            dialog_ids.append(dialog_id)
+        elif exclusive:
+            if goal[domain] and all(not goal[d] for d in DOMAINS if d != domain):
+                dialog_ids.append(dialog_id)
+        elif goal[domain]:
+            dialog_ids.append(dialog_id)
+    return dialog_ids
+
+
 def pick_dialog(data, dialog_id='random', domain='all', exclusive=False):
     assert domain == 'all' or domain in DOMAINS
 
     if dialog_id == 'random':
-        while True:
-            dialog_id = random.choice(list(data.keys()))
-            goal = data[dialog_id]['goal']
-            if domain == 'all':
-                break
-            if exclusive:
-                if goal[domain] and all(not goal[d] for d in DOMAINS if d != domain):
-                    break
-            else:
-                if goal[domain]:
-                    break
+        dialog_id = random.choice(filter_dialog_ids(data, domain, exclusive))
     else:
         assert dialog_id in data
     dialog = data[dialog_id]